@@ -0,0 +1,147 @@
+
+'''
+Compare writing and reading the per-scan QA tables as individual text files
+against the columnar `QAStore`.
+
+Synthetic tables in the plotms text layout are used, so no MS is needed.
+Run within the CASA python environment:
+
+    python benchmarks/bench_qa_store.py --nfields 6 --nscans 40
+
+'''
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from glob import glob
+import numpy as np
+
+from lband_pipeline.qa_plotting.qa_table_engine import (PLOTMS_TXT_DTYPE, scan_products,
+                                                        qa_table_filename, write_plotms_table,
+                                                        plotms_table_header)
+from lband_pipeline.qa_plotting.qa_store import QAStore, read_qa_store, read_plotms_txt
+
+
+def synthetic_table(nrow, scan, field, rng):
+    '''
+    Random table in the plotms text layout.
+    '''
+
+    table = np.zeros(nrow, dtype=PLOTMS_TXT_DTYPE)
+
+    table['x'] = rng.uniform(0, 1e4, nrow)
+    table['y'] = rng.uniform(0, 10, nrow)
+    table['chan'] = rng.integers(0, 64, nrow)
+    table['scan'] = scan
+    table['field'] = field
+    table['ant1'] = rng.integers(0, 27, nrow)
+    table['ant2'] = rng.integers(0, 27, nrow)
+    table['ant1name'] = np.char.add('ea', table['ant1'].astype('U2'))
+    table['ant2name'] = np.char.add('ea', table['ant2'].astype('U2'))
+    table['time'] = 5.0e9 + rng.uniform(0, 3600, nrow)
+    table['freq'] = rng.uniform(1., 2., nrow)
+    table['spw'] = rng.integers(0, 32, nrow)
+    table['corr'] = np.where(rng.uniform(size=nrow) > 0.5, 'RR', 'LL')
+
+    return table
+
+
+def make_tables(nfields, nscans, nrow, seed=0):
+    '''
+    Tables for each field, scan and product. The first field is a calibrator.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    tables = []
+
+    for field in range(nfields):
+        fieldname = "field{}".format(field)
+
+        for scan in range(nscans):
+            for product in scan_products(field == 0):
+                tables.append((fieldname, scan, product,
+                               synthetic_table(nrow, scan, field, rng)))
+
+    return tables
+
+
+def bench_txt(tables, output_folder):
+
+    t0 = time.time()
+    for fieldname, scan, product, table in tables:
+        write_plotms_table(qa_table_filename(output_folder, fieldname, product, scan),
+                           table, product)
+    t_write = time.time() - t0
+
+    t0 = time.time()
+    for txtfile in glob(os.path.join(output_folder, "*.txt")):
+        read_plotms_txt(txtfile)
+    t_read = time.time() - t0
+
+    size = sum([os.path.getsize(txtfile)
+                for txtfile in glob(os.path.join(output_folder, "*.txt"))])
+
+    return t_write, t_read, size
+
+
+def bench_store(tables, store_filename):
+
+    t0 = time.time()
+    store = QAStore()
+    for fieldname, scan, product, table in tables:
+        store.add(product, table,
+                  os.path.basename(qa_table_filename("", fieldname, product, scan)),
+                  header=plotms_table_header(product))
+    store.save(store_filename)
+    t_write = time.time() - t0
+
+    t0 = time.time()
+    for product in np.unique([this_table[2] for this_table in tables]):
+        read_qa_store(store_filename, product)
+    t_read = time.time() - t0
+
+    return t_write, t_read, os.path.getsize(store_filename)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nfields", type=int, default=6)
+    parser.add_argument("--nscans", type=int, default=40)
+    parser.add_argument("--nrow", type=int, default=500,
+                        help="Rows per table.")
+    args = parser.parse_args()
+
+    tables = make_tables(args.nfields, args.nscans, args.nrow)
+
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        txt_folder = os.path.join(tmpdir, "scan_plots_txt")
+        os.mkdir(txt_folder)
+
+        txt_write, txt_read, txt_size = bench_txt(tables, txt_folder)
+        store_write, store_read, store_size = bench_store(tables,
+                                                          os.path.join(tmpdir, "qa_tables.npz"))
+
+        # Check the export round-trips to the same files
+        t0 = time.time()
+        export_folder = os.path.join(tmpdir, "export_txt")
+        QAStore.load(os.path.join(tmpdir, "qa_tables.npz")).export_txt(export_folder)
+        t_export = time.time() - t0
+
+        nfiles = len(glob(os.path.join(export_folder, "*.txt")))
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print("{0} tables of {1} rows".format(len(tables), args.nrow))
+    print("{0:>8} {1:>10} {2:>10} {3:>12}".format("format", "write (s)", "read (s)", "size (MB)"))
+    print("{0:>8} {1:>10.2f} {2:>10.2f} {3:>12.1f}".format("txt", txt_write, txt_read, txt_size / 1e6))
+    print("{0:>8} {1:>10.2f} {2:>10.2f} {3:>12.1f}".format("store", store_write, store_read,
+                                                           store_size / 1e6))
+    print("Legacy export of {0} files: {1:.2f} s".format(nfiles, t_export))
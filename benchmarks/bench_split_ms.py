@@ -0,0 +1,103 @@
+
+'''
+Compare splitting an MS into the continuum and line MSs one after the other
+(`nworkers=1`) against writing both at the same time (`nworkers=2`). Watch the
+peak memory as well as the time: the concurrent mode runs two mstransform
+processes at once.
+
+Needs an imported (uncalibrated) L-band MS. Run within the CASA python
+environment from a scratch folder with room for two copies of the split MSs:
+
+    python benchmarks/bench_split_ms.py /path/to/track.ms
+
+For a fair comparison, drop the page cache between runs (as root):
+
+    sync; echo 3 > /proc/sys/vm/drop_caches
+
+'''
+
+import os
+import time
+import shutil
+import argparse
+
+from casatools import table
+
+from lband_pipeline.ms_split_tools import split_ms
+
+
+def split_nrows(folder):
+    '''
+    Number of rows in each MS within a split folder.
+    '''
+
+    tb = table()
+
+    nrows = {}
+    for ms_name in sorted(os.listdir(folder)):
+        if not ms_name.endswith(".ms"):
+            continue
+
+        tb.open(os.path.join(folder, ms_name))
+        nrows[ms_name] = tb.nrows()
+        tb.close()
+
+    return nrows
+
+
+def run_split(ms_name, outfolder_prefix, nworkers, hanning):
+
+    t0 = time.time()
+
+    split_ms(ms_name,
+             outfolder_prefix=outfolder_prefix,
+             split_type='all',
+             hanningsmooth_continuum=hanning,
+             overwrite=True,
+             nworkers=nworkers)
+
+    elapsed = time.time() - t0
+
+    folder_base = os.path.dirname(ms_name)
+
+    nrows = {}
+    for split_kind in ['continuum', 'speclines']:
+        nrows.update(split_nrows(os.path.join(folder_base,
+                                              "{0}_{1}".format(outfolder_prefix, split_kind))))
+
+    return elapsed, nrows
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("ms_name", type=str)
+    parser.add_argument("--hanning", action='store_true',
+                        help="Hanning smooth the continuum MS.")
+    parser.add_argument("--keep", action='store_true',
+                        help="Keep the split MSs.")
+    args = parser.parse_args()
+
+    ms_name = args.ms_name.rstrip("/")
+    folder_base = os.path.dirname(ms_name)
+
+    timings = {}
+    outputs = {}
+
+    for nworkers, prefix in [(1, "bench_twopass"), (2, "bench_concurrent")]:
+        timings[nworkers], outputs[nworkers] = run_split(ms_name, prefix, nworkers, args.hanning)
+
+        print("nworkers={0}: {1:.1f} s".format(nworkers, timings[nworkers]))
+
+    print("Speed-up: {0:.2f}x".format(timings[1] / timings[2]))
+
+    assert outputs[1] == outputs[2]
+
+    print("Split MSs have the same rows: {}".format(outputs[1]))
+
+    if not args.keep:
+        for prefix in ["bench_twopass", "bench_concurrent"]:
+            for split_kind in ['continuum', 'speclines']:
+                shutil.rmtree(os.path.join(folder_base, "{0}_{1}".format(prefix, split_kind)),
+                              ignore_errors=True)
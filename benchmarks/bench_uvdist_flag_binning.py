@@ -0,0 +1,154 @@
+
+'''
+Compare the original (CHILES) uv-distance flag binning loops with the
+vectorized versions in `flagging_summary_plots`, and check that the binned
+outputs are identical.
+
+A synthetic VLA-like dataset of 27 antennas is used, so no MS is needed.
+Run within the CASA python environment:
+
+    python benchmarks/bench_uvdist_flag_binning.py --nrows 3000000
+
+'''
+
+import time
+import argparse
+import numpy as np
+
+from lband_pipeline.qa_plotting.flagging_summary_plots import (baseline_uvdist_modes,
+                                                               match_baseline_flags,
+                                                               bin_flag_fraction)
+
+
+# The original implementations, kept here as the reference.
+
+def create_baseline_dict(antenna_names, antdata):
+    baseline_pairs = {}
+    i = 0
+    while i <= antdata['antenna1'].max():
+        j = i + 1
+        while j <= antdata['antenna2'].max():
+            temp_dict_key = str(antenna_names[i]) + '&&' + str(antenna_names[j])
+            baseline_pairs[temp_dict_key] = []
+            j += 1
+        i += 1
+    i = 0
+    while i < len(antdata['antenna1']):
+        temp_dict_key = str(antenna_names[antdata['antenna1'][i]]) + '&&' + str(antenna_names[antdata['antenna2'][i]])
+        baseline_pairs[temp_dict_key].append(antdata['uvdist'][i])
+        i += 1
+
+    return baseline_pairs
+
+
+def flag_match_baseline(flgdata, baselines):
+    flagging_data = [[], []]
+    i = 0
+    dictkeys = list(flgdata.keys())
+    while i < len(dictkeys):
+        flagging_data[0].append(uvdist_max(baselines[dictkeys[i]])[0])
+        flagging_data[1].append([flgdata[dictkeys[i]]['flagged'], flgdata[dictkeys[i]]['total']])
+        i += 1
+
+    return flagging_data
+
+
+def uvdist_max(flg_data):
+    yvals, edges = np.histogram(flg_data, bins=20)
+    max_index = yvals.argmax()
+    uvdist_max = (edges[max_index] + edges[max_index + 1]) / 2.
+    return [uvdist_max, np.std(flg_data)]
+
+
+def bin_statistics(dpoints, nbins):
+    binned = [[], []]
+    i = 0
+    width = int(1.05 * max(dpoints[0]) / nbins)
+
+    while i < nbins:
+        j = 0
+        temp_flg, temp_total = 0., 0.
+        while j < len(dpoints[0]):
+            if dpoints[0][j] >= (i * width) and dpoints[0][j] <= ((i + 1) * width):
+                temp_flg += dpoints[1][j][0]
+                temp_total += dpoints[1][j][1]
+            j += 1
+        binned[0].append(i * width)
+        if temp_total == 0:
+            binned[1].append(0)
+        else:
+            binned[1].append(temp_flg / temp_total)
+        i += 1
+
+    return np.array(binned), width
+
+
+def synthetic_data(nant, nrows, seed=0):
+    '''
+    Baselines from random antenna positions with uv-distances that change
+    with time, and random flagdata-like baseline counts.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    antenna_names = ["ea{:02d}".format(ii + 1) for ii in range(nant)]
+
+    ant1, ant2 = np.triu_indices(nant, k=1)
+    nbl = ant1.size
+
+    ntime = max(1, nrows // nbl)
+
+    positions = rng.uniform(-10000, 10000, size=(nant, 2))
+    lengths = np.hypot(*(positions[ant1] - positions[ant2]).T)
+
+    hour_angle = np.linspace(-np.pi / 3, np.pi / 3, ntime)
+    projection = 0.6 + 0.4 * np.abs(np.cos(hour_angle[:, np.newaxis] +
+                                           rng.uniform(0, np.pi, nbl)))
+
+    antdata = {'antenna1': np.tile(ant1, ntime),
+               'antenna2': np.tile(ant2, ntime),
+               'uvdist': (lengths * projection).ravel()}
+
+    flgdata = {}
+    for a1, a2 in zip(ant1, ant2):
+        total = int(rng.integers(1000, 100000))
+        flgdata["{0}&&{1}".format(antenna_names[a1], antenna_names[a2])] = \
+            {'flagged': int(rng.integers(0, total)), 'total': total}
+
+    return antenna_names, antdata, flgdata
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nant", type=int, default=27)
+    parser.add_argument("--nrows", type=int, default=3000000)
+    parser.add_argument("--nbin", type=int, default=25)
+    args = parser.parse_args()
+
+    antenna_names, antdata, flgdata = synthetic_data(args.nant, args.nrows)
+
+    print("{0} antennas, {1} rows".format(args.nant, antdata['uvdist'].size))
+
+    t0 = time.time()
+    base_dict = create_baseline_dict(antenna_names, antdata)
+    datamatch = flag_match_baseline(flgdata, base_dict)
+    binned_orig, width_orig = bin_statistics(datamatch, args.nbin)
+    t_orig = time.time() - t0
+
+    t0 = time.time()
+    uvdist_modes = baseline_uvdist_modes(antdata, len(antenna_names))
+    uvdist, flagged, total = match_baseline_flags(flgdata, antenna_names, uvdist_modes)
+    binned_vect, width_vect = bin_flag_fraction(uvdist, flagged, total, args.nbin)
+    t_vect = time.time() - t0
+
+    print("Original loops: {0:.2f} s".format(t_orig))
+    print("Vectorized: {0:.2f} s".format(t_vect))
+    print("Speed-up: {0:.1f}x".format(t_orig / t_vect))
+
+    assert width_orig == width_vect
+    assert np.array_equal(binned_orig, binned_vect)
+    assert np.array_equal(np.array(datamatch[0]), uvdist)
+
+    print("Binned outputs are identical.")
@@ -0,0 +1,117 @@
+
+'''
+Compare the original per-baseline and per-scan residual binning loops with
+the sort-based group-by in `uvresid_plot`, and check that the outputs are
+identical.
+
+A synthetic plotms-like table of 27 antennas is used, so no MS is needed.
+Run within the CASA python environment:
+
+    python benchmarks/bench_uvresid_binning.py --nscans 60 --nint 20
+
+'''
+
+import time
+import argparse
+import numpy as np
+
+from lband_pipeline.qa_plotting.uvresid_plot import bin_uvdata, bin_uvdata_perscan
+
+
+# The original implementations, kept here as the reference.
+
+def bin_uvdata_loop(dat):
+    list_x, list_y, list_yerr = [], [], []
+    for ant1 in np.unique(dat['ant1']):
+        for ant2 in np.unique(dat['ant2']):
+            hits = np.where((dat['ant1'] == ant1) & (dat['ant2'] == ant2))[0]
+            if len(hits) > 5:
+                q25, q50, q75 = np.percentile(dat['y'][hits], [25, 50, 75])
+                iqr = (1 / 1.35) * (q75 - q25)
+                bin_median = q50
+                bin_std = np.abs(iqr) / np.sqrt(len(hits))
+                bin_x = np.median(dat['x'][hits])
+                list_x.append(bin_x)
+                list_y.append(bin_median)
+                list_yerr.append(bin_std)
+    return np.array([list_x, list_y, list_yerr])
+
+
+def bin_uvdata_perscan_loop(dat):
+    list_x, list_y, list_yerr = [], [], []
+    for ant1 in np.unique(dat['ant1']):
+        for ant2 in np.unique(dat['ant2']):
+            for scan in np.unique(dat['scan']):
+                hits = np.where((dat['ant1'] == ant1) & (dat['ant2'] == ant2) & (dat['scan'] == scan))[0]
+                if len(hits) > 5:
+                    q25, q50, q75 = np.percentile(dat['y'][hits], [25, 50, 75])
+                    iqr = (1 / 1.35) * (q75 - q25)
+                    bin_median = q50
+                    bin_std = np.abs(iqr) / np.sqrt(len(hits))
+                    bin_x = np.median(dat['x'][hits])
+                    list_x.append(bin_x)
+                    list_y.append(bin_median)
+                    list_yerr.append(bin_std)
+    return np.array([list_x, list_y, list_yerr])
+
+
+def synthetic_data(nant, nscans, nint, nspw=16, seed=0):
+    '''
+    Residual amplitudes (%) per baseline, scan, integration, SPW and correlation,
+    with a random fraction of rows removed as if flagged.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    ant1, ant2 = np.triu_indices(nant, k=1)
+
+    nrow = ant1.size * nscans * nint * nspw * 2
+
+    dat = np.zeros(nrow, dtype=[('x', float), ('y', float), ('scan', int),
+                                ('ant1', int), ('ant2', int), ('spw', int)])
+
+    dat['ant1'] = np.tile(ant1, nrow // ant1.size)
+    dat['ant2'] = np.tile(ant2, nrow // ant1.size)
+    dat['scan'] = np.repeat(np.arange(1, nscans + 1), nrow // nscans)
+    dat['spw'] = rng.integers(0, nspw, nrow)
+    dat['x'] = rng.uniform(100, 1e5, nrow)
+    dat['y'] = rng.normal(0, 5, nrow)
+
+    # Flagged rows, including whole baselines in some scans.
+    keep = rng.uniform(size=nrow) > 0.2
+    keep &= ~((dat['ant1'] == 3) & (dat['scan'] % 4 == 0))
+
+    return dat[keep]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nant", type=int, default=27)
+    parser.add_argument("--nscans", type=int, default=60)
+    parser.add_argument("--nint", type=int, default=2)
+    args = parser.parse_args()
+
+    dat = synthetic_data(args.nant, args.nscans, args.nint)
+
+    print("{0} antennas, {1} scans, {2} rows".format(args.nant, args.nscans, dat.size))
+
+    for name, func_loop, func_group in [("per baseline", bin_uvdata_loop, bin_uvdata),
+                                        ("per scan", bin_uvdata_perscan_loop, bin_uvdata_perscan)]:
+
+        t0 = time.time()
+        binned_loop = func_loop(dat)
+        t_loop = time.time() - t0
+
+        t0 = time.time()
+        binned_group = func_group(dat)
+        t_group = time.time() - t0
+
+        print("{0}: loops {1:.2f} s, group-by {2:.2f} s, speed-up {3:.1f}x".format(name, t_loop, t_group,
+                                                                               t_loop / t_group))
+
+        assert binned_loop.shape == binned_group.shape
+        assert np.array_equal(binned_loop, binned_group, equal_nan=True)
+
+    print("Binned outputs are identical.")
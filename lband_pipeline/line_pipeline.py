@@ -22,7 +22,7 @@ from lband_pipeline.line_tools import (bandpass_with_gap_interpolation,
                                        build_cont_dat)
 
 # Info for SPW setup
-from lband_pipeline.spw_setup import create_spw_dict, linerest_dict_GHz
+from lband_pipeline.spw_setup import create_spw_dict, line_catalogue
 
 # Protected velocity range for different targets
 # Used to build `cont.dat` for line SPWs
@@ -69,7 +69,7 @@ myvis = mySDM if mySDM.endswith("ms") else mySDM + ".ms"
 proj_code = mySDM.split(".")[0]
 
 # Get the SPW mapping for the line MS.
-spwdict_filename = "spw_definitions.npy"
+spwdict_filename = "spw_definitions.json"
 linespw_dict = create_spw_dict(myvis, save_spwdict=True,
                                spwdict_filename=spwdict_filename)
 
@@ -192,7 +192,7 @@ if not skip_pipeline:
             # Create cont.dat file based on the target name.
             build_cont_dat(myvis,
                         target_line_range_kms,
-                        line_freqs=linerest_dict_GHz,
+                        line_freqs=line_catalogue,
                         fields=[],  # Empty list == all target fields
                         outfile="cont.dat",
                         overwrite=False,
@@ -1,3 +1,4 @@
 
-from .line_tools import bandpass_with_gap_interpolation
+from .line_tools import (bandpass_with_gap_interpolation, find_bandpass_tables,
+                         interpolate_bandpass_tables)
 from .line_flagging import flag_hi_foreground, build_cont_dat
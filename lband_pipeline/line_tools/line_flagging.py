@@ -10,6 +10,8 @@ import os
 
 from casatools import logsink
 
+from lband_pipeline.ms_metadata import get_ms_metadata, nearest_channel
+
 casalog = logsink()
 
 
@@ -48,23 +50,9 @@ def flag_hi_foreground(myvis,
 
     # Make a new flagging version marking these calls at the end.
 
-    # from taskinit import msmdtool, mstool
-    from casatools import ms
-
     from casatasks import flagdata, flagmanager
 
-    # msmd = msmdtool()
-    # ms = mstool()
-
-    # mymsmd = msmd()
-    myms = ms()
-
-    # if no fields are provided use observe_target intent
-    # I saw once a calibrator also has this intent so check carefully
-    # mymsmd.open(myvis)
-    myms.open(myvis)
-
-    mymsmd = myms.metadata()
+    mymsmd = get_ms_metadata(myvis)
 
     # Loop through field intents. Default is all calibrators.
     field_nums = []
@@ -78,19 +66,15 @@ def flag_hi_foreground(myvis,
 
     field_names = np.asarray(mymsmd.fieldnames())[field_nums]
 
-    mymsmd.close()
-
     # Loop through the field names, identify in calibrator_line_range_kms,
     # and convert mapping from velocity -> freq (LSRK) -> channel.
-    # myms.open(myvis)
-
-    freqs_lsrk = myms.cvelfreqs(spwids=[hi_spw_num], outframe='LSRK')
-
-    myms.close()
+    # LSRK frequencies are for each calibrator's direction. Compute them together.
+    mymsmd.cache_frame_freqs([hi_spw_num],
+                             [field for field in field_names if field in calibrator_line_range_kms],
+                             frames=['LSRK'])
 
     # in Hz
     hi_restfreq = 1.420405752e9
-    vels_lsrk = lines_freq2vels(freqs_lsrk, hi_restfreq)
 
     for field in field_names:
 
@@ -100,6 +84,9 @@ def flag_hi_foreground(myvis,
 
             continue
 
+        freqs_lsrk = mymsmd.chanfreqs(hi_spw_num, frame='LSRK', field=field)
+        vels_lsrk = lines_freq2vels(freqs_lsrk, hi_restfreq)
+
         vel_start = calibrator_line_range_kms[field]['HI'][0]
         vel_stop = calibrator_line_range_kms[field]['HI'][1]
 
@@ -107,8 +94,7 @@ def flag_hi_foreground(myvis,
         if vel_start < vel_stop:
             vel_stop, vel_start = vel_start, vel_stop
 
-        chan_start = np.abs(vels_lsrk - vel_start).argmin()
-        chan_stop = np.abs(vels_lsrk - vel_stop).argmin()
+        chan_start, chan_stop = nearest_channel(vels_lsrk, [vel_start, vel_stop])
 
         # Do the flagging and save a new version
 
@@ -133,8 +119,14 @@ def partition_cont_range(line_freqs=[], spw_start=1, spw_end=2,
                          test_print=False):
     """
     Cuts one continuum range into smaller ones to avoid lines.
+
+    The line ranges are sorted by their start and swept once, merging those that
+    overlap or touch, so the continuum chunks are the gaps between the merged
+    ranges. This scales to thousands of line ranges (e.g., full RRL catalogues).
+
     :param line_freqs: line frequencies in GHz. Given as a two component list for
-        the start and end freqs.
+        the start and end freqs. Reversed ranges (e.g. from velocity ranges) are
+        treated as (min, max).
     :param spw_start: start of the SPW in GHz
     :param spw_end: end of the SPW in GHz
     :return: list of continuum chunks, each defined as a dictionary with start and end
@@ -142,60 +134,41 @@ def partition_cont_range(line_freqs=[], spw_start=1, spw_end=2,
     """
 
     # make sure lists are treaded as float vectors
-    line_freqs = np.array(line_freqs)
-
-    # define line ranges that will be excluded
-    # line_starts = line_freqs - 0.5 * line_widths
-    # line_ends = line_freqs + 0.5 * line_widths
+    line_freqs = np.sort(np.asarray(line_freqs, dtype=float).reshape(-1, 2), axis=1)
 
     if test_print:
         print("All line freqs {}".format(line_freqs))
-        print("Start line freqs {}".format(line_freqs[:, 0]))
-        print("End line freqs {}".format(line_freqs[:, 1]))
+        print("SPW limits: {0}, {1}".format(spw_start, spw_end))
+
+    # Only lines that overlap or touch the SPW matter.
+    in_spw = (line_freqs[:, 1] >= spw_start) & (line_freqs[:, 0] <= spw_end)
+    line_freqs = line_freqs[in_spw]
+
+    if line_freqs.shape[0] == 0:
+        cont_chunks = [dict(start=spw_start, end=spw_end)]
+
+        if test_print:
+            print("Found cont chunks: {}".format(cont_chunks))
+
+        return cont_chunks
+
+    line_freqs = line_freqs[np.argsort(line_freqs[:, 0], kind='stable')]
 
     line_starts = line_freqs[:, 0]
-    line_ends = line_freqs[:, 1]
+    line_ends = np.maximum.accumulate(line_freqs[:, 1])
 
-    # start with the whole spw as one continuum chunk
-    cont_chunks = [dict(start=spw_start, end=spw_end)]
+    # A merged range starts where a line starts after the ends of all previous lines.
+    new_range = np.append(True, line_starts[1:] > line_ends[:-1])
+    last_in_range = np.append(new_range[1:], True)
 
-    if test_print:
-        print("SPW limits: {}".format(cont_chunks))
-        print("SPW len: {}".format(len(cont_chunks)))
-
-    for i in range(len(line_starts)):
-        # for each line loop over the continuum chunk collection and modify it in the process
-        j = 0
-        while j < len(cont_chunks):
-            # line outside chunk, skip
-            if line_ends[i] < cont_chunks[j]["start"] or line_starts[i] > cont_chunks[j]["end"]:
-                pass
-
-            # line covers whole chunk, delete it
-            elif line_starts[i] <= cont_chunks[j]["start"] and line_ends[i] >= cont_chunks[j]["end"]:
-                cont_chunks.pop(j)
-                j = j - 1
-
-            # line covers left edge only, edit cont chunk start
-            elif line_starts[i] < cont_chunks[j]["start"] and line_ends[i] >= cont_chunks[j]["start"]:
-                cont_chunks[j]["start"] = line_ends[i]
-
-            # line covers right edge only, edit cont chunk end
-            elif line_starts[i] <= cont_chunks[j]["end"] and line_ends[i] > cont_chunks[j]["end"]:
-                cont_chunks[j]["end"] = line_starts[i]
-
-            # line in the middle, splits chunk into two
-            elif line_starts[i] > cont_chunks[j]["start"] and line_ends[i] < cont_chunks[j]["end"]:
-                cont_chunks.insert(j + 1, dict(start=line_ends[i], end=cont_chunks[j]["end"]))
-                cont_chunks[j]["end"] = line_starts[i]
-                j = j + 1
-
-            # other non-implemented scenarios (are all useful cases covered? any pathological edge case?)
-            else:
-                pass
+    # The continuum is between the merged ranges and the SPW edges.
+    chunk_starts = np.append(spw_start, line_ends[last_in_range])
+    chunk_ends = np.append(line_starts[new_range], spw_end)
 
-            # progress to the next chunk
-            j = j + 1
+    keep = chunk_ends > chunk_starts
+
+    cont_chunks = [dict(start=float(chunk_start), end=float(chunk_end))
+                   for chunk_start, chunk_end in zip(chunk_starts[keep], chunk_ends[keep])]
 
     if test_print:
         print("Found cont chunks: {}".format(cont_chunks))
@@ -216,7 +189,9 @@ def build_cont_dat(vis, target_line_range_kms,
     Example of cont.dat content from NRAO online documentation:
     https://science.nrao.edu/facilities/vla/data-processing/pipeline/#section-25
     :param vis: path to the measurement set
-    :param line_freqs: line frequencies (obs frame, LSRK) in GHz
+    :param line_freqs: line rest frequencies in GHz, as a dict or a
+        `spw_setup.LineCatalogue`. Velocity range keys match the line species
+        (e.g., "OH" for "OH1612") or names.
     :param line_widths: widths of lines (obs frame, LSRK) in GHz to cut from the continuum
     :param fields: science target fields. If empty, TARGET intent fields are used.
     :param outfile: path to the output cont.dat file
@@ -225,24 +200,15 @@ def build_cont_dat(vis, target_line_range_kms,
     :return: None
     """
 
-    # from taskinit import msmdtool, mstool
-    from casatools import ms
+    from lband_pipeline.spw_setup import LineCatalogue
 
-    # need for metadata
-    # msmd = msmdtool()
-    # mymsmd = msmd()
+    catalogue = line_freqs if isinstance(line_freqs, LineCatalogue) else LineCatalogue(line_freqs)
 
-    # TOPO -> LSRK conversion
-    # ms = mstool()
-    myms = ms()
+    # Field, SPW and TOPO/LSRK frequencies from the persistent metadata index.
+    mymsmd = get_ms_metadata(vis)
 
     # if no fields are provided use observe_target intent
     # I saw once a calibrator also has this intent so check carefully
-    # mymsmd.open(vis)
-    myms.open(vis)
-
-    mymsmd = myms.metadata()
-
     if len(fields) < 1:
         # fields = mymsmd.fieldsforintent("*OBSERVE_TARGET*", True)
         fields = mymsmd.fieldsforintent("*TARGET*", True)
@@ -261,6 +227,10 @@ def build_cont_dat(vis, target_line_range_kms,
         spws = mymsmd.spwsforfield(field)
         cont_dat_field = {}
 
+        # LSRK and TOPO frequencies for this field's direction. Computed once
+        # per MS and field, then kept in the metadata index.
+        mymsmd.cache_frame_freqs(spws, [field])
+
         # Match target with the galaxy. Names should be unique enough to do this
         thisgal = None
         for gal in target_line_range_kms:
@@ -282,77 +252,58 @@ def build_cont_dat(vis, target_line_range_kms,
             # TODO: implement some transformations to LSRK for the edges?
 
             # Grab freqs in LSRK and TOPO
-            freqs_lsrk = myms.cvelfreqs(spwids=[spw], outframe='LSRK')
-            freqs_topo = myms.cvelfreqs(spwids=[spw], outframe='TOPO')
+            freqs_lsrk = mymsmd.chanfreqs(spw, frame='LSRK', field=field)
+            freqs_topo = mymsmd.chanfreqs(spw, frame='TOPO', field=field)
 
             line_freqs_topo = []
 
-            for line in line_freqs:
+            # Only include lines with a defined velocity range. Each range is
+            # matched to all lines of that species at once.
+            for key in target_line_range_kms[thisgal]:
 
-                restfreq = line_freqs[line] * 1e9
+                for vel_range in target_line_range_kms[thisgal][key]:
 
-                # Only include if that line has a defined velocity range
-                key_match = None
-                for key in target_line_range_kms[thisgal]:
-                    if key in line:
-                        key_match = key
-                        break
-
-                if key_match is None:
-                    continue
-
-                for vel_range in target_line_range_kms[thisgal][key_match]:
-
-                    vel_start, vel_stop = vel_range
-
-                    freq_to_match_start = lines_rest2obs(restfreq, vel_start)
-                    freq_to_match_stop = lines_rest2obs(restfreq, vel_stop)
+                    line_names, freq_ranges = catalogue.lines_overlapping(freqs_lsrk.min(),
+                                                                          freqs_lsrk.max(),
+                                                                          vel_range,
+                                                                          species=key)
 
                     if test_print:
-                        print(spw, line, vel_start, vel_stop)
-                        print(spw, line, freq_to_match_start, freq_to_match_stop)
+                        print(spw, key, vel_range, line_names)
+                        print(spw, freq_ranges)
                         print(freqs_lsrk.min(), freqs_lsrk.max())
 
                     # Not within range. Skip.
-                    if freq_to_match_start > freqs_lsrk.max() or freq_to_match_stop < freqs_lsrk.min():
-                        skip_line = True
-                        break
-
-                    skip_line = False
+                    if len(line_names) == 0:
+                        continue
 
                     # Convert from Hz to GHz
-                    freq_topo_start = freq_match_lsrk_to_topo(freq_to_match_start,
-                                                              freqs_lsrk, freqs_topo) * 1e-9
-
-                    freq_topo_stop = freq_match_lsrk_to_topo(freq_to_match_stop,
-                                                             freqs_lsrk, freqs_topo) * 1e-9
+                    freq_ranges_topo = freq_match_lsrk_to_topo(freq_ranges,
+                                                               freqs_lsrk, freqs_topo) * 1e-9
 
                     if test_print:
-                        print("Found range: {0}, {1}".format(freq_topo_start, freq_topo_stop))
+                        print("Found ranges: {0}".format(freq_ranges_topo))
 
-                    line_freqs_topo.append([freq_topo_start, freq_topo_stop])
+                    line_freqs_topo.extend(freq_ranges_topo.tolist())
 
-                if skip_line:
-                    continue
+            if len(line_freqs_topo) == 0:
+                continue
 
-                spw_start = np.min(freqs_topo) * 1e-9  # GHz
-                spw_end = np.max(freqs_topo) * 1e-9  # GHz
+            spw_start = np.min(freqs_topo) * 1e-9  # GHz
+            spw_end = np.max(freqs_topo) * 1e-9  # GHz
 
-                if test_print:
-                    print("SPW {}: {}".format(spw, line_freqs_topo))
+            if test_print:
+                print("SPW {}: {}".format(spw, line_freqs_topo))
 
-                cont_chunks = partition_cont_range(line_freqs_topo, spw_start, spw_end,
-                                                   test_print=test_print)
-                cont_dat_field.update({spw: cont_chunks})
+            cont_chunks = partition_cont_range(line_freqs_topo, spw_start, spw_end,
+                                               test_print=test_print)
+            cont_dat_field.update({spw: cont_chunks})
 
             # print(spw, cont_chunks)
             # print(spw_start, spw_end)
 
         cont_dat.update({field: cont_dat_field})
 
-    mymsmd.close()
-    myms.close()
-
     # write the dictionary into a file usable by the CASA VLA pipeline
     access_mode = "a" if append else "w"
     with open(outfile, access_mode) as f:
@@ -397,11 +348,12 @@ def lines_freq2vels(freqs, restfreq):
 
 def freq_match_lsrk_to_topo(freq_to_match, freqs_lsrk, freqs_topo):
     '''
-    Match channel in freq and return the freq. in TOPO.
+    Match channel in freq and return the freq. in TOPO. `freq_to_match`
+    can be a single frequency or an array.
     '''
 
     # Match in LSRK
-    chan = np.abs(freqs_lsrk - freq_to_match).argmin()
+    chan = nearest_channel(freqs_lsrk, freq_to_match)
 
     # Return channel in TOPO
     return freqs_topo[chan]
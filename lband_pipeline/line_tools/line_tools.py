@@ -1,14 +1,18 @@
 
 import os
+import json
 from glob import glob
-from copy import copy, deepcopy
+from copy import copy
 import numpy as np
-import shutil
 import scipy.ndimage as nd
+from numpy.lib.stride_tricks import sliding_window_view
+from concurrent.futures import ThreadPoolExecutor
 
 from casatasks import bandpass
 from casatools import logsink
 
+from lband_pipeline.parallel_tools import run_work_items
+
 casalog = logsink()
 
 
@@ -172,6 +176,31 @@ def bandpass_with_gap_interpolation(myvis, hi_spwid,
 
     '''
 
+    bpname = find_bandpass_table(myvis, search_string=search_string, task_string=task_string)
+
+    # Remove already-made version
+    # rmtables(bpname)
+    # Or copy to another name to check against
+    # os.system("mv {0} {0}.orig".format(bpname))
+
+    # Add better interpolation scheme. This should only be need for HI?
+
+    interpolate_bandpass(bpname,
+                         spw_ids=[hi_spwid],
+                         poly_order=2,  # Works well from Josh and Eric's testing
+                         add_residuals=False,  # We re-add residuals to match the noise in the gap
+                         backup_table=True,  # A backup table is always made.
+                         test_output_nowrite=False,
+                         test_print=False)
+
+
+
+def find_bandpass_table(myvis, search_string="test", task_string="hifv_testBPdcals"):
+    '''
+    Find the bandpass table of a VLA pipeline stage with the standard naming,
+    e.g. `{myvis}.hifv_testBPdcals.s5_4.testBPcal.tbl`.
+    '''
+
     # Look for BP table
     bpname = glob("{0}.{1}.s*_4.{2}BPcal*.tbl".format(myvis, task_string, search_string))
 
@@ -189,20 +218,158 @@ def bandpass_with_gap_interpolation(myvis, hi_spwid,
         raise ValueError("Found too many matches to the BP table."
                          " Unclear which should be used: {0}".format(bpname))
 
-    # Remove already-made version
-    # rmtables(bpname)
-    # Or copy to another name to check against
-    # os.system("mv {0} {0}.orig".format(bpname))
+    return bpname
 
-    # Add better interpolation scheme. This should only be need for HI?
 
-    interpolate_bandpass(bpname,
-                         spw_ids=[hi_spwid],
-                         poly_order=2,  # Works well from Josh and Eric's testing
-                         add_residuals=False,  # We re-add residuals to match the noise in the gap
-                         backup_table=True,  # A backup table is always made.
-                         test_output_nowrite=False,
-                         test_print=False)
+# (search_string, task_string) of the bandpass tables from each pipeline stage.
+BANDPASS_TABLE_STAGES = [('test', 'hifv_testBPdcals'),
+                         ('', 'hifv_semiFinalBPdcals'),
+                         ('final', 'hifv_finalcals')]
+
+
+def find_bandpass_tables(vis_spws, stages=BANDPASS_TABLE_STAGES):
+    '''
+    Find the bandpass tables of several tracks for `interpolate_bandpass_tables`.
+
+    Parameters
+    ----------
+    vis_spws : dict
+        The SPWs to interpolate (e.g. the HI SPW) for each MS: {myvis: [spw]}.
+    stages : list, optional
+        (search_string, task_string) for each stage. See `find_bandpass_table`.
+
+    Returns
+    -------
+    table_spws : dict
+        The SPWs to interpolate for each table found: {tablename: [spw]}.
+    '''
+
+    table_spws = {}
+
+    for myvis in vis_spws:
+        for search_string, task_string in stages:
+            try:
+                tablename = find_bandpass_table(myvis, search_string=search_string,
+                                                task_string=task_string)
+            except ValueError as err:
+                casalog.post(message="No {0} bandpass table for {1}: {2}".format(task_string, myvis, err),
+                             origin='find_bandpass_tables', priority='WARN')
+                continue
+
+            table_spws[tablename] = [int(spw) for spw in np.atleast_1d(vis_spws[myvis])]
+
+    return table_spws
+
+
+def interpolate_bandpass_tables(table_spws, nworkers=1, atomic=True, log_prefix=None,
+                                **interp_kwargs):
+    '''
+    Interpolate across the gaps of many bandpass tables (e.g. the test, semiFinal
+    and final tables of many tracks) over a process pool.
+
+    Parameters
+    ----------
+    table_spws : dict
+        SPWs to interpolate for each table: {tablename: [spw]}. See `find_bandpass_tables`.
+    nworkers : int, optional
+        Number of processes. Each table is one work item.
+    atomic : bool, optional
+        Restore the modified columns from the backup if a table's interpolation
+        fails or is interrupted (see `interpolate_bandpass_atomic`).
+    log_prefix : str, optional
+        Prefix of the per-table CASA logs when running in parallel. See `run_work_items`.
+    interp_kwargs : dict
+        Passed to `interpolate_bandpass` (e.g. `poly_order`, `add_residuals`).
+
+    Returns
+    -------
+    results : list
+        Output of `run_work_items` per table. 'result' holds the gaps interpolated
+        per SPW, and 'elapsed' the time in seconds.
+    '''
+
+    interp_func = interpolate_bandpass_atomic if atomic else interpolate_bandpass
+
+    work_items = [(tablename, interp_func, (tablename,),
+                   dict(spw_ids=table_spws[tablename], **interp_kwargs))
+                  for tablename in table_spws]
+
+    results = run_work_items(work_items, nworkers=nworkers, log_prefix=log_prefix,
+                             origin='interpolate_bandpass_tables')
+
+    for result in results:
+        gaps = result['result']
+
+        casalog.post(message="{0}: {1:.1f} s. Gaps interpolated: {2}".format(result['label'],
+                                                                         result['elapsed'],
+                                                                         gaps),
+                     origin='interpolate_bandpass_tables')
+
+    return results
+
+
+def interpolate_bandpass_atomic(tablename, **interp_kwargs):
+    '''
+    Run `interpolate_bandpass` in place so an interrupted run can be undone.
+
+    The CPARAM and FLAG values of the modified rows are always saved to the npz
+    backup before they are written, in one `putcol` per column. A marker file
+    `{tablename}.interp_inprogress` lists the SPWs while the table is being
+    modified. If a run raises, those SPWs are restored from the backup straight
+    away; if a run is killed, the next call finds the marker and restores them
+    before interpolating again. A marker without a backup is removed, as the
+    run stopped before the table was modified.
+    '''
+
+    tablename = tablename.rstrip("/")
+
+    interp_kwargs.setdefault('backup_filename', tablename + '.bak_from_interpbandpass.npz')
+    interp_kwargs['backup_table'] = True
+
+    backup_filename = interp_kwargs['backup_filename']
+
+    marker_filename = "{}.interp_inprogress".format(tablename)
+
+    if os.path.exists(marker_filename):
+        with open(marker_filename, 'r') as markerfile:
+            marker_spws = json.load(markerfile)['spw_ids']
+
+        # Without a backup, the run stopped before anything was written.
+        if os.path.exists(backup_filename):
+            casalog.post(message="Found an interrupted interpolation of {0}. Restoring SPWs {1}"
+                         " from {2}".format(tablename, marker_spws, backup_filename),
+                         origin='interpolate_bandpass_atomic', priority='WARN')
+
+            restore_interpolate_bandpass_backup(tablename, spw_ids=marker_spws,
+                                                backup_filename=backup_filename)
+
+        os.remove(marker_filename)
+
+    spw_ids = interp_kwargs.get('spw_ids')
+    if spw_ids is not None:
+        spw_ids = [int(spw) for spw in np.atleast_1d(spw_ids)]
+
+    with open(marker_filename, 'w') as markerfile:
+        json.dump({'spw_ids': spw_ids}, markerfile)
+
+    try:
+        gaps = interpolate_bandpass(tablename, **interp_kwargs)
+    except Exception:
+        if os.path.exists(backup_filename):
+            casalog.post(message="Interpolation of {0} failed. Restoring SPWs {1}"
+                         " from {2}".format(tablename, spw_ids, backup_filename),
+                         origin='interpolate_bandpass_atomic', priority='WARN')
+
+            restore_interpolate_bandpass_backup(tablename, spw_ids=spw_ids,
+                                                backup_filename=backup_filename)
+
+        os.remove(marker_filename)
+        raise
+
+    os.remove(marker_filename)
+
+    return gaps
+
 
 ###############################
 # Josh Marvil's code for bandpass interpolation across gaps.
@@ -211,16 +378,131 @@ def bandpass_with_gap_interpolation(myvis, hi_spwid,
 
 
 def rolling_window(x, k):
-    y = np.ma.zeros((len(x), k), dtype='complex128')
+    '''
+    Windows of `k` (odd) channels centred on each channel of `x`, padded with
+    the edge values. The windows are strided views of one padded copy of `x`.
+    '''
+
     k2 = (k - 1) // 2
-    y[:, k2] = x
-    for i in range(k2):
-        j = k2 - i
-        y[j:, i] = x[:-j]
-        y[:j, i] = x[0]
-        y[:-j, -(i + 1)] = x[j:]
-        y[-j:, -(i + 1)] = x[-1]
-    return y
+    pad_width = (k2, k - 1 - k2)
+
+    data = np.pad(np.ma.getdata(x).astype('complex128'), pad_width, mode='edge')
+    mask = np.pad(np.ma.getmaskarray(x), pad_width, mode='edge')
+
+    return np.ma.array(sliding_window_view(data, k), mask=sliding_window_view(mask, k))
+
+
+def masked_savgol(values, mask, window_size, poly_order, evaluate=None,
+                  max_elements=2**22, n_workers=1):
+    '''
+    Savitzky-Golay smoothing of masked series, batched over all series and channels.
+
+    This gives the same values (to rounding) as fitting `np.ma.polyfit` to each
+    row of `rolling_window` and keeping the constant term. The unmasked points of
+    each window are fit by least squares through the moment sums of the window
+    offsets, which are scaled to [-1, 1] to keep the normal equations well
+    conditioned.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        Series with shape (nseries, nchan).
+    mask : np.ndarray
+        Boolean mask (True is masked) with the same shape as `values`.
+    window_size : int
+        Number of channels in each window. The windows are padded with the edge
+        channels, as in `rolling_window`.
+    poly_order : int
+        Order of the polynomial.
+    evaluate : np.ndarray, optional
+        Boolean array of the channels to evaluate. Default is all.
+    max_elements : int, optional
+        Maximum number of window elements held in memory at once (per worker).
+    n_workers : int, optional
+        Number of threads to evaluate the channels with. NumPy releases the
+        GIL in the fits so blocks of channels run concurrently. The output
+        does not depend on the number of workers.
+
+    Returns
+    -------
+    smoothed : np.ndarray
+        Complex array with the same shape as `values`. Channels that are not
+        evaluated, or with fewer than `poly_order + 1` unmasked points in their
+        window, are NaN.
+    '''
+
+    values = np.atleast_2d(values)
+    mask = np.atleast_2d(mask)
+
+    half = (window_size - 1) // 2
+    pad_width = ((0, 0), (half, window_size - 1 - half))
+
+    # Windows of every channel as strided views: (nseries, nchan, window_size)
+    value_windows = sliding_window_view(np.pad(values, pad_width, mode='edge'),
+                                        window_size, axis=1)
+    mask_windows = sliding_window_view(np.pad(mask, pad_width, mode='edge'),
+                                       window_size, axis=1)
+
+    # Offsets used by the polynomial fit, scaled to [-1, 1].
+    offsets = np.arange(window_size) - np.floor(window_size / 2.)
+    offsets /= max(1., np.abs(offsets).max())
+
+    # Powers of the offsets for the moment sums: (2 * poly_order + 1, window_size)
+    powers = offsets[np.newaxis] ** np.arange(2 * poly_order + 1)[:, np.newaxis]
+
+    # The normal matrix is a Hankel matrix of the moment sums.
+    hankel_idx = np.add.outer(np.arange(poly_order + 1), np.arange(poly_order + 1))
+
+    smoothed = np.full(values.shape, np.nan, dtype=complex)
+
+    if evaluate is None:
+        evaluate = np.ones(values.shape, dtype=bool)
+
+    series_idx, chan_idx = np.nonzero(evaluate)
+
+    # Split into at least one block per worker.
+    block_size = max(1, min(max_elements // window_size,
+                            int(np.ceil(series_idx.size / max(1, n_workers)))))
+
+    def _fit_block(start):
+
+        this_series = series_idx[start:start + block_size]
+        this_chan = chan_idx[start:start + block_size]
+
+        # Only the windows of the evaluated channels are copied.
+        good = ~mask_windows[this_series, this_chan]
+        window_vals = np.where(good, value_windows[this_series, this_chan], 0.)
+
+        # einsum (rather than BLAS) sums each window in the same order for any
+        # block size, so the output does not depend on the number of workers.
+        moments = np.einsum('ij,kj->ik', good.astype(float), powers)
+        rhs = np.einsum('ij,kj->ik', window_vals, powers[:poly_order + 1])
+
+        # Skip if too few points
+        enough = good.sum(1) >= poly_order + 1
+
+        coeffs = np.linalg.solve(moments[enough][:, hankel_idx],
+                                 rhs[enough][:, :, np.newaxis])
+
+        # The value at the window centre is the constant term.
+        smoothed[this_series[enough], this_chan[enough]] = coeffs[:, 0, 0]
+
+    _map_workers(_fit_block, range(0, series_idx.size, block_size), n_workers)
+
+    return smoothed
+
+
+def _map_workers(func, items, n_workers=1):
+    '''
+    Call `func` on each item, over a thread pool when `n_workers > 1`.
+    '''
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # list() to raise any exception from the workers.
+            return list(executor.map(func, items))
+
+    return [func(item) for item in items]
 
 
 def interpolate_bandpass(tablename,
@@ -229,184 +511,408 @@ def interpolate_bandpass(tablename,
                          poly_order=2,
                          add_residuals=True,
                          backup_table=True, test_output_nowrite=False,
-                         test_print=False):
+                         test_print=False, n_workers=1, seed=None,
+                         backup_filename=None):
     '''
     Use Savitzky-Golay smoothing across flagged channels in the bandpass.
 
     The smoothing window size is set by `window_size_factor`. This will create
     a smoothing length (by default) 2.5 times larger than the gap that will be interpolated
     across. Smaller window sizes will produce artifacts over the interpolated region.
+
+    The smoothing is computed with `masked_savgol` for all antennas and
+    polarizations with the same window size at once, and only for the channels
+    that are used: the gaps, and the unflagged channels when `add_residuals=True`.
+
+    With `n_workers > 1`, the smoothing and the gap filling of the antenna and
+    polarization slices run over a thread pool. The residuals added to each
+    slice are drawn from its own random stream, set by `seed` and the
+    (SPW, pol, antenna), so the output does not depend on `n_workers`. With
+    `seed=None`, the seed is drawn from `np.random`.
+
+    The CPARAM and FLAG values of the modified rows are saved first to
+    `backup_filename` (default `{tablename}.bak_from_interpbandpass.npz`).
+
+    Returns the interpolated data per SPW with `test_output_nowrite=True`.
+    Otherwise, returns the channel ranges of the gaps interpolated in each SPW.
     '''
 
     from casatools import table
 
     # from taskinit import tbtool, casalog
 
-    if backup_table:
-        original_table_backup = tablename + '.bak_from_interpbandpass'
-        if not os.path.isdir(original_table_backup):
-            shutil.copytree(tablename, original_table_backup)
-
     # tb = tbtool()
     tb = table()
 
-    tb.open(tablename)
-    all_spw_ids = np.unique(tb.getcol("SPECTRAL_WINDOW_ID"))
-    tb.close()
+    tb.open(tablename, nomodify=test_output_nowrite)
+
+    try:
+        all_spw_ids = np.unique(tb.getcol("SPECTRAL_WINDOW_ID"))
+
+        if spw_ids is None:
+            spw_ids = all_spw_ids
+        else:
+            for spw in spw_ids:
+                if spw not in all_spw_ids:
+                    raise ValueError("SPW {} specified does not exist in the table.".format(spw))
+
+        # Read all of the requested SPWs at once.
+        stb = tb.query('SPECTRAL_WINDOW_ID IN [{0}]'.format(",".join([str(spw) for spw in spw_ids])))
+
+        row_spws = stb.getcol('SPECTRAL_WINDOW_ID')
+        spw_cols = _get_spw_columns(stb, ['CPARAM', 'FLAG'], row_spws, spw_ids)
+
+        if backup_table:
+            if backup_filename is None:
+                backup_filename = tablename + '.bak_from_interpbandpass.npz'
+
+            _backup_spw_columns(backup_filename, spw_cols, stb.rownumbers(), row_spws)
+
+        # We'll just output the corrected data as numpy arrays instead of writing
+        # back to the table.
+        if test_output_nowrite:
+            bp_pass_dict = dict()
+
+        modified = False
+        spw_gaps = {}
+
+        if seed is None:
+            seed = np.random.randint(0, 2**31)
 
-    if spw_ids is None:
-        spw_ids = all_spw_ids
-    else:
         for spw in spw_ids:
-            if spw not in all_spw_ids:
-                raise ValueError("SPW {} specified does not exist in the table.".format(spw))
+            casalog.post(message='processing SPW {0}'.format(spw),
+                         origin='interpolate_bandpass')
 
-    # We'll just output the corrected data as numpy arrays instead of writing
-    # back to the table.
-    if test_output_nowrite:
-        bp_pass_dict = dict()
+            dat = np.ma.array(spw_cols[spw]['CPARAM'], mask=spw_cols[spw]['FLAG'])
 
-    for spw in spw_ids:
-        casalog.post(message='processing SPW {0}'.format(spw),
-                     origin='interpolate_bandpass')
+            dat, spw_gaps[int(spw)] = _interpolate_spw_gaps(dat, spw, window_size_factor, poly_order,
+                                                            add_residuals, test_print,
+                                                            n_workers=n_workers, seed=seed)
+
+            if dat is None:
+                continue
+
+            if test_output_nowrite:
+                bp_pass_dict[spw] = dat
+                continue
+
+            spw_cols[spw]['CPARAM'] = dat.data
+            spw_cols[spw]['FLAG'] = np.ma.getmaskarray(dat)
+
+            modified = True
+
+        if modified:
+            casalog.post(message="writing out smoothed gaps to table for spws {}".format(spw_ids),
+                         origin='interpolate_bandpass')
+
+            _put_spw_columns(stb, ['CPARAM', 'FLAG'], spw_cols, row_spws)
 
-        tb.open(tablename)
-        stb = tb.query('SPECTRAL_WINDOW_ID == {0}'.format(spw))
-        dat = np.ma.array(stb.getcol('CPARAM'))
-        dat.mask = stb.getcol('FLAG')
         stb.close()
+
+    finally:
+        tb.clearlocks()
         tb.close()
 
-        # Identify if there are gaps to interpolate across
-        # We ignore the edge masking in all cases.
-        # The sum is over corr and ants. If there are only 2 gaps, no interpolation is needed.
-        blank_slices = nd.find_objects(*nd.label(dat.sum(2).sum(0).mask))
+    if test_output_nowrite:
+        return bp_pass_dict
 
-        # If there's only 2 slices, it's the SPW edge flagging.
-        # We can skip those.
-        if len(blank_slices) == 2:
-            casalog.post(message="no interpolation needed for {0}".format(spw),
-                         origin='interpolate_bandpass')
-            continue
+    return spw_gaps
+
+
+def _interpolate_spw_gaps(dat, spw, window_size_factor, poly_order, add_residuals,
+                          test_print=False, n_workers=1, seed=0):
+    '''
+    Interpolate across the gaps of one SPW of a bandpass table. `dat` is the
+    masked CPARAM array with shape (npol, nchan, nrow).
+
+    Returns the interpolated array (None when there are no gaps to interpolate)
+    and the [start, stop) channel ranges of the gaps flagged in every row.
+    '''
+
+    # Identify if there are gaps to interpolate across
+    # We ignore the edge masking in all cases.
+    # The sum is over corr and ants. If there are only 2 gaps, no interpolation is needed.
+    blank_slices = nd.find_objects(*nd.label(dat.sum(2).sum(0).mask))
+
+    # If there's only 2 slices, it's the SPW edge flagging.
+    # We can skip those.
+    if len(blank_slices) == 2:
+        casalog.post(message="no interpolation needed for {0}".format(spw),
+                     origin='interpolate_bandpass')
+        return None, []
+
+    # Channel ranges flagged in every row, without the SPW edges.
+    spw_gaps = [[int(slicer[0].start), int(slicer[0].stop)] for slicer in blank_slices[1:-1]]
+
+    dat_shape = dat.shape
+
+    # Mask with the gaps masked out, for the smoothing.
+    smooth_mask = np.ma.getmaskarray(dat).copy()
+    gap_mask = np.zeros(dat_shape, dtype=bool)
 
-        dat_shape = dat.shape
+    # Gaps and window size for each (pol, ant) to interpolate
+    interp_setup = {}
 
-        smooth_dat = deepcopy(dat)
+    for ant in range(dat_shape[2]):
+        for pol in range(dat_shape[0]):
 
-        for ant in range(dat_shape[2]):
-            casalog.post(message='processing antenna {0}'.format(ant),
+            # Skip if all flagged.
+            if np.all(dat.mask[pol, :, ant]):
+                continue
+
+            # Determine ranges to interpolate over
+            blank_slices = nd.find_objects(*nd.label(dat[pol, :, ant].mask))
+
+            # If there's only 2 slices, it's the SPW edge flagging.
+            # No interpolation needed. Nothing to do without any flagging.
+            if len(blank_slices) == 2 or len(blank_slices) == 0:
+                continue
+
+            # Otherwise we'll mask out the middle gaps
+            # Remove the edges.
+            if len(blank_slices) > 1:
+                blank_slices.pop(0)
+                blank_slices.pop(-1)
+
+            nchans_in_gap = max([(thisslc[0].stop - thisslc[0].start)
+                                 for thisslc in blank_slices])
+
+            # Define the window size based on the given fraction of the num of SPW channels
+            window_size = int(np.floor(window_size_factor * nchans_in_gap))
+
+            # Force odd window size
+            if window_size % 2 == 0:
+                window_size += 1
+
+            # Mask out the gap.
+            for slicer in blank_slices:
+                smooth_mask[pol, slicer[0], ant] = True
+                gap_mask[pol, slicer[0], ant] = True
+
+            interp_setup[(pol, ant)] = (blank_slices, window_size)
+
+    # Smooth all (pol, ant) with the same window size together.
+    smooth_dat = np.full(dat_shape, np.nan, dtype=complex)
+
+    for window_size in sorted(set([setup[1] for setup in interp_setup.values()])):
+
+        casalog.post(message="Using window size of {0} for SPW {1}".format(window_size, spw),
+                     origin='interpolate_bandpass')
+
+        # Print a warning if the gap is >50% of the whole SPW
+        if window_size / dat.shape[1] > 0.5:
+            casalog.post(message="Warning: the window size is >50% of the SPW",
                          origin='interpolate_bandpass')
-            for pol in range(dat_shape[0]):
 
-                # Skip if all flagged.
-                if np.all(dat.mask[pol, :, ant]):
-                    continue
+        pol_ants = [pol_ant for pol_ant in interp_setup
+                    if interp_setup[pol_ant][1] == window_size]
+        pols, ants = [np.array(idx) for idx in zip(*pol_ants)]
+
+        # Only evaluate the gaps, plus the unflagged channels used for the residuals.
+        evaluate = gap_mask[pols, :, ants]
+        if add_residuals:
+            evaluate |= ~dat.mask[pols, :, ants]
 
-                # Determine ranges to interpolate over
-                blank_slices = nd.find_objects(*nd.label(dat[pol, :, ant].mask))
+        smooth_dat[pols, :, ants] = masked_savgol(dat.data[pols, :, ants],
+                                                  smooth_mask[pols, :, ants],
+                                                  window_size, poly_order,
+                                                  evaluate=evaluate,
+                                                  n_workers=n_workers)
 
-                # If there's only 2 slices, it's the SPW edge flagging.
-                # No interpolation needed.
-                if len(blank_slices) == 2:
-                    continue
+    casalog.post(message="replacing values with smoothed",
+                 origin='interpolate_bandpass')
 
-                # Otherwise we'll mask out the middle gaps
-                # Remove the edges.
-                if len(blank_slices) > 1:
-                    blank_slices.pop(0)
-                    blank_slices.pop(-1)
+    # Write to the data and mask arrays directly; each slice only touches its own elements.
+    dat_data = dat.data
+    dat_mask = np.ma.getmaskarray(dat)
 
-                nchans_in_gap = max([(thisslc[0].stop - thisslc[0].start)
-                                     for thisslc in blank_slices])
+    def _fill_slice(pol_ant):
+        pol, ant = pol_ant
 
-                # Define the window size based on the given fraction of the num of SPW channels
-                window_size = int(np.floor(window_size_factor * nchans_in_gap))
+        blank_slices, window_size = interp_setup[(pol, ant)]
 
-                # Force odd window size
-                if window_size % 2 == 0:
-                    window_size += 1
+        rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(int(spw), pol, ant)))
 
-                casalog.post(message="Using window size of {0} for SPW {1}".format(window_size, spw),
-                            origin='interpolate_bandpass')
+        _fill_gap_slice(dat_data[pol, :, ant], dat_mask[pol, :, ant], smooth_dat[pol, :, ant],
+                        blank_slices, add_residuals, rng)
 
-                # Print a warning if the gap is >50% of the whole SPW
-                if window_size / dat.shape[1] > 0.5:
-                    casalog.post(message="Warning: the window size is >50% of the SPW",
-                                 origin='interpolate_bandpass')
+    # In (ant, pol) order
+    pol_ants = sorted(interp_setup, key=lambda pol_ant: (pol_ant[1], pol_ant[0]))
 
-                x_polyfit = np.arange(window_size) - np.floor(window_size / 2.)
+    _map_workers(_fill_slice, pol_ants, n_workers)
 
-                # Mask out the gap.
-                for slicer in blank_slices:
-                    smooth_dat.mask[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))] = True
+    dat = np.ma.array(dat_data, mask=dat_mask)
 
-                rolled_array = rolling_window(smooth_dat[pol, :, ant], window_size)
+    # Keeping just for diagnosing issues
+    if test_print:
+        for pol, ant in pol_ants:
+            for slicer in interp_setup[(pol, ant)][0]:
+                print((slice(pol, pol + 1), slicer[0], slice(ant, ant + 1)))
+                print(dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))].shape)
+                print(dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))][:10])
+                print(smooth_dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))][:10])
 
-                for i in range(dat_shape[1]):
-                    # Skip if too few points:
-                    if (rolled_array[i].mask == False).sum() < poly_order + 1:
-                        smooth_dat[pol, i, ant] = np.NaN
-                        continue
+    return dat, spw_gaps
 
-                    # try:
-                    smooth_dat[pol, i, ant] = np.ma.polyfit(x_polyfit,
-                                                            rolled_array[i],
-                                                            poly_order)[-1]
-                    # What's the catch here? ValueError is all flagged?
-                    # except:
-                    #     pass
 
-                casalog.post(message="replacing values with smoothed",
-                             origin='interpolate_bandpass')
+def _fill_gap_slice(data, mask, smoothed, blank_slices, add_residuals, rng):
+    '''
+    Replace the gaps of one (pol, antenna) slice with the smoothed values, and
+    optionally add residuals resampled with `rng` from the unflagged channels.
+    `data` and `mask` are modified in place.
+    '''
 
-                if add_residuals:
-                    resids = dat[pol, :, ant] - smooth_dat[pol, :, ant]
+    if add_residuals:
+        resids = np.ma.array(data - smoothed, mask=mask.copy())
 
-                # Add the interpolated values back to the original array
-                for slicer in blank_slices:
+    # Add the interpolated values back to the original array
+    for slicer in blank_slices:
 
-                    dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))] = \
-                        smooth_dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))]
+        data[slicer[0]] = smoothed[slicer[0]]
 
-                    # Optionally sample residuals from the difference and add to the interpolated
-                    # region to keep a consistent noise level.
-                    if add_residuals:
+        # Optionally sample residuals from the difference and add to the interpolated
+        # region to keep a consistent noise level.
+        if add_residuals:
 
-                        gap_size = slicer[0].stop - slicer[0].start
-                        resid_samps = np.random.choice(resids[~resids.mask], size=gap_size)
+            gap_size = slicer[0].stop - slicer[0].start
+            data[slicer[0]] += rng.choice(resids[~resids.mask], size=gap_size)
 
-                        # Pad some axes on.
-                        resid_samps = resid_samps[np.newaxis, :, np.newaxis]
+        # Reset the mask across the interp region
+        mask[slicer[0]] = False
 
-                        dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))] += resid_samps
 
-                    # Reset the mask across the interp region
-                    dat.mask[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))] = False
+def _get_spw_columns(stb, columns, row_spws, spw_ids):
+    '''
+    Read each column of a table selection in one call and split the rows per
+    SPW into arrays of shape (npol, nchan, nrow). SPWs with different numbers
+    of channels are read with `getvarcol`.
+    '''
+
+    spw_cols = dict([(spw, {}) for spw in spw_ids])
 
-                # Keeping just for diagnosing issues
-                if test_print:
-                    print((slice(pol, pol + 1), slicer[0], slice(ant, ant + 1)))
-                    print(dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))].shape)
-                    print(dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))][:10])
-                    print(smooth_dat[(slice(pol, pol + 1), slicer[0], slice(ant, ant + 1))][:10])
+    for column in columns:
 
-        if test_output_nowrite:
-            bp_pass_dict[spw] = dat
-            continue
+        if len(set(stb.getcolshapestring(column))) == 1:
+            values = stb.getcol(column)
 
-        casalog.post(message="writing out smoothed gaps to table for spw {}".format(spw),
-                     origin='interpolate_bandpass')
+            for spw in spw_ids:
+                spw_cols[spw][column] = values[..., row_spws == spw]
 
-        tb.open(tablename, nomodify=False)
-        stb = tb.query('SPECTRAL_WINDOW_ID == {0}'.format(spw))
-        # Set new data
-        stb.putcol('CPARAM', dat.data)
-        # Set new flags
-        stb.putcol('FLAG', dat.mask)
-        stb.close()
+        else:
+            values = stb.getvarcol(column)
+            cells = [_varcol_cell(values['r{}'.format(ii + 1)]) for ii in range(len(row_spws))]
+
+            for spw in spw_ids:
+                spw_cols[spw][column] = np.stack([cells[ii] for ii in np.flatnonzero(row_spws == spw)],
+                                                 axis=-1)
+
+    return spw_cols
+
+
+def _put_spw_columns(stb, columns, spw_cols, row_spws):
+    '''
+    Write the per-SPW arrays from `_get_spw_columns` back in one call per column.
+    '''
+
+    spw_ids = list(spw_cols)
+
+    for column in columns:
+
+        if len(set([spw_cols[spw][column].shape[:-1] for spw in spw_ids])) == 1:
+            values = np.zeros(spw_cols[spw_ids[0]][column].shape[:-1] + (len(row_spws),),
+                              dtype=spw_cols[spw_ids[0]][column].dtype)
+
+            for spw in spw_ids:
+                values[..., row_spws == spw] = spw_cols[spw][column]
+
+            stb.putcol(column, values)
+
+        else:
+            values = {}
+            for spw in spw_ids:
+                for cell, row in zip(np.moveaxis(spw_cols[spw][column], -1, 0),
+                                     np.flatnonzero(row_spws == spw)):
+                    values['r{}'.format(row + 1)] = cell[..., np.newaxis]
+
+            stb.putvarcol(column, values)
+
+
+def _varcol_cell(cell):
+    '''
+    Remove the trailing row axis that `getvarcol` includes with each cell.
+    '''
+    return cell[..., 0] if cell.ndim == 3 else cell
+
+
+def _backup_spw_columns(backup_filename, spw_cols, rownumbers, row_spws):
+    '''
+    Save the CPARAM and FLAG columns of the rows that will be modified, with
+    their row numbers. SPWs already in an existing backup keep their original
+    values. Restore with `restore_interpolate_bandpass_backup`.
+    '''
 
+    arrays = {}
+
+    if os.path.exists(backup_filename):
+        with np.load(backup_filename, allow_pickle=False) as data:
+            arrays = dict([(key, data[key]) for key in data.files])
+
+    backup_spws = [key.split("/")[0] for key in arrays]
+
+    new_spws = [spw for spw in spw_cols if str(spw) not in backup_spws]
+
+    if len(new_spws) == 0:
+        return
+
+    for spw in new_spws:
+        arrays["{}/rows".format(spw)] = np.asarray(rownumbers)[row_spws == spw]
+        for column in spw_cols[spw]:
+            arrays["{0}/{1}".format(spw, column)] = spw_cols[spw][column]
+
+    tmp_filename = "{}.tmp".format(backup_filename)
+
+    # Pass a file object so numpy does not append '.npz' to the name.
+    with open(tmp_filename, 'wb') as backupfile:
+        np.savez(backupfile, **arrays)
+
+    os.replace(tmp_filename, backup_filename)
+
+
+def restore_interpolate_bandpass_backup(tablename, spw_ids=None, backup_filename=None):
+    '''
+    Restore the CPARAM and FLAG columns saved by `interpolate_bandpass`
+    in `backup_filename` (default `{tablename}.bak_from_interpbandpass.npz`).
+    Only the SPWs in `spw_ids` are restored when given.
+    '''
+
+    from casatools import table
+
+    if backup_filename is None:
+        backup_filename = tablename + '.bak_from_interpbandpass.npz'
+
+    tb = table()
+    tb.open(tablename, nomodify=False)
+
+    try:
+        with np.load(backup_filename, allow_pickle=False) as data:
+
+            spws = sorted(set([key.split("/")[0] for key in data.files]), key=int)
+
+            if spw_ids is not None:
+                spws = [spw for spw in spws if int(spw) in [int(this_spw) for this_spw in spw_ids]]
+
+            for spw in spws:
+                rows = data["{}/rows".format(spw)]
+
+                for column in ['CPARAM', 'FLAG']:
+                    values = data["{0}/{1}".format(spw, column)]
+
+                    for row, cell in zip(rows, np.moveaxis(values, -1, 0)):
+                        tb.putcell(column, int(row), cell)
+
+                casalog.post(message="Restored SPW {0} of {1}".format(spw, tablename),
+                             origin='restore_interpolate_bandpass_backup')
+
+    finally:
         tb.clearlocks()
         tb.close()
-
-    if test_output_nowrite:
-        return bp_pass_dict
@@ -0,0 +1,468 @@
+
+'''
+Persistent index of the MS metadata used throughout the pipeline.
+
+Several steps (SPW setup, target identification, cont.dat creation, flagging,
+quicklook imaging and the QA exports) each reopen the MS to find the same
+facts: the scans and intents of each field, which fields have data, and the
+channel frequencies of each SPW in TOPO and LSRK. These are gathered here in
+one pass and saved as JSON next to the MS (`{ms_name}.metadata_index.json`).
+
+The index is rebuilt when the MS structure changes (see
+`product_cache.ms_metadata_fingerprint`). Flagging and applying calibration do
+not change the fingerprint, so they do not invalidate the index or the cached
+per-field frequencies.
+
+`ms.cvelfreqs` uses the direction of the first field by default. LSRK frequencies
+for a given field are computed on first use, kept in the index keyed by
+(SPW, field, frame) and saved with it, so repeated cont.dat or flagging calls on
+mosaics do not redo the conversions.
+
+The methods mimic the `msmetadata` tool names so they can be swapped in directly.
+
+'''
+
+import os
+import json
+from fnmatch import fnmatch
+import numpy as np
+
+from casatools import logsink
+
+from lband_pipeline.ms_reader import iter_table_chunks
+from lband_pipeline.product_cache import ms_metadata_fingerprint
+
+casalog = logsink()
+
+
+# Sub-tables that the index is built from.
+INDEX_SUBTABLES = ['ANTENNA', 'DATA_DESCRIPTION', 'FIELD', 'SPECTRAL_WINDOW', 'STATE']
+
+# Loaded indices for this process: {ms_name: MSMetadataIndex}
+_LOADED_INDICES = {}
+
+
+def metadata_index_filename(ms_name):
+    '''
+    Name of the index saved next to the MS.
+    '''
+    return "{}.metadata_index.json".format(ms_name.rstrip("/"))
+
+
+def get_ms_metadata(ms_name, rebuild=False, save=True):
+    '''
+    Return the metadata index for an MS.
+
+    The index is loaded from memory, then from the file next to the MS, and is
+    only built from the MS when neither matches its current fingerprint.
+
+    Parameters
+    ----------
+    ms_name : str
+        MS name.
+    rebuild : bool, optional
+        Force the index to be rebuilt.
+    save : bool, optional
+        Save a newly built index next to the MS.
+
+    Returns
+    -------
+    index : `MSMetadataIndex`
+    '''
+
+    fingerprint = ms_metadata_fingerprint(ms_name, subtables=INDEX_SUBTABLES)
+
+    if not rebuild:
+        index = _LOADED_INDICES.get(ms_name)
+
+        if index is not None and index.fingerprint == fingerprint:
+            return index
+
+        index_filename = metadata_index_filename(ms_name)
+
+        if os.path.exists(index_filename):
+            index = MSMetadataIndex.load(index_filename)
+
+            if index.fingerprint == fingerprint:
+                _LOADED_INDICES[ms_name] = index
+                return index
+
+    casalog.post(message="Building metadata index for {}".format(ms_name),
+                 origin='get_ms_metadata')
+
+    index = MSMetadataIndex.build(ms_name, fingerprint=fingerprint)
+
+    if save:
+        try:
+            index.save(metadata_index_filename(ms_name))
+        except OSError:
+            casalog.post(message="Unable to save the metadata index for {}".format(ms_name),
+                         origin='get_ms_metadata', priority='WARN')
+
+    _LOADED_INDICES[ms_name] = index
+
+    return index
+
+
+class MSMetadataIndex(object):
+    '''
+    Field, scan, intent and SPW metadata of an MS.
+
+    Parameters
+    ----------
+    meta : dict
+        Contents of the index. Use `MSMetadataIndex.build` or `get_ms_metadata`.
+    '''
+
+    def __init__(self, meta):
+
+        self.meta = meta
+
+        self.fingerprint = meta['fingerprint']
+
+        # JSON keys are strings. Convert the ID keys back to integers.
+        self._field_scans = self._int_keys(meta['field_scans'])
+        self._field_intents = self._int_keys(meta['field_intents'])
+        self._field_spws = self._int_keys(meta['field_spws'])
+        self._scan_fields = self._int_keys(meta['scan_fields'])
+        self._scan_intents = self._int_keys(meta['scan_intents'])
+        self._scan_spws = self._int_keys(meta['scan_spws'])
+        self._spws = self._int_keys(meta['spws'])
+
+        # Per-field frame conversions: {"{field}_{spw}_{frame}": freqs}
+        self.meta.setdefault('field_chan_freqs', {})
+
+    @staticmethod
+    def _int_keys(this_dict):
+        return dict([(int(key), this_dict[key]) for key in this_dict])
+
+    @classmethod
+    def build(cls, ms_name, fingerprint=None):
+        '''
+        Build the index from the MS. The MAIN table is read once for the
+        FIELD_ID, SCAN_NUMBER, STATE_ID and DATA_DESC_ID columns.
+        '''
+
+        from casatools import table, ms
+
+        tb = table()
+
+        tb.open(os.path.join(ms_name, "FIELD"))
+        field_names = list(tb.getcol('NAME'))
+        tb.close()
+
+        tb.open(os.path.join(ms_name, "ANTENNA"))
+        ant_names = list(tb.getcol('NAME'))
+        tb.close()
+
+        tb.open(os.path.join(ms_name, "STATE"))
+        if tb.nrows() > 0:
+            state_intents = [obs_mode.split(",") for obs_mode in tb.getcol('OBS_MODE')]
+        else:
+            state_intents = []
+        tb.close()
+
+        tb.open(os.path.join(ms_name, "DATA_DESCRIPTION"))
+        ddid_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+        tb.close()
+
+        tb.open(os.path.join(ms_name, "SPECTRAL_WINDOW"))
+        spw_names = list(tb.getcol('NAME'))
+        spw_bandwidths = tb.getcol('TOTAL_BANDWIDTH')
+        nspw = tb.nrows()
+        chan_widths = [tb.getcell('CHAN_WIDTH', ii) for ii in range(nspw)]
+        chan_freqs = [tb.getcell('CHAN_FREQ', ii) for ii in range(nspw)]
+        tb.close()
+
+        # Unique (field, scan, state, ddid) combinations in the MAIN table.
+        columns = ['FIELD_ID', 'SCAN_NUMBER', 'STATE_ID', 'DATA_DESC_ID']
+
+        combos = []
+        tb.open(ms_name)
+        for rows, chunk in iter_table_chunks(tb, columns):
+            combos.append(np.unique(np.vstack([chunk[column] for column in columns]).T,
+                                    axis=0))
+        tb.close()
+
+        if len(combos) > 0:
+            combos = np.unique(np.vstack(combos), axis=0)
+        else:
+            combos = np.zeros((0, 4), dtype=int)
+
+        field_scans = {}
+        field_intents = {}
+        field_spws = {}
+        scan_fields = {}
+        scan_intents = {}
+        scan_spws = {}
+
+        for field_id, scan, state_id, ddid in combos:
+            field_id, scan, spw = int(field_id), int(scan), int(ddid_spw[ddid])
+
+            intents = state_intents[state_id] if 0 <= state_id < len(state_intents) else []
+
+            field_scans.setdefault(field_id, set()).add(scan)
+            field_intents.setdefault(field_id, set()).update(intents)
+            field_spws.setdefault(field_id, set()).add(spw)
+            scan_fields.setdefault(scan, set()).add(field_id)
+            scan_intents.setdefault(scan, set()).update(intents)
+            scan_spws.setdefault(scan, set()).add(spw)
+
+        # Channel frequencies in TOPO and LSRK, as used when defining the SPWs.
+        spws = {}
+
+        myms = ms()
+        myms.open(ms_name)
+
+        for spwid in range(nspw):
+            spws[spwid] = {'name': spw_names[spwid],
+                           'bandwidth': float(spw_bandwidths[spwid]),
+                           'chan_widths': list(chan_widths[spwid]),
+                           'chan_freqs': list(chan_freqs[spwid])}
+
+            try:
+                spws[spwid]['chan_freqs_topo'] = list(myms.cvelfreqs(spwids=[spwid], outframe='TOPO'))
+                spws[spwid]['chan_freqs_lsrk'] = list(myms.cvelfreqs(spwids=[spwid], outframe='LSRK'))
+            except Exception:
+                # e.g., a SPW without any data. Use the native frequencies
+                spws[spwid]['chan_freqs_topo'] = list(chan_freqs[spwid])
+                spws[spwid]['chan_freqs_lsrk'] = None
+
+                casalog.post(message="Unable to find LSRK frequencies for SPW {}".format(spwid),
+                             origin='MSMetadataIndex.build', priority='WARN')
+
+        myms.close()
+
+        def sorted_lists(this_dict):
+            return dict([(key, sorted(this_dict[key])) for key in sorted(this_dict)])
+
+        if fingerprint is None:
+            fingerprint = ms_metadata_fingerprint(ms_name, subtables=INDEX_SUBTABLES)
+
+        meta = {'ms_name': ms_name,
+                'fingerprint': fingerprint,
+                'field_names': field_names,
+                'antenna_names': ant_names,
+                'ddid_spw': [int(spw) for spw in ddid_spw],
+                'field_scans': sorted_lists(field_scans),
+                'field_intents': sorted_lists(field_intents),
+                'field_spws': sorted_lists(field_spws),
+                'scan_fields': sorted_lists(scan_fields),
+                'scan_intents': sorted_lists(scan_intents),
+                'scan_spws': sorted_lists(scan_spws),
+                'spws': spws}
+
+        return cls(meta)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Load an index saved with `MSMetadataIndex.save`.
+        '''
+
+        with open(filename, 'r') as index_file:
+            meta = json.load(index_file)
+
+        return cls(meta)
+
+    def save(self, filename):
+        '''
+        Save the index as JSON. The file is replaced atomically.
+        '''
+
+        tmp_filename = "{}.tmp".format(filename)
+
+        with open(tmp_filename, 'w') as index_file:
+            json.dump(self.meta, index_file)
+
+        os.replace(tmp_filename, filename)
+
+    def _field_id(self, field):
+        '''
+        Field ID from a field name or ID.
+        '''
+
+        if isinstance(field, str):
+            return self.meta['field_names'].index(field)
+
+        return int(field)
+
+    def fieldnames(self):
+        return list(self.meta['field_names'])
+
+    def antennanames(self):
+        return list(self.meta['antenna_names'])
+
+    def namesforfields(self, field_ids):
+        return [self.meta['field_names'][int(field_id)] for field_id in np.atleast_1d(field_ids)]
+
+    def fieldsforintent(self, intent, asnames=False):
+        '''
+        Fields (in ID order) with any intent matching the wildcard pattern `intent`.
+        '''
+
+        field_ids = [field_id for field_id in sorted(self._field_intents)
+                     if any([fnmatch(this_intent, intent)
+                             for this_intent in self._field_intents[field_id]])]
+
+        if asnames:
+            return self.namesforfields(field_ids)
+
+        return np.array(field_ids, dtype=int)
+
+    def intentsforfield(self, field):
+        return list(self._field_intents.get(self._field_id(field), []))
+
+    def is_calibrator(self, field):
+        '''
+        Whether any intent of the field is a calibration intent.
+        '''
+        return any(["CALIBRATE" in intent for intent in self.intentsforfield(field)])
+
+    def has_data(self, field):
+        '''
+        Whether the field has any rows in the MAIN table.
+        '''
+        return self._field_id(field) in self._field_scans
+
+    def scansforfield(self, field):
+        return np.array(self._field_scans.get(self._field_id(field), []), dtype=int)
+
+    def scansforintent(self, intent):
+        return np.array([scan for scan in sorted(self._scan_intents)
+                         if any([fnmatch(this_intent, intent)
+                                 for this_intent in self._scan_intents[scan]])], dtype=int)
+
+    def fieldsforscan(self, scan):
+        return np.array(self._scan_fields.get(int(scan), []), dtype=int)
+
+    def intentsforscan(self, scan):
+        return list(self._scan_intents.get(int(scan), []))
+
+    def spwsforfield(self, field):
+        return np.array(self._field_spws.get(self._field_id(field), []), dtype=int)
+
+    def spwsforscan(self, scan):
+        return np.array(self._scan_spws.get(int(scan), []), dtype=int)
+
+    def namesforspws(self, spwid):
+        return [self._spws[int(spwid)]['name']]
+
+    def nchan(self, spwid):
+        return len(self._spws[int(spwid)]['chan_freqs'])
+
+    def chanwidths(self, spwid):
+        return np.array(self._spws[int(spwid)]['chan_widths'])
+
+    def bandwidths(self, spwid):
+        return self._spws[int(spwid)]['bandwidth']
+
+    def chanfreqs(self, spwid, frame=None, field=None):
+        '''
+        Channel frequencies (Hz) of a SPW. With `frame=None`, these are the
+        CHAN_FREQ values (as from `msmetadata.chanfreqs`). Otherwise 'TOPO' or
+        'LSRK' from `ms.cvelfreqs`, for the direction of `field` when given.
+        '''
+
+        if frame is None:
+            return np.array(self._spws[int(spwid)]['chan_freqs'])
+
+        if frame.upper() not in ['TOPO', 'LSRK']:
+            raise ValueError("frame must be None, TOPO or LSRK. Given {}".format(frame))
+
+        if field is not None:
+            key = self._frame_key(spwid, field, frame)
+
+            if key not in self.meta['field_chan_freqs']:
+                self.cache_frame_freqs([spwid], [field], frames=[frame])
+
+            freqs = self.meta['field_chan_freqs'][key]
+
+        else:
+            freqs = self._spws[int(spwid)]['chan_freqs_{}'.format(frame.lower())]
+
+        if freqs is None:
+            raise ValueError("No {0} frequencies for SPW {1}".format(frame, spwid))
+
+        return np.array(freqs)
+
+    def _frame_key(self, spwid, field, frame):
+        return "{0}_{1}_{2}".format(self._field_id(field), int(spwid), frame.upper())
+
+    def cache_frame_freqs(self, spwids, fields, frames=['TOPO', 'LSRK'], save=True):
+        '''
+        Compute the channel frequencies of each SPW in each frame for the
+        direction of each field. Only missing combinations are computed, with the
+        MS opened once, and the index is then saved next to the MS.
+        '''
+
+        from casatools import ms
+
+        todo = [(int(spwid), self._field_id(field), frame.upper())
+                for spwid in spwids for field in fields for frame in frames
+                if self._frame_key(spwid, field, frame) not in self.meta['field_chan_freqs']]
+
+        if len(todo) == 0:
+            return
+
+        myms = ms()
+        myms.open(self.meta['ms_name'])
+
+        for spwid, field_id, frame in todo:
+            try:
+                freqs = list(myms.cvelfreqs(spwids=[spwid], fieldids=[field_id], outframe=frame))
+            except Exception:
+                # e.g., a SPW without any data. Same fallback as when building the index.
+                freqs = self._spws[spwid]['chan_freqs_{}'.format(frame.lower())]
+
+                casalog.post(message="Unable to find {0} frequencies for SPW {1} field {2}".format(frame,
+                                                                                                  spwid,
+                                                                                                  field_id),
+                             origin='MSMetadataIndex.cache_frame_freqs', priority='WARN')
+
+            self.meta['field_chan_freqs'][self._frame_key(spwid, field_id, frame)] = freqs
+
+        myms.close()
+
+        if save:
+            try:
+                self.save(metadata_index_filename(self.meta['ms_name']))
+            except OSError:
+                casalog.post(message="Unable to save the metadata index for {}".format(self.meta['ms_name']),
+                             origin='MSMetadataIndex.cache_frame_freqs', priority='WARN')
+
+    def match_frame_freqs(self, freqs, spwid, inframe='LSRK', outframe='TOPO', field=None):
+        '''
+        Convert frequencies (Hz) between frames by matching to the nearest channel
+        of the SPW in `inframe` and returning that channel's frequency in `outframe`.
+        '''
+
+        chans = nearest_channel(self.chanfreqs(spwid, frame=inframe, field=field), freqs)
+
+        return self.chanfreqs(spwid, frame=outframe, field=field)[chans]
+
+
+def nearest_channel(chan_freqs, freqs):
+    '''
+    Index of the nearest channel to each frequency. This matches
+    `np.abs(chan_freqs - freq).argmin()` for each of `freqs` (including the lower
+    index on ties) using a binary search, and works for ascending or descending
+    channel frequencies.
+    '''
+
+    chan_freqs = np.asarray(chan_freqs)
+
+    order = np.argsort(chan_freqs, kind='stable')
+    sorted_freqs = chan_freqs[order]
+
+    pos = np.searchsorted(sorted_freqs, freqs)
+
+    right = np.clip(pos, 0, sorted_freqs.size - 1)
+    left = np.clip(pos - 1, 0, sorted_freqs.size - 1)
+
+    dist_left = np.abs(sorted_freqs[left] - freqs)
+    dist_right = np.abs(sorted_freqs[right] - freqs)
+
+    use_right = (dist_right < dist_left) | ((dist_right == dist_left) & (order[right] < order[left]))
+
+    return order[np.where(use_right, right, left)]
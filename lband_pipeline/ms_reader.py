@@ -0,0 +1,251 @@
+
+'''
+Stream the MAIN table of an MS in bounded chunks.
+
+Reading whole columns (e.g. FLAG or CORRECTED_DATA) with `getcol` or
+`ms.getdata` needs more memory than a node has for A-configuration L-band
+tracks. These readers yield the requested columns in chunks of rows sized to
+a memory budget so the QA routines can accumulate their outputs chunk by chunk.
+
+Array columns are returned in row-major order (nrow, nchan, ncorr); these are
+transposed views of the (ncorr, nchan, nrow) arrays from casatools.
+
+'''
+
+import os
+import numpy as np
+
+from casatools import logsink
+
+casalog = logsink()
+
+
+# Default memory budget per chunk (in bytes) for all of the columns read.
+DEFAULT_MEMORY_BUDGET = 512 * 2**20
+
+# `ms.getdata` items with one value per row or per correlation. All others are
+# taken to have a value per channel and correlation.
+ROW_ITEMS = ['antenna1', 'antenna2', 'field_id', 'data_desc_id', 'scan_number',
+             'time', 'uvdist', 'u', 'v', 'w', 'ha', 'flag_row', 'feed1', 'feed2']
+CORR_ITEMS = ['weight', 'sigma']
+
+
+def row_nbytes(tb, columns):
+    '''
+    Size in bytes of one row of `columns` in an open table (or selection).
+    The cell shapes are taken from the first row, so the table should only
+    contain one DATA_DESC_ID for array columns.
+    '''
+
+    nbytes = 0
+    for column in columns:
+        cell = np.asarray(tb.getcell(column, 0))
+        nbytes += max(cell.nbytes, cell.dtype.itemsize)
+
+    return nbytes
+
+
+def chunk_nrows(tb, columns, memory_budget=DEFAULT_MEMORY_BUDGET):
+    '''
+    Number of rows of `columns` that fit within `memory_budget` bytes.
+    '''
+
+    return max(1, int(memory_budget // row_nbytes(tb, columns)))
+
+
+def iter_table_chunks(tb, columns, memory_budget=DEFAULT_MEMORY_BUDGET,
+                      chunk_rows=None):
+    '''
+    Iterate over an open table (or selection from `tb.query`) in chunks of rows.
+
+    Parameters
+    ----------
+    tb : casatools.table
+        Open table. Array columns must have the same shape in every row, e.g.
+        a selection of a single DATA_DESC_ID.
+    columns : list
+        Column names to read.
+    memory_budget : int, optional
+        Approximate maximum number of bytes per chunk.
+    chunk_rows : int, optional
+        Fixed number of rows per chunk. Overrides `memory_budget`.
+
+    Yields
+    ------
+    rows : slice
+        The rows of the chunk within the table.
+    chunk : dict
+        Array for each column, with the row as the first axis.
+    '''
+
+    nrow = tb.nrows()
+
+    if nrow == 0:
+        return
+
+    if chunk_rows is None:
+        chunk_rows = chunk_nrows(tb, columns, memory_budget=memory_budget)
+
+    for start in range(0, nrow, chunk_rows):
+        this_nrow = min(chunk_rows, nrow - start)
+
+        # casatools returns (..., nrow). Transpose to have the row first.
+        chunk = dict([(column, tb.getcol(column, startrow=start, nrow=this_nrow).T)
+                      for column in columns])
+
+        yield slice(start, start + this_nrow), chunk
+
+
+def iter_ms_chunks(ms_name, columns, taql=None, ddids=None,
+                   memory_budget=DEFAULT_MEMORY_BUDGET, chunk_rows=None):
+    '''
+    Iterate over the MAIN table of an MS per DATA_DESC_ID in bounded row chunks.
+
+    Parameters
+    ----------
+    ms_name : str
+        MS name.
+    columns : list
+        Column names to read, e.g. ['SCAN_NUMBER', 'FLAG'].
+    taql : str, optional
+        Additional TaQL selection, e.g. "FIELD_ID==2 AND SCAN_NUMBER==5".
+    ddids : list, optional
+        DATA_DESC_IDs to read. Default is all in the DATA_DESCRIPTION table.
+    memory_budget : int, optional
+        Approximate maximum number of bytes per chunk.
+    chunk_rows : int, optional
+        Fixed number of rows per chunk. Overrides `memory_budget`.
+
+    Yields
+    ------
+    ddid : int
+        DATA_DESC_ID of the chunk.
+    rows : slice
+        The rows of the chunk within the selection of this DATA_DESC_ID.
+    chunk : dict
+        Array for each column, with the row as the first axis.
+    '''
+
+    from casatools import table
+
+    tb = table()
+
+    if ddids is None:
+        tb.open(os.path.join(ms_name, "DATA_DESCRIPTION"))
+        ddids = range(tb.nrows())
+        tb.close()
+
+    tb.open(ms_name)
+
+    try:
+        for ddid in ddids:
+
+            query = "DATA_DESC_ID=={}".format(ddid)
+            if taql is not None:
+                query = "({0}) AND {1}".format(taql, query)
+
+            ddtable = tb.query(query, columns=",".join(columns))
+
+            try:
+                for rows, chunk in iter_table_chunks(ddtable, columns,
+                                                     memory_budget=memory_budget,
+                                                     chunk_rows=chunk_rows):
+                    yield int(ddid), rows, chunk
+            finally:
+                ddtable.close()
+
+    finally:
+        tb.close()
+
+
+def iter_ms_time_chunks(ms_name, items, selection=None, interval=0.,
+                        memory_budget=DEFAULT_MEMORY_BUDGET, maxrows=None):
+    '''
+    Iterate over an MS in time chunks with `ms.iterinit`.
+
+    The default sort columns are used, so each chunk has a single field and
+    DATA_DESC_ID.
+
+    Parameters
+    ----------
+    ms_name : str
+        MS name.
+    items : list
+        Items for `ms.getdata`, e.g. ['antenna1', 'antenna2', 'flag'].
+    selection : dict, optional
+        Selection passed to `ms.msselect`, e.g. {'field': '3C48', 'spw': '2'}.
+    interval : float, optional
+        Time interval (s) of each chunk. The default of 0 is one integration.
+    memory_budget : int, optional
+        Approximate maximum number of bytes per chunk. Used to set `maxrows` from the
+        largest SPW when `maxrows` is not given.
+    maxrows : int, optional
+        Maximum number of rows per chunk.
+
+    Yields
+    ------
+    chunk : dict
+        Output of `ms.getdata` with the row as the first axis of each item.
+    '''
+
+    from casatools import ms
+
+    if maxrows is None:
+        maxrows = _maxrows_for_budget(ms_name, items, memory_budget)
+
+    myms = ms()
+    myms.open(ms_name)
+
+    try:
+        if selection is not None:
+            myms.msselect(selection)
+
+        myms.iterinit(interval=interval, maxrows=maxrows)
+        myms.iterorigin()
+
+        more_chunks = True
+        while more_chunks:
+            chunk = myms.getdata(items)
+
+            yield dict([(item, np.asarray(chunk[item]).T) for item in chunk])
+
+            more_chunks = myms.iternext()
+
+        myms.iterend()
+
+    finally:
+        myms.close()
+
+
+def _maxrows_for_budget(ms_name, items, memory_budget):
+    '''
+    Rows per chunk within the memory budget for the largest SPW. Per-channel
+    items are taken as complex (16 bytes) per channel and correlation.
+    '''
+
+    from casatools import table
+
+    tb = table()
+
+    tb.open(os.path.join(ms_name, "SPECTRAL_WINDOW"))
+    max_nchan = tb.getcol('NUM_CHAN').max()
+    tb.close()
+
+    tb.open(os.path.join(ms_name, "POLARIZATION"))
+    max_ncorr = tb.getcol('NUM_CORR').max()
+    tb.close()
+
+    nbytes = 0
+    for item in items:
+        item = item.lower()
+
+        if item in ROW_ITEMS:
+            nbytes += 8
+        elif item == 'uvw':
+            nbytes += 24
+        elif item in CORR_ITEMS:
+            nbytes += 8 * max_ncorr
+        else:
+            nbytes += 16 * max_nchan * max_ncorr
+
+    return max(1, int(memory_budget // nbytes))
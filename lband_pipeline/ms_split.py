@@ -49,4 +49,7 @@ split_ms(ms_active,
          line_kwargs={"include_rrls": False,
                       "keep_backup_continuum": keep_backup_continuum},
          reindex=reindex_spws,
-         overwrite=False)
+         overwrite=False,
+         # nworkers=2 writes the continuum and line MSs concurrently with about
+         # twice the peak memory. Keep 1 until timed with benchmarks/bench_split_ms.py.
+         nworkers=1)
@@ -7,8 +7,13 @@ An example format of spw_dict is shown in 20A-246_spw_setup.py.
 '''
 
 import os
+from fnmatch import fnmatch
+import numpy as np
 
 from lband_pipeline.spw_setup import create_spw_dict
+from lband_pipeline.parallel_tools import run_work_items
+from lband_pipeline.ms_reader import iter_ms_chunks, DEFAULT_MEMORY_BUDGET
+from lband_pipeline.ms_metadata import get_ms_metadata
 
 
 def get_continuum_spws(spw_dict, baseband='both', return_string=True):
@@ -134,7 +139,8 @@ def split_ms(ms_name,
                           "keep_backup_continuum": True},
              overwrite=False,
              reindex=False,
-             hanningsmooth_continuum=False):
+             hanningsmooth_continuum=False,
+             nworkers=1):
     '''
     Split an MS into continuum and line SPWs.
 
@@ -164,10 +170,17 @@ def split_ms(ms_name,
     hanningsmooth_continuum : bool, optional
         Apply Hanning smoothing to the continuum. Default is False.
         If enabled, do NOT use `hifv_hanning` in the pipeline!
+        The line MS is never smoothed.
 
-    '''
+    nworkers : int, optional
+        With 2 and `split_type='all'`, the continuum and line MSs are written
+        by two concurrent mstransform processes. Each still reads the whole
+        input MS, and the peak memory is about double that of a single split.
+        Whether this is faster depends on the disks; time it with
+        `benchmarks/bench_split_ms.py` first. Default is 1 to split them one
+        after the other.
 
-    from casatasks import mstransform
+    '''
 
     folder_base, ms_name_base = os.path.split(ms_name)
 
@@ -193,50 +206,78 @@ def split_ms(ms_name,
     # Define the spw mapping dictionary
     spw_dict = create_spw_dict(ms_name)
 
+    # One mstransform call per output. These only read the input MS.
+    work_items = []
+
     if do_split_continuum:
 
         continuum_folder = os.path.join(folder_base, "{}_continuum".format(outfolder_prefix))
 
-        if not os.path.exists(continuum_folder):
-            os.mkdir(continuum_folder)
-        else:
-            # Delete existing version when overwrite is enabled
-            if overwrite:
-                os.system("rm -r {}/*".format(continuum_folder))
+        _make_split_folder(continuum_folder, overwrite=overwrite)
 
         continuum_spw_str = get_continuum_spws(spw_dict, return_string=True,
                                                **continuum_kwargs)
 
-        mstransform(vis=ms_name,
-                    outputvis="{0}/{1}.continuum.ms".format(continuum_folder,
-                                                            ms_name_base),
-                    spw=continuum_spw_str,
-                    datacolumn='DATA',
-                    hanning=hanningsmooth_continuum,
-                    field="",
-                    reindex=reindex)
+        work_items.append(("continuum", _split_spws, (),
+                           dict(vis=ms_name,
+                                outputvis="{0}/{1}.continuum.ms".format(continuum_folder,
+                                                                        ms_name_base),
+                                spw=continuum_spw_str,
+                                datacolumn='DATA',
+                                hanning=hanningsmooth_continuum,
+                                field="",
+                                reindex=reindex)))
 
     if do_split_lines:
 
         lines_folder = os.path.join(folder_base, "{}_speclines".format(outfolder_prefix))
 
-        if not os.path.exists(lines_folder):
-            os.mkdir(lines_folder)
-        else:
-            # Delete existing version when overwrite is enabled
-            if overwrite:
-                os.system("rm -r {}/*".format(lines_folder))
+        _make_split_folder(lines_folder, overwrite=overwrite)
 
         line_spw_str = get_line_spws(spw_dict, return_string=True,
                                      **line_kwargs)
 
-        mstransform(vis=ms_name,
-                    outputvis="{0}/{1}.speclines.ms".format(lines_folder,
-                                                            ms_name_base),
-                    spw=line_spw_str,
-                    datacolumn='DATA',
-                    field="",
-                    reindex=reindex)
+        work_items.append(("speclines", _split_spws, (),
+                           dict(vis=ms_name,
+                                outputvis="{0}/{1}.speclines.ms".format(lines_folder,
+                                                                        ms_name_base),
+                                spw=line_spw_str,
+                                datacolumn='DATA',
+                                field="",
+                                reindex=reindex)))
+
+    log_prefix = os.path.join(folder_base, "{}_split_ms".format(ms_name_base)) if nworkers > 1 else None
+
+    results = run_work_items(work_items, nworkers=nworkers, log_prefix=log_prefix,
+                             origin='split_ms', best_effort=True)
+
+    failed = [result['label'] for result in results if result['error'] is not None]
+
+    if len(failed) > 0:
+        raise RuntimeError("Splitting failed for {0} from {1}".format(failed, ms_name))
+
+
+def _make_split_folder(folder, overwrite=False):
+    '''
+    Make the output folder of a split, emptying an existing one when overwrite is enabled.
+    '''
+
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    else:
+        # Delete existing version when overwrite is enabled
+        if overwrite:
+            os.system("rm -r {}/*".format(folder))
+
+
+def _split_spws(**kwargs):
+    '''
+    Run mstransform. Kept at the module level so it can be sent to a worker process.
+    '''
+
+    from casatasks import mstransform
+
+    return mstransform(**kwargs)
 
 
 def split_ms_final(ms_name,
@@ -250,7 +291,11 @@ def split_ms_final(ms_name,
                    keep_lines_only=True,
                    overwrite=False,
                    output_suffix="",
-                   output_path="."):
+                   output_path=".",
+                   chan_bin=1,
+                   auto_average=False,
+                   max_smearing=0.01,
+                   fov_radius_arcmin=None):
     '''
     Split a calibrated MS into a final version with target or required
     calibrators (if continuum).
@@ -292,6 +337,22 @@ def split_ms_final(ms_name,
     output_path : str, optional
         Output path. Default is "." (current working directory).
 
+    chan_bin : int, optional
+        Number of channels to average. Default is 1 (no averaging).
+
+    auto_average : bool, optional
+        Set `time_bin` and (for the continuum only) `chan_bin` to the most averaging
+        that keeps time and bandwidth smearing below `max_smearing` within
+        `fov_radius_arcmin`. See `smearing_limited_averaging`. The predicted
+        output size is reported before splitting. Default is False.
+
+    max_smearing : float, optional
+        Maximum fractional loss in peak amplitude from smearing for `auto_average`.
+
+    fov_radius_arcmin : float, optional
+        Radius where smearing is limited for `auto_average`. Default is the
+        primary beam FWHM at the lowest frequency of each SPW.
+
     '''
 
     from casatasks import mstransform
@@ -304,10 +365,7 @@ def split_ms_final(ms_name,
     if len(folder_base) == 0:
         folder_base = '.'
 
-    if len(output_suffix) == 0:
-        output_ms_name = f"{ms_name_base}.split"
-    else:
-        output_ms_name = f"{ms_name_base}.split_{output_suffix}"
+    output_ms_name = final_split_name(ms_name, output_suffix=output_suffix)
 
     if overwrite and os.path.exists(output_ms_name):
         os.system(f"rm -r {output_ms_name}")
@@ -316,17 +374,38 @@ def split_ms_final(ms_name,
         casalog.post(f"Found existing MS and overwrite=False. Skipping. Name: {output_ms_name}")
         return
 
+    if auto_average:
+        selection = final_split_selection(ms_name, spw_dict,
+                                          target_name_prefix=target_name_prefix,
+                                          line_intents=line_intents,
+                                          continuum_intents=continuum_intents,
+                                          keep_lines_only=keep_lines_only)
+
+        averaging = smearing_limited_averaging(ms_name, spws=selection['spws'],
+                                               max_smearing=max_smearing,
+                                               fov_radius_arcmin=fov_radius_arcmin)
+
+        time_bin = f"{averaging['time_bin']}s"
+
+        # Keep the full spectral resolution for the lines.
+        if 'speclines' in ms_name_base:
+            chan_bin = 1
+        else:
+            chan_bin = min(averaging['chan_bin'].values())
+
+        casalog.post(f"Averaging {output_ms_name} with time_bin={time_bin} and chan_bin={chan_bin}"
+                     f" for <{max_smearing} smearing. Longest baseline: {averaging['max_baseline']:.0f} m",
+                     origin='split_ms_final')
+
+        report_split_size(ms_name, selection, averaging['integration'], averaging['time_bin'],
+                          chan_bin, keep_flags=keep_flags)
+
     # We're classifying based on "continuum" or "speclines" in the name.
     if 'speclines' in ms_name_base:
 
         # Remove the continuum SPWs that are backups for calibration
         if keep_lines_only:
-            line_spws = []
-            for thisspw in spw_dict:
-                if "continuum" not in spw_dict[thisspw]['label']:
-                    line_spws.append(str(thisspw))
-
-            spw_select_str =",".join(list(set(line_spws)))
+            spw_select_str = ",".join([str(thisspw) for thisspw in _final_line_spws(spw_dict)])
 
         else:
             spw_select_str = ""
@@ -339,6 +418,8 @@ def split_ms_final(ms_name,
                     intent=line_intents,
                     timebin=time_bin,
                     field=f"{target_name_prefix}*",
+                    chanaverage=chan_bin > 1,
+                    chanbin=chan_bin,
                     keepflags=keep_flags,
                     reindex=False)
 
@@ -355,6 +436,8 @@ def split_ms_final(ms_name,
                     intent=continuum_intents,
                     timebin=time_bin,
                     field=f"{target_name_prefix}*",
+                    chanaverage=chan_bin > 1,
+                    chanbin=chan_bin,
                     keepflags=keep_flags,
                     reindex=False)
 
@@ -362,6 +445,318 @@ def split_ms_final(ms_name,
         raise ValueError(f"Cannot find 'continuum' or 'speclines' in name {ms_name_base}")
 
 
+def final_split_name(ms_name, output_suffix=""):
+    '''
+    Name of the MS written by `split_ms_final`.
+    '''
+
+    ms_name_base = os.path.basename(ms_name.rstrip("/"))
+
+    if len(output_suffix) == 0:
+        return f"{ms_name_base}.split"
+
+    return f"{ms_name_base}.split_{output_suffix}"
+
+
+def _final_line_spws(spw_dict):
+    '''
+    The line SPWs kept by `split_ms_final` with `keep_lines_only=True`.
+    '''
+
+    return sorted(set([int(thisspw) for thisspw in spw_dict
+                       if "continuum" not in spw_dict[thisspw]['label']]))
+
+
+def final_split_selection(ms_name, spw_dict,
+                          target_name_prefix="",
+                          line_intents='*TARGET*',
+                          continuum_intents='*TARGET*',
+                          keep_lines_only=True,
+                          **kwargs):
+    '''
+    The intent, field and SPW selection used by `split_ms_final`, for counting rows
+    with `count_final_split_rows`. Other keyword arguments are ignored.
+    '''
+
+    ms_name_base = os.path.basename(ms_name.rstrip("/"))
+
+    if 'speclines' in ms_name_base:
+        return {'intent': line_intents,
+                'field': f"{target_name_prefix}*",
+                'spws': _final_line_spws(spw_dict) if keep_lines_only else None}
+
+    return {'intent': continuum_intents,
+            'field': f"{target_name_prefix}*",
+            'spws': None}
+
+
+def count_final_split_rows(ms_name, selections, keep_flags=False, per_spw=False,
+                           memory_budget=DEFAULT_MEMORY_BUDGET):
+    '''
+    Count the rows of an MS within each split selection in one pass.
+
+    Parameters
+    ----------
+    ms_name : str
+        Name of MS.
+    selections : dict
+        Selection of each output from `final_split_selection`.
+    keep_flags : bool, optional
+        When False, only rows with any unflagged data are counted, matching
+        `mstransform(keepflags=False)`. This reads the FLAG column.
+    per_spw : bool, optional
+        Return the counts of each selection per SPW as {spw: nrows}.
+    memory_budget : int, optional
+        Approximate maximum number of bytes per chunk read.
+
+    Returns
+    -------
+    counts : dict
+        Number of rows for each selection, and 'unselected' for the rows in none
+        of the selections.
+    '''
+
+    from casatools import table
+
+    tb = table()
+
+    tb.open(os.path.join(ms_name, "STATE"))
+    obs_modes = list(tb.getcol('OBS_MODE')) if tb.nrows() > 0 else []
+    tb.close()
+
+    tb.open(os.path.join(ms_name, "FIELD"))
+    field_names = list(tb.getcol('NAME'))
+    tb.close()
+
+    tb.open(os.path.join(ms_name, "DATA_DESCRIPTION"))
+    ddid_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+
+    # Matching states and fields of each selection. The extra False entry
+    # is used for STATE_ID = -1.
+    state_match = {}
+    field_match = {}
+    for label, selection in selections.items():
+        state_match[label] = np.array([fnmatch(obs_mode, selection['intent'])
+                                       for obs_mode in obs_modes] + [False])
+        field_match[label] = np.array([fnmatch(field_name, selection['field'])
+                                       for field_name in field_names])
+
+    columns = ['FIELD_ID', 'STATE_ID']
+    if not keep_flags:
+        columns.append('FLAG')
+
+    counts = dict([(label, {} if per_spw else 0) for label in selections])
+    counts['unselected'] = 0
+
+    for ddid, rows, chunk in iter_ms_chunks(ms_name, columns, memory_budget=memory_budget):
+
+        if keep_flags:
+            good = np.ones(chunk['FIELD_ID'].size, dtype=bool)
+        else:
+            good = ~chunk['FLAG'].reshape(chunk['FLAG'].shape[0], -1).all(axis=1)
+
+        selected = np.zeros_like(good)
+
+        for label, selection in selections.items():
+
+            if selection['spws'] is not None and ddid_spw[ddid] not in selection['spws']:
+                continue
+
+            this_selected = good & state_match[label][chunk['STATE_ID']] & \
+                field_match[label][chunk['FIELD_ID']]
+
+            if per_spw:
+                spw = int(ddid_spw[ddid])
+                counts[label][spw] = counts[label].get(spw, 0) + int(this_selected.sum())
+            else:
+                counts[label] += int(this_selected.sum())
+
+            selected |= this_selected
+
+        counts['unselected'] += int((good & ~selected).sum())
+
+    return counts
+
+
+def max_bandwidth_ratio(max_smearing):
+    '''
+    Largest (bandwidth / frequency) x (distance / synthesized beam FWHM) with a
+    fractional peak loss below `max_smearing`. This inverts the Gaussian-bandpass
+    approximation for a Gaussian beam, I / I0 = 1 / sqrt(1 + (2 ln 2 / 3) x^2)
+    (Bridle & Schwab 1999). For a 1% limit, the square-bandpass (erf) form gives
+    a loss of 0.997% at the same x.
+    '''
+
+    return np.sqrt(3. / (2. * np.log(2.)) * ((1. / (1. - max_smearing))**2 - 1.))
+
+
+def max_time_average(max_smearing, beam_distance):
+    '''
+    Longest averaging time (s) with a fractional peak loss below `max_smearing`
+    at `beam_distance` synthesized beam FWHMs from the phase centre
+    (Bridle & Schwab 1999, eq. 18-43).
+    '''
+
+    return np.sqrt(max_smearing / 1.0830e-9) / beam_distance
+
+
+def smearing_limited_averaging(ms_name, spws=None, max_smearing=0.01,
+                               fov_radius_arcmin=None, max_time_bin=None):
+    '''
+    The most time and channel averaging that keeps time and bandwidth smearing
+    below `max_smearing` within the field of view.
+
+    The longest baseline is from the antenna positions. The synthesized beam is
+    taken as lambda / B_max at the top of each SPW.
+
+    Parameters
+    ----------
+    ms_name : str
+        Name of MS.
+    spws : list, optional
+        SPWs to consider. Default is all with data.
+    max_smearing : float, optional
+        Maximum fractional loss in peak amplitude.
+    fov_radius_arcmin : float, optional
+        Radius where smearing is limited. Default is the primary beam FWHM
+        (45' / nu_GHz) at the lowest frequency of each SPW.
+    max_time_bin : float, optional
+        Upper limit on the time bin (s).
+
+    Returns
+    -------
+    averaging : dict
+        'time_bin' (s; a multiple of the integration time, or 0 for no averaging),
+        'chan_bin' ({spw: nchan}), 'integration' (s) and 'max_baseline' (m).
+    '''
+
+    from casatools import table
+
+    tb = table()
+
+    tb.open(os.path.join(ms_name, "ANTENNA"))
+    positions = tb.getcol('POSITION').T
+    antenna_flags = tb.getcol('FLAG_ROW')
+    tb.close()
+
+    positions = positions[~antenna_flags]
+
+    max_baseline = np.sqrt(((positions[:, np.newaxis] - positions[np.newaxis])**2).sum(-1)).max()
+
+    tb.open(ms_name)
+    integration = float(np.median(tb.getcol('INTERVAL', startrow=0, nrow=min(1000, tb.nrows()))))
+    tb.close()
+
+    metadata = get_ms_metadata(ms_name)
+
+    if spws is None:
+        spws = sorted(set(metadata.meta['ddid_spw']))
+
+    ckms = 299792458.0 / 1000.
+
+    chan_bin = {}
+    time_limits = []
+
+    for spw in spws:
+        freqs = metadata.chanfreqs(spw)
+
+        if fov_radius_arcmin is None:
+            this_fov = 45. / (freqs.min() / 1e9)
+        else:
+            this_fov = fov_radius_arcmin
+
+        fov_rad = np.deg2rad(this_fov / 60.)
+
+        # Bandwidth smearing: the ratio of (bandwidth / freq) and (fov / (lambda / B))
+        # is bandwidth * fov * B / c, so the limit on the averaged bandwidth does
+        # not depend on frequency.
+        max_width = max_bandwidth_ratio(max_smearing) * ckms * 1e3 / (fov_rad * max_baseline)
+
+        chan_bin[int(spw)] = int(np.clip(max_width // np.abs(metadata.chanwidths(spw)).max(),
+                                         1, freqs.size))
+
+        # Time smearing is largest for the smallest beam at the top of the SPW.
+        beam_distance = fov_rad * max_baseline * freqs.max() / (ckms * 1e3)
+
+        time_limits.append(max_time_average(max_smearing, beam_distance))
+
+    max_time = min(time_limits)
+
+    if max_time_bin is not None:
+        max_time = min(max_time, max_time_bin)
+
+    nint = int(max_time // integration)
+
+    time_bin = round(nint * integration, 3) if nint >= 2 else 0
+
+    return {'time_bin': time_bin,
+            'chan_bin': chan_bin,
+            'integration': integration,
+            'max_baseline': float(max_baseline)}
+
+
+def report_split_size(ms_name, selection, integration, time_bin, chan_bin,
+                      keep_flags=True):
+    '''
+    Log the predicted size of a split with and without averaging.
+
+    The size per visibility is the DATA (complex64) and WEIGHT_SPECTRUM (float32)
+    values with 1 bit for the flags, plus ~100 bytes per row for the other columns.
+
+    Returns the predicted sizes in bytes without and with averaging.
+    '''
+
+    from casatools import table, logsink
+
+    casalog = logsink()
+
+    tb = table()
+
+    tb.open(os.path.join(ms_name, "DATA_DESCRIPTION"))
+    ddid_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    ddid_pol = tb.getcol('POLARIZATION_ID')
+    tb.close()
+
+    tb.open(os.path.join(ms_name, "POLARIZATION"))
+    pol_ncorr = tb.getcol('NUM_CORR')
+    tb.close()
+
+    spw_ncorr = dict([(int(spw), int(pol_ncorr[pol])) for spw, pol in zip(ddid_spw, ddid_pol)])
+
+    spw_rows = count_final_split_rows(ms_name, {'split': selection}, keep_flags=True,
+                                      per_spw=True)['split']
+
+    metadata = get_ms_metadata(ms_name)
+
+    time_factor = integration / time_bin if time_bin > 0 else 1.
+
+    vis_bytes = 8 + 4 + 1 / 8.
+    row_bytes = 100.
+
+    size = 0.
+    size_averaged = 0.
+
+    for spw in spw_rows:
+        nchan = metadata.nchan(spw)
+        nchan_out = int(np.ceil(nchan / chan_bin))
+
+        size += spw_rows[spw] * (row_bytes + nchan * spw_ncorr[spw] * vis_bytes)
+        size_averaged += spw_rows[spw] * time_factor * \
+            (row_bytes + nchan_out * spw_ncorr[spw] * vis_bytes)
+
+    casalog.post(f"Predicted split size of {ms_name} ({selection['intent']}):"
+                 f" {size / 1e9:.1f} GB without averaging,"
+                 f" {size_averaged / 1e9:.1f} GB with time_bin={time_bin}s and chan_bin={chan_bin}",
+                 origin='report_split_size')
+
+    if not keep_flags:
+        casalog.post("Fully flagged rows are not kept, so the split will be smaller.",
+                     origin='report_split_size')
+
+    return size, size_averaged
+
+
 def split_ms_final_all(ms_name,
                        spw_dict,
                        data_column='CORRECTED',
@@ -369,35 +764,111 @@ def split_ms_final_all(ms_name,
                        time_bin='0s',
                        keep_flags=False,
                        overwrite=False,
-                       output_path="."):
+                       output_path=".",
+                       nworkers=3,
+                       check_rows=True,
+                       auto_average=False,
+                       max_smearing=0.01,
+                       fov_radius_arcmin=None):
     '''
     Wrapper to split out the target and calibrator data using `split_ms_final`.
+
+    Both splits only read `ms_name`, so they are run at the same time in separate
+    processes. With `check_rows=True`, the rows expected in each output are
+    counted in a third work item (see `count_final_split_rows`) and compared to
+    the rows written. The check is skipped when averaging in time.
+
+    With `nworkers=3` (the default) the two splits and the row count each have
+    their own process. With `nworkers=2` the row count runs after the target
+    split in the first process. The workers write to the current CASA log so
+    their progress is shown as they run.
+
+    With `auto_average=True`, each split is averaged in time (and in frequency for
+    the continuum) up to the smearing limit. See `split_ms_final`.
     '''
 
-    # Target
-    split_ms_final(ms_name,
-                   spw_dict,
-                   data_column=data_column,
-                   target_name_prefix=target_name_prefix,
-                   line_intents='*TARGET*',
-                   continuum_intents='*TARGET*',
-                   time_bin=time_bin,
-                   keep_flags=keep_flags,
-                   keep_lines_only=True,
-                   overwrite=overwrite,
-                   output_suffix="",
-                   output_path=output_path)
+    from casatools import logsink
 
-    # Calibrators
-    split_ms_final(ms_name,
-                   spw_dict,
-                   data_column=data_column,
-                   target_name_prefix=target_name_prefix,
-                   line_intents='*CALIBRATE*',
-                   continuum_intents='*CALIBRATE*',
-                   time_bin=time_bin,
-                   keep_flags=keep_flags,
-                   keep_lines_only=False,
-                   overwrite=overwrite,
-                   output_suffix="calibrators",
-                   output_path=output_path)
+    casalog = logsink()
+
+    split_kwargs = dict(data_column=data_column,
+                        target_name_prefix=target_name_prefix,
+                        time_bin=time_bin,
+                        keep_flags=keep_flags,
+                        overwrite=overwrite,
+                        output_path=output_path,
+                        auto_average=auto_average,
+                        max_smearing=max_smearing,
+                        fov_radius_arcmin=fov_radius_arcmin)
+
+    splits = {'target': dict(line_intents='*TARGET*',
+                             continuum_intents='*TARGET*',
+                             keep_lines_only=True,
+                             output_suffix=""),
+              'calibrators': dict(line_intents='*CALIBRATE*',
+                                  continuum_intents='*CALIBRATE*',
+                                  keep_lines_only=False,
+                                  output_suffix="calibrators")}
+
+    work_items = [(label, split_ms_final, (ms_name, spw_dict), dict(split_kwargs, **splits[label]))
+                  for label in splits]
+
+    if check_rows and (auto_average or time_bin not in ['0s', '']):
+        casalog.post("Skipping the row check with time averaging.",
+                     origin='split_ms_final_all')
+        check_rows = False
+
+    if check_rows:
+        selections = dict([(label, final_split_selection(ms_name, spw_dict,
+                                                         target_name_prefix=target_name_prefix,
+                                                         **splits[label]))
+                           for label in splits])
+
+        work_items.append(("row_count", count_final_split_rows, (ms_name, selections),
+                           dict(keep_flags=keep_flags)))
+
+    casalog.post(f"Starting the final splits of {ms_name}: "
+                 f"{[final_split_name(ms_name, splits[label]['output_suffix']) for label in splits]}",
+                 origin='split_ms_final_all')
+
+    # No per-item logs: these would only be merged once every item finishes.
+    results = run_work_items(work_items, nworkers=nworkers, log_prefix=None,
+                             origin='split_ms_final_all', best_effort=True)
+
+    for result in results:
+        casalog.post(f"{result['label']} took {result['elapsed']:.1f} s",
+                     origin='split_ms_final_all')
+
+    failed = [result['label'] for result in results if result['error'] is not None]
+
+    if len(failed) > 0:
+        raise RuntimeError(f"Final split failed for {failed} from {ms_name}")
+
+    if not check_rows:
+        return
+
+    from casatools import table
+
+    expected = results[-1]['result']
+
+    tb = table()
+
+    mismatched = []
+
+    for label in splits:
+        tb.open(os.path.join(output_path, final_split_name(ms_name, splits[label]['output_suffix'])))
+        nrows = tb.nrows()
+        tb.close()
+
+        casalog.post(f"{label}: {nrows} rows written, {expected[label]} expected",
+                     origin='split_ms_final_all')
+
+        if nrows != expected[label]:
+            mismatched.append(label)
+
+    casalog.post(f"{expected['unselected']} rows with data are not in either split.",
+                 origin='split_ms_final_all')
+
+    if len(mismatched) > 0:
+        raise ValueError(f"Rows written to the {mismatched} splits of {ms_name} do not "
+                         f"match the selected rows: {expected}")
@@ -0,0 +1,181 @@
+
+'''
+Run independent pipeline work items (e.g., per scan QA exports) over a process pool.
+
+Each work item is a tuple of (label, function, args, kwargs). The function must
+be importable at the top level of a module so it can be sent to the workers.
+Failures are caught per item so one bad scan or table does not stop the rest.
+A RuntimeError is raised once all items finish if any failed, unless the caller
+opts into `best_effort` and checks the results itself.
+
+'''
+
+import os
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from casatools import logsink
+
+casalog = logsink()
+
+
+def _run_work_item(index, work_item, log_prefix=None):
+    '''
+    Run a single work item and catch any failure.
+    '''
+
+    label, func, args, kwargs = work_item
+
+    if log_prefix is not None:
+        # Keep each item's CASA log separate so they can be merged in order.
+        logsink().setlogfile("{0}_{1}.log".format(log_prefix, index))
+
+    t0 = time.time()
+
+    try:
+        result = func(*args, **kwargs)
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+
+    return {'index': index,
+            'label': label,
+            'result': result,
+            'error': error,
+            'elapsed': time.time() - t0}
+
+
+def _run_shard(shard, log_prefix=None):
+    '''
+    Run a shard of (index, work item) pairs in series within one worker.
+    '''
+
+    return [_run_work_item(index, work_item, log_prefix=log_prefix)
+            for index, work_item in shard]
+
+
+def _merge_item_logs(log_prefix, nitems, origin):
+    '''
+    Append the per-item worker logs to the main CASA log in the order of the work items.
+    '''
+
+    for index in range(nitems):
+        this_log = "{0}_{1}.log".format(log_prefix, index)
+
+        if not os.path.exists(this_log):
+            continue
+
+        with open(this_log, 'r') as logfile:
+            log_text = logfile.read()
+
+        if len(log_text) > 0:
+            casalog.post(message=log_text, origin=origin)
+
+        os.remove(this_log)
+
+
+def check_work_item_errors(results, origin='run_work_items'):
+    '''
+    Raise a RuntimeError listing the failed work items, if any.
+    '''
+
+    failed = [result['label'] for result in results if result['error'] is not None]
+
+    if len(failed) > 0:
+        raise RuntimeError("{0}: {1} of {2} work items failed: {3}".format(origin, len(failed),
+                                                                          len(results), failed))
+
+
+def run_work_items(work_items, nworkers=1, log_prefix=None,
+                   origin='run_work_items', mp_start_method='fork',
+                   best_effort=False):
+    '''
+    Run work items in series or spread over a pool of processes.
+
+    Parameters
+    ----------
+    work_items : list
+        List of (label, function, args, kwargs) tuples.
+    nworkers : int, optional
+        Number of worker processes. With 1 (the default) the items are run in series
+        in the current process.
+    log_prefix : str, optional
+        When running in parallel, each item writes its CASA log to
+        `{log_prefix}_{index}.log`. These are merged into the main CASA log in the
+        order of `work_items` once all items finish. When None, the workers write
+        to the current CASA log directly.
+    origin : str, optional
+        Origin used for the log messages.
+    mp_start_method : str, optional
+        The multiprocessing start method for the workers. Default is 'fork'.
+    best_effort : bool, optional
+        Return the results when items fail instead of raising a RuntimeError once
+        all items finish. The caller should then check each 'error' (e.g. with
+        `check_work_item_errors`). Default is False.
+
+    Returns
+    -------
+    results : list
+        A dictionary per work item, in the input order, with the 'label', 'result',
+        'error' (traceback string or None) and 'elapsed' time in seconds.
+    '''
+
+    indexed_items = list(enumerate(work_items))
+
+    nworkers = max(1, min(int(nworkers), len(indexed_items)))
+
+    t0 = time.time()
+
+    if nworkers == 1:
+        results = _run_shard(indexed_items)
+
+    else:
+        casalog.post(message="Running {0} work items over {1} processes".format(len(indexed_items), nworkers),
+                     origin=origin)
+
+        # Interleave the items so each shard has a similar mix of (e.g.) calibrator and target scans.
+        shards = [indexed_items[ii::nworkers] for ii in range(nworkers)]
+
+        mp_context = multiprocessing.get_context(mp_start_method)
+
+        results = []
+        with ProcessPoolExecutor(max_workers=nworkers, mp_context=mp_context) as executor:
+            futures = [executor.submit(_run_shard, shard, log_prefix=log_prefix)
+                       for shard in shards]
+
+            for future, shard in zip(futures, shards):
+                try:
+                    results.extend(future.result())
+                except Exception:
+                    # The worker itself died (e.g., a segfault in a CASA tool).
+                    error = traceback.format_exc()
+                    for index, work_item in shard:
+                        results.append({'index': index,
+                                        'label': work_item[0],
+                                        'result': None,
+                                        'error': error,
+                                        'elapsed': 0.})
+
+        results = sorted(results, key=lambda result: result['index'])
+
+        if log_prefix is not None:
+            _merge_item_logs(log_prefix, len(indexed_items), origin)
+
+    nfailed = 0
+    for result in results:
+        if result['error'] is not None:
+            nfailed += 1
+            casalog.post(message="Failed on {0}: {1}".format(result['label'], result['error']),
+                         origin=origin, priority='WARN')
+
+    casalog.post(message="Finished {0} work items ({1} failed) in {2:.1f} s".format(len(results), nfailed,
+                                                                                 time.time() - t0),
+                 origin=origin)
+
+    if not best_effort:
+        check_work_item_errors(results, origin=origin)
+
+    return results
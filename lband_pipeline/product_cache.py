@@ -0,0 +1,251 @@
+
+'''
+Manifest-backed cache for the post-calibration QA and imaging products.
+
+Each product (a txt table, image, etc.) is recorded in a JSON manifest with a key
+built from the inputs that produced it: a fingerprint of the MS data and flags,
+checksums of any calibration tables, and the parameters of the function call.
+A product is only regenerated when its key changes, e.g., after re-flagging or
+re-running a calibration step, instead of relying on whether the file exists.
+
+'''
+
+import os
+import json
+import shutil
+import hashlib
+
+
+# Default manifest name written in each output folder.
+MANIFEST_NAME = ".product_manifest.json"
+
+
+def ms_fingerprint(ms_name, subtables=()):
+    '''
+    Fingerprint of the MS flags and visibilities.
+
+    This uses the size and modification time of the files in the MAIN table
+    (which hold FLAG, DATA, CORRECTED_DATA, etc.) along with the list of saved
+    flag versions. Re-flagging or applying calibration changes the fingerprint
+    without needing to read the data. The table lock file is ignored as it is
+    updated whenever the MS is opened.
+
+    The files of any sub-tables given in `subtables` (e.g. 'FIELD') are
+    included in the same way.
+    '''
+
+    hasher = hashlib.sha1()
+
+    _hash_table_files(hasher, ms_name,
+                      [ms_name] + [os.path.join(ms_name, subtable) for subtable in subtables])
+
+    flagversion_list = os.path.join("{}.flagversions".format(ms_name), "FLAG_VERSION_LIST")
+    if os.path.exists(flagversion_list):
+        with open(flagversion_list, 'rb') as flagfile:
+            hasher.update(flagfile.read())
+
+    return hasher.hexdigest()
+
+
+def ms_metadata_fingerprint(ms_name, subtables=()):
+    '''
+    Fingerprint of the MS structure, for products that do not depend on the
+    flags or visibilities (e.g. the metadata index).
+
+    This uses the files of the sub-tables given in `subtables`, as in
+    `ms_fingerprint`, and the number of rows in the MAIN table. The MAIN table
+    files are not used so flagging or applying calibration does not change it.
+    '''
+
+    from casatools import table
+
+    hasher = hashlib.sha1()
+
+    _hash_table_files(hasher, ms_name,
+                      [os.path.join(ms_name, subtable) for subtable in subtables])
+
+    tb = table()
+    tb.open(ms_name)
+    nrows = tb.nrows()
+    tb.close()
+
+    hasher.update("nrows:{};".format(nrows).encode())
+
+    return hasher.hexdigest()
+
+
+def _hash_table_files(hasher, ms_name, table_names):
+    '''
+    Add the size and modification time of the files of each table (not
+    descending into sub-tables) to `hasher`. The table lock file is ignored.
+    '''
+
+    for table_name in table_names:
+        if not os.path.isdir(table_name):
+            continue
+
+        for filename in sorted(os.listdir(table_name)):
+            if filename == 'table.lock':
+                continue
+
+            this_file = os.path.join(table_name, filename)
+
+            # Sub-tables are directories. Skip these.
+            if os.path.isdir(this_file):
+                continue
+
+            stat = os.stat(this_file)
+            hasher.update("{0}:{1}:{2};".format(os.path.relpath(this_file, ms_name),
+                                                stat.st_size,
+                                                stat.st_mtime_ns).encode())
+
+
+def table_checksum(tablename):
+    '''
+    Checksum of the contents of a (small) CASA table, e.g. a calibration table.
+    Sub-tables are included. The table lock file is ignored.
+    '''
+
+    hasher = hashlib.sha1()
+
+    for dirpath, dirnames, filenames in os.walk(tablename):
+        # Make the walk order deterministic
+        dirnames.sort()
+
+        for filename in sorted(filenames):
+            if filename == 'table.lock':
+                continue
+
+            this_file = os.path.join(dirpath, filename)
+
+            hasher.update(os.path.relpath(this_file, tablename).encode())
+
+            with open(this_file, 'rb') as datafile:
+                for block in iter(lambda: datafile.read(2**20), b''):
+                    hasher.update(block)
+
+    return hasher.hexdigest()
+
+
+def make_cache_key(**inputs):
+    '''
+    Build a cache key from the inputs that define a product. Values must be
+    JSON serializable (numpy scalars are converted with `str`).
+    '''
+
+    key_str = json.dumps(inputs, sort_keys=True, default=str)
+
+    return hashlib.sha1(key_str.encode()).hexdigest()
+
+
+class ProductManifest(object):
+    '''
+    JSON manifest mapping product filenames to the key of the inputs that made them.
+
+    Parameters
+    ----------
+    filename : str
+        Manifest filename. Typically `MANIFEST_NAME` within the output folder.
+    '''
+
+    def __init__(self, filename):
+
+        self.filename = filename
+
+        if os.path.exists(filename):
+            with open(filename, 'r') as manifest_file:
+                self.entries = json.load(manifest_file)
+        else:
+            self.entries = {}
+
+    @classmethod
+    def for_folder(cls, output_folder):
+        '''
+        Load (or start) the manifest within an output folder.
+        '''
+        return cls(os.path.join(output_folder, MANIFEST_NAME))
+
+    def is_current(self, product, key):
+        '''
+        Check whether `product` was made from inputs matching `key`. Products that
+        were written must also still exist on disk.
+
+        Parameters
+        ----------
+        product : str
+            Product filename.
+        key : str
+            Key from `make_cache_key`.
+        '''
+
+        entry = self.entries.get(product)
+
+        if entry is None or entry['key'] != key:
+            return False
+
+        if entry['written'] and not os.path.exists(product):
+            return False
+
+        return True
+
+    def record(self, product, key):
+        '''
+        Record that `product` was made from inputs matching `key`. Whether the
+        product was written is also kept: some products are legitimately not
+        written (e.g., all data flagged) and should not be retried until the
+        inputs change.
+        '''
+        self.entries[product] = {'key': key,
+                                 'written': os.path.exists(product)}
+
+    def remove_stale(self, products, key):
+        '''
+        Remove any of `products` on disk that were not made from inputs matching `key`
+        so they are regenerated.
+
+        Returns
+        -------
+        stale : list
+            The products that need to be remade.
+        '''
+
+        stale = []
+
+        for product in products:
+            if self.is_current(product, key):
+                continue
+
+            stale.append(product)
+            self.forget(product)
+
+            if os.path.isdir(product):
+                shutil.rmtree(product)
+            elif os.path.exists(product):
+                os.remove(product)
+
+        return stale
+
+    def forget(self, product):
+        '''
+        Remove `product` from the manifest.
+        '''
+        self.entries.pop(product, None)
+
+    def clear(self):
+        '''
+        Remove all entries.
+        '''
+        self.entries = {}
+
+    def save(self):
+        '''
+        Write the manifest. The file is replaced atomically so an interrupted
+        run cannot leave a partially written manifest.
+        '''
+
+        tmp_filename = "{}.tmp".format(self.filename)
+
+        with open(tmp_filename, 'w') as manifest_file:
+            json.dump(self.entries, manifest_file, indent=1, sort_keys=True)
+
+        os.replace(tmp_filename, self.filename)
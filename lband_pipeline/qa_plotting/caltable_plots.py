@@ -5,6 +5,12 @@ import numpy as np
 
 from casatools import logsink
 
+from lband_pipeline.parallel_tools import run_work_items, check_work_item_errors
+from lband_pipeline.product_cache import (ProductManifest, make_cache_key,
+                                          table_checksum)
+
+from .qa_store import QAStore
+
 casalog = logsink()
 
 CALTABLE_MAPPING = {'bandpass_amp': {'output_folder': 'final_caltable_txt',
@@ -57,13 +63,24 @@ CALTABLE_MAPPING = {'bandpass_amp': {'output_folder': 'final_caltable_txt',
                                     'colorby': 'spw'}}
 
 
-def make_caltable_txt(ms_active, caltable_type,
-                      caltable_mapping=CALTABLE_MAPPING):
+def caltable_txt_work_items(ms_active, caltable_type,
+                            caltable_mapping=CALTABLE_MAPPING,
+                            manifest=None):
     '''
-    Output txt files using plotms to make plots of various calibration tables.
-    See definitions in `CALTABLE_MAPPING`.
-    The naming convention follows the VLA pipeline table names from `hifv_finalcals`
+    Return the work items (see `lband_pipeline.parallel_tools`) to export
+    each iteration of a calibration table type.
 
+    Existing outputs are skipped. When a `ProductManifest` is given, outputs
+    are only skipped if they were made from the same calibration table
+    (by checksum) and settings; stale outputs are removed.
+
+    Returns
+    -------
+    work_items : list
+        Work items to run.
+    item_products : list
+        The (output folder, output filename, cache key) of each work item. The
+        key is None without a manifest.
     '''
 
     caltable_values = caltable_mapping[caltable_type]
@@ -73,11 +90,6 @@ def make_caltable_txt(ms_active, caltable_type,
 
     tb = table()
 
-    from casaplotms import plotms
-
-    casalog.post(f"Running make_caltable_txt on {caltable_type} to export txt files for QA.")
-    print(f"Running make_caltable_txt on {caltable_type} to export txt files for QA.")
-
     mySDM = ms_active.rstrip(".ms")
 
     if not os.path.exists(caltable_values['output_folder']):
@@ -90,6 +102,9 @@ def make_caltable_txt(ms_active, caltable_type,
     # Blindly assume we want the first name
     caltable_name = caltable_name[0]
 
+    if manifest is not None:
+        caltable_key = table_checksum(caltable_name)
+
     tb.open(caltable_name)
     spw_vals = np.unique(tb.getcol("SPECTRAL_WINDOW_ID"))
     ant_vals = np.unique(tb.getcol("ANTENNA1"))
@@ -98,10 +113,10 @@ def make_caltable_txt(ms_active, caltable_type,
     # Make txt files per SPW.
     iteraxis = spw_vals if caltable_values['iter'] == 'spw' else ant_vals
 
-    for ii in iteraxis:
+    work_items = []
+    item_products = []
 
-        print("On spectral window: {}".format(ii))
-        casalog.post("On spectral window: {}".format(ii))
+    for ii in iteraxis:
 
         # Output text names
         # name_xaxis_yaxis_iter num
@@ -113,30 +128,208 @@ def make_caltable_txt(ms_active, caltable_type,
 
         thisplotfile = os.path.join(caltable_values['output_folder'], out_filename)
 
-        if not os.path.exists(thisplotfile):
-
-            print(caltable_name)
-
-            plotms(vis=caltable_name,
-                   xaxis=caltable_values['x'],
-                   yaxis=caltable_values['y'],
-                   field='',
-                   antenna=str(ii) if caltable_values['iter'] == 'ant' else "",
-                   spw=str(ii) if caltable_values['iter'] == 'spw' else "",
-                   timerange='',
-                   showgui=False,
-                   # avgtime='1e8',
-                   averagedata=True,
-                   plotfile=thisplotfile)
+        if manifest is not None:
+            this_key = make_cache_key(caltable=caltable_key,
+                                      caltable_type=caltable_type,
+                                      iter_num=int(ii),
+                                      **caltable_values)
+
+            manifest.remove_stale([thisplotfile], this_key)
         else:
+            this_key = None
+
+        if os.path.exists(thisplotfile):
             casalog.post("File {} already exists. Skipping".format(thisplotfile))
+            continue
+
+        work_items.append(("{0} {1} {2}".format(caltable_type, caltable_values['iter'], ii),
+                           plotms_caltable_iter,
+                           (caltable_name, caltable_values, ii, thisplotfile),
+                           {}))
+        item_products.append((caltable_values['output_folder'], thisplotfile, this_key))
 
+    return work_items, item_products
 
-def make_all_caltable_txt(msname, caltable_mapping=CALTABLE_MAPPING):
+
+def plotms_caltable_iter(caltable_name, caltable_values, iter_num, plotfile):
+    '''
+    Export one SPW or antenna of a calibration table with plotms.
+    '''
+
+    from casaplotms import plotms
+
+    print("On {0}: {1}".format(caltable_values['iter'], iter_num))
+    casalog.post("On {0}: {1}".format(caltable_values['iter'], iter_num))
+
+    plotms(vis=caltable_name,
+           xaxis=caltable_values['x'],
+           yaxis=caltable_values['y'],
+           field='',
+           antenna=str(iter_num) if caltable_values['iter'] == 'ant' else "",
+           spw=str(iter_num) if caltable_values['iter'] == 'spw' else "",
+           timerange='',
+           showgui=False,
+           # avgtime='1e8',
+           averagedata=True,
+           plotfile=plotfile)
+
+
+def _record_caltable_products(results, item_products, manifests):
+    '''
+    Record the successful exports in the manifest of their output folder.
+    '''
+
+    for result, (output_folder, plotfile, this_key) in zip(results, item_products):
+        if result['error'] is not None or not os.path.exists(plotfile):
+            continue
+
+        manifests[output_folder].record(plotfile, this_key)
+
+    for output_folder in manifests:
+        manifests[output_folder].save()
+
+
+def make_caltable_txt(ms_active, caltable_type,
+                      caltable_mapping=CALTABLE_MAPPING,
+                      nworkers=1, use_cache=True):
+    '''
+    Output txt files using plotms to make plots of various calibration tables.
+    See definitions in `CALTABLE_MAPPING`.
+    The naming convention follows the VLA pipeline table names from `hifv_finalcals`
+
+    Set `nworkers > 1` to export the iterations over a process pool.
+
+    With `use_cache=True`, existing outputs are remade when the calibration
+    table has changed since they were exported (see `lband_pipeline.product_cache`).
+
+    '''
+
+    casalog.post(f"Running make_caltable_txt on {caltable_type} to export txt files for QA.")
+    print(f"Running make_caltable_txt on {caltable_type} to export txt files for QA.")
+
+    output_folder = caltable_mapping[caltable_type]['output_folder']
+
+    manifests = {}
+    if use_cache:
+        if not os.path.exists(output_folder):
+            os.mkdir(output_folder)
+
+        manifests[output_folder] = ProductManifest.for_folder(output_folder)
+
+    work_items, item_products = \
+        caltable_txt_work_items(ms_active, caltable_type,
+                                caltable_mapping=caltable_mapping,
+                                manifest=manifests.get(output_folder))
+
+    results = run_work_items(work_items, nworkers=nworkers,
+                             log_prefix="{0}_{1}".format(output_folder, caltable_type) if nworkers > 1 else None,
+                             origin='make_caltable_txt', best_effort=True)
+
+    # Keep the successful exports before raising on any failure.
+    if use_cache:
+        _record_caltable_products(results, item_products, manifests)
+
+    check_work_item_errors(results, origin='make_caltable_txt')
+
+    return results
+
+
+def make_all_caltable_txt(msname, caltable_mapping=CALTABLE_MAPPING,
+                          nworkers=1, use_cache=True, store_filename=None):
+    '''
+    Export all calibration tables in `caltable_mapping`. With `nworkers > 1`, the
+    iterations of all tables are shared over one process pool.
+
+    With `store_filename`, the exports are also packed into one columnar
+    file (see `pack_caltable_txt`).
+    '''
+
+    work_items = []
+    item_products = []
+
+    manifests = {}
+
+    for key in caltable_mapping:
+        casalog.post(f"Running make_caltable_txt on {key} to export txt files for QA.")
+        print(f"Running make_caltable_txt on {key} to export txt files for QA.")
+
+        output_folder = caltable_mapping[key]['output_folder']
+
+        if use_cache and output_folder not in manifests:
+            if not os.path.exists(output_folder):
+                os.mkdir(output_folder)
+
+            manifests[output_folder] = ProductManifest.for_folder(output_folder)
+
+        these_items, these_products = \
+            caltable_txt_work_items(msname, key,
+                                    caltable_mapping=caltable_mapping,
+                                    manifest=manifests.get(output_folder))
+
+        work_items.extend(these_items)
+        item_products.extend(these_products)
+
+    results = run_work_items(work_items, nworkers=nworkers,
+                             log_prefix="make_all_caltable_txt" if nworkers > 1 else None,
+                             origin='make_all_caltable_txt', best_effort=True)
+
+    # Keep the successful exports before raising on any failure.
+    if use_cache:
+        _record_caltable_products(results, item_products, manifests)
+
+    check_work_item_errors(results, origin='make_all_caltable_txt')
+
+    if store_filename is not None:
+        pack_caltable_txt(msname, store_filename, caltable_mapping=caltable_mapping)
+
+    return results
+
+
+def pack_caltable_txt(msname, store_filename, caltable_mapping=CALTABLE_MAPPING):
+    '''
+    Pack the text exports of each calibration table type into a `QAStore`
+    with one product per type (e.g. 'caltable_bandpass_amp').
+
+    The text files are kept in their output folders as they are the cache
+    for `make_caltable_txt`; only the store needs to be copied to the products.
+    '''
+
+    mySDM = msname.rstrip(".ms")
+
+    if os.path.exists(store_filename):
+        store = QAStore.load(store_filename)
+    else:
+        store = QAStore()
 
     for key in caltable_mapping:
-        make_caltable_txt(msname, key,
-                          caltable_mapping=caltable_mapping)
+
+        caltable_values = caltable_mapping[key]
+
+        caltable_name = glob(mySDM + caltable_values['search_string'])
+        if len(caltable_name) == 0:
+            casalog.post(f"Cannot find {caltable_values['search_string']} table name. Skipping.")
+            continue
+        caltable_name = caltable_name[0]
+
+        # Same naming as in `caltable_txt_work_items`
+        search_name = '{0}_{1}_{2}_{3}*.txt'.format(os.path.splitext(caltable_name)[0],
+                                                    caltable_values['x'],
+                                                    caltable_values['y'],
+                                                    caltable_values['iter'])
+
+        product = "caltable_{}".format(key)
+
+        # Replace any older tables of this type.
+        store.remove(store.filenames(product))
+
+        for txtfile in sorted(glob(os.path.join(caltable_values['output_folder'], search_name))):
+            store.add_txt(product, txtfile)
+
+    store.save(store_filename)
+
+    casalog.post(f"Saved calibration table exports to {store_filename}")
+
+    return store
 
 
 # hifv_plotsummary amp vs freq coloured by ant1
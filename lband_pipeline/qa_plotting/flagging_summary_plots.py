@@ -9,6 +9,11 @@ import os
 
 from casatools import logsink
 
+from lband_pipeline.product_cache import (ProductManifest, make_cache_key,
+                                          ms_fingerprint)
+from lband_pipeline.ms_reader import iter_ms_chunks, DEFAULT_MEMORY_BUDGET
+from lband_pipeline.ms_metadata import get_ms_metadata
+
 casalog = logsink()
 
 
@@ -18,15 +23,9 @@ def make_flagsummary_freq_plot(myvis, flag_dict=None, save_name=None):
     part so we can save it.
     '''
 
-    from casatools import ms
-
     from casatasks import flagdata
 
-    myms = ms()
-
-    myms.open(myvis)
-
-    mymsmd = myms.metadata()
+    mymsmd = get_ms_metadata(myvis)
 
     if flag_dict is None or 'spw:channel' not in flag_dict:
         flag_dict = flagdata(vis=myvis, mode='summary', spwchan=True, action='calculate')
@@ -46,9 +45,6 @@ def make_flagsummary_freq_plot(myvis, flag_dict=None, save_name=None):
         # Plot it.
         plt.plot(spw_freqs, spw_flagfracs, drawstyle='steps-mid', label=f"SPW {spw}")
 
-    mymsmd.close()
-    myms.close()
-
     ax.set_ylim([0.0, 1.5])
 
     plt.legend(loc='upper center', frameon=True, ncol=4)
@@ -72,21 +68,16 @@ def make_all_flagsummary_data(myvis, output_folder='perfield_flagfraction'):
 
 
 def make_flagsummary_freq_data(myvis, output_folder='perfield_flagfraction',
-                               intent="*", overwrite=False):
+                               intent="*", overwrite=False, use_cache=True):
     '''
     This mimics the summary plots made by flagdata, but removes the interactive
     part so we can save it.
-    '''
-
-    from casatools import ms
-
-    from casatasks import flagdata
 
-    myms = ms()
-
-    myms.open(myvis)
+    With `use_cache=True`, existing outputs are remade when the MS flags have
+    changed since they were made (see `lband_pipeline.product_cache`).
+    '''
 
-    mymsmd = myms.metadata()
+    mymsmd = get_ms_metadata(myvis)
 
     fieldsnums = mymsmd.fieldsforintent(intent)
 
@@ -100,64 +91,138 @@ def make_flagsummary_freq_data(myvis, output_folder='perfield_flagfraction',
     casalog.post(f"Selecting on fields: {fields}")
     print(f"Selecting on fields: {fields}")
 
-    for field in fields:
+    if use_cache:
+        manifest = ProductManifest.for_folder(output_folder)
+        ms_key = ms_fingerprint(myvis)
 
-        casalog.post(f"Creating freq. flagging fraction for {field}")
-        print(f"Creating freq. flagging fraction for {field}")
+    # Find the fields that need to be (re)made.
+    todo_fields = []
+    field_keys = {}
+
+    for field in fields:
 
         save_name = f"{output_folder}/field_{field}_flagfrac_freq.txt"
 
         if os.path.exists(save_name) and overwrite:
             os.system(f"rm {save_name}")
 
+        if use_cache:
+            field_keys[field] = make_cache_key(ms=ms_key, field=field,
+                                               product='flagfrac_freq')
+            manifest.remove_stale([save_name], field_keys[field])
+
         if not os.path.exists(save_name):
+            todo_fields.append(field)
+        else:
+            casalog.post(message="File {} already exists. Skipping".format(save_name),
+                         origin='make_qa_tables')
 
-            flag_dict = flagdata(vis=myvis, mode='summary', spwchan=True, action='calculate',
-                                field=field)
+    if len(todo_fields) > 0:
+        # One pass over FLAG for all fields and SPWs.
+        flag_counts = flag_counts_per_channel(myvis)
 
-            flag_data = []
+    for field in todo_fields:
 
-            for spw in spw_nums:
-                spw_freqs = mymsmd.chanfreqs(spw) / 1e9  # GHz
+        casalog.post(f"Creating freq. flagging fraction for {field}")
+        print(f"Creating freq. flagging fraction for {field}")
 
-                spw_flagfracs = []
-                for chan in range(len(spw_freqs)):
-                    spw_flagfracs.append(flag_dict['spw:channel'][f"{spw}:{chan}"]['flagged'] / flag_dict['spw:channel'][f'{spw}:{chan}']['total'])
+        save_name = f"{output_folder}/field_{field}_flagfrac_freq.txt"
 
-                # Make an equal length SPW column
-                spw_labels = [spw] * len(spw_freqs)
+        field_id = mymsmd.fieldnames().index(field)
 
-                flag_data.append([spw_labels, np.arange(len(spw_freqs)), spw_freqs, spw_flagfracs])
+        flag_data = []
 
-            output_data = np.hstack(flag_data).T
+        for spw in spw_nums:
+            spw_freqs = mymsmd.chanfreqs(spw) / 1e9  # GHz
 
-            np.savetxt(save_name, output_data, header="spw,channel,freq,frac")
+            flagged, total = flag_counts[spw]
 
-        else:
-            casalog.post(message="File {} already exists. Skipping".format(save_name),
-                         origin='make_qa_tables')
+            # Channels without data for this field are NaN.
+            with np.errstate(invalid='ignore', divide='ignore'):
+                spw_flagfracs = flagged[field_id] / total[field_id]
 
+            # Make an equal length SPW column
+            spw_labels = [spw] * len(spw_freqs)
 
-    mymsmd.close()
-    myms.close()
+            flag_data.append([spw_labels, np.arange(len(spw_freqs)), spw_freqs, spw_flagfracs])
 
+        output_data = np.hstack(flag_data).T
 
+        np.savetxt(save_name, output_data, header="spw,channel,freq,frac")
 
-def make_flagsummary_uvdist_data(myvis, nbin=25, output_folder="perfield_flagfraction",
-                                 intent='*', overwrite=False):
+        if use_cache:
+            manifest.record(save_name, field_keys[field])
+
+    if use_cache:
+        manifest.save()
+
+
+def flag_counts_per_channel(myvis, memory_budget=DEFAULT_MEMORY_BUDGET):
     '''
-    Make a binned flagging fraction vs. uv-distance.
+    Count the flagged and total visibilities per field, SPW and channel in one
+    pass over FLAG. This matches the 'spw:channel' counts of
+    `flagdata(mode='summary', spwchan=True)` for each field, where each
+    correlation is counted separately.
+
+    Parameters
+    ----------
+    myvis : str
+        MS name.
+    memory_budget : int, optional
+        Approximate maximum number of bytes read at once.
+
+    Returns
+    -------
+    flag_counts : dict
+        For each SPW, the (flagged, total) counts with shape (nfield, nchan).
     '''
 
-    from casatools import ms
+    mymsmd = get_ms_metadata(myvis)
 
-    from casatasks import flagdata
+    nfield = len(mymsmd.fieldnames())
+
+    ddid_spw = mymsmd.meta['ddid_spw']
+
+    flag_counts = {}
+
+    for ddid, rows, chunk in iter_ms_chunks(myvis, ['FIELD_ID', 'FLAG'],
+                                            memory_budget=memory_budget):
 
-    myms = ms()
+        spw = ddid_spw[ddid]
 
-    myms.open(myvis)
+        # Shape is (nrow, nchan, ncorr)
+        nrow, nchan, ncorr = chunk['FLAG'].shape
 
-    mymsmd = myms.metadata()
+        if spw not in flag_counts:
+            flag_counts[spw] = (np.zeros((nfield, nchan)), np.zeros((nfield, nchan)))
+
+        flagged, total = flag_counts[spw]
+
+        # Index of each (field, channel) in the flattened (nfield, nchan) arrays.
+        field_chan = (chunk['FIELD_ID'][:, np.newaxis] * nchan + np.arange(nchan)).ravel()
+
+        flagged += np.bincount(field_chan, weights=chunk['FLAG'].sum(axis=2).ravel(),
+                               minlength=nfield * nchan).reshape(nfield, nchan)
+
+        total += ncorr * np.bincount(chunk['FIELD_ID'], minlength=nfield)[:, np.newaxis]
+
+    return flag_counts
+
+
+def make_flagsummary_uvdist_data(myvis, nbin=25, output_folder="perfield_flagfraction",
+                                 intent='*', overwrite=False, single_pass=True):
+    '''
+    Make a binned flagging fraction vs. uv-distance.
+
+    With `single_pass=True`, ANTENNA1/2, UVW, FIELD_ID and FLAG are read once
+    for all fields and SPWs (see `baseline_flag_counts`) and the baseline
+    lengths are taken from the rows of each field. Otherwise, `flagdata` is
+    run for every field and SPW and the baseline lengths use all rows in the MS.
+    '''
+
+    from casatasks import flagdata
+
+    mymsmd = get_ms_metadata(myvis)
 
     # Get VLA antenna ID
     antenna_names = mymsmd.antennanames() #returns a list that corresponds to antenna ID
@@ -176,7 +241,35 @@ def make_flagsummary_uvdist_data(myvis, nbin=25, output_folder="perfield_flagfra
     casalog.post(f"Selecting on fields: {fields}")
     print(f"Selecting on fields: {fields}")
 
-    for field in fields:
+    todo_fields = []
+
+    for field_id, field in zip(fieldsnums, fields):
+
+        save_name = f"{output_folder}/field_{field}_flagfrac_uvdist.txt"
+
+        if os.path.exists(save_name) and overwrite:
+            os.system(f"rm {save_name}")
+
+        if not os.path.exists(save_name):
+            todo_fields.append((field_id, field))
+
+    if len(todo_fields) == 0:
+        return
+
+    if single_pass:
+        flag_counts, field_uvdist_modes = baseline_flag_counts(myvis)
+
+        ant1, ant2 = np.divmod(np.arange(len(antenna_names)**2), len(antenna_names))
+
+    else:
+        # The baseline lengths do not depend on the field or SPW loops below.
+        # Stream them once.
+        gantdata = read_baseline_uvdist(myvis)
+
+        # Peak uv-distance for each baseline
+        uvdist_modes = baseline_uvdist_modes(gantdata, len(antenna_names))
+
+    for field_id, field in todo_fields:
 
         casalog.post(f"Creating uvdist flagging fraction for {field}")
         print(f"Creating uvdist flagging fraction for {field}")
@@ -185,131 +278,325 @@ def make_flagsummary_uvdist_data(myvis, nbin=25, output_folder="perfield_flagfra
 
         save_name = f"{output_folder}/field_{field}_flagfrac_uvdist.txt"
 
-        if os.path.exists(save_name) and overwrite:
-            os.system(f"rm {save_name}")
+        for spw in spw_list:
 
-        if not os.path.exists(save_name):
+            if single_pass:
+                if spw not in flag_counts or field_id not in field_uvdist_modes:
+                    casalog.post(f"No data for field {field} in SPW {spw}. Skipping.")
+                    continue
+
+                flagged, total = flag_counts[spw]
 
-            for spw in spw_list:
+                # Only baselines with data, as in the flagdata summary.
+                has_data = total[field_id] > 0
 
+                if not has_data.any():
+                    casalog.post(f"No data for field {field} in SPW {spw}. Skipping.")
+                    continue
+
+                uvdist = field_uvdist_modes[field_id][ant1[has_data], ant2[has_data]]
+                flagged = flagged[field_id][has_data]
+                total = total[field_id][has_data]
+
+            else:
                 flag_dict = flagdata(vis=myvis, mode='summary', basecnt=True, action='calculate',
                                     field=field, spw=str(spw))
 
-                # Make plot of flagging statistics
+                # match flagging data to each baseline
+                uvdist, flagged, total = match_baseline_flags(flag_dict['baseline'],
+                                                              antenna_names, uvdist_modes)
+
+            # 25 is the number of uvdist bins such that there is minimal error in uvdist.
+            binned_stats, barwidth = bin_flag_fraction(uvdist, flagged, total, nbin)
+
+            spw_vals = [spw] * len(binned_stats[0])
+            field_vals = [field] * len(binned_stats[0])
+
+            baseline_flagging_table.append([field_vals, spw_vals, binned_stats[0], binned_stats[1]])
+
+        if len(baseline_flagging_table) == 0:
+            continue
+
+        baseline_flagging_table_hstack = np.hstack(baseline_flagging_table).T
+
+        out_table = np.zeros(baseline_flagging_table_hstack.shape[0],
+                            dtype=[("field", 'U32'),
+                                    ('spw', int),
+                                    ('uvdist', float),
+                                    ('frac', float)])
+
+        out_table['field'] = baseline_flagging_table_hstack[:, 0].astype('U32')
+        out_table['spw'] = baseline_flagging_table_hstack[:, 1].astype(int)
+        out_table['uvdist'] = baseline_flagging_table_hstack[:, 2].astype(float)
+        out_table['frac'] = baseline_flagging_table_hstack[:, 3].astype(float)
+
+        np.savetxt(save_name, out_table, fmt='%s %d %f %f', header="field,spw,uvdist,frac")
+
+
+def baseline_flag_counts(myvis, memory_budget=DEFAULT_MEMORY_BUDGET):
+    '''
+    Flagged and total counts per field, SPW and baseline, and the baseline
+    lengths of each field, from one pass over the MS.
+
+    The counts match the 'baseline' output of `flagdata(mode='summary', basecnt=True)`
+    for each field and SPW. The baseline lengths (see `baseline_uvdist_modes`)
+    of each field are computed from the rows of the first DATA_DESC_ID with
+    data for that field, as UVW is the same for all SPWs.
+
+    Parameters
+    ----------
+    myvis : str
+        MS name.
+    memory_budget : int, optional
+        Approximate maximum number of bytes read at once.
+
+    Returns
+    -------
+    flag_counts : dict
+        For each SPW, the (flagged, total) counts with shape (nfield, nant * nant),
+        where the baseline index is antenna1 * nant + antenna2.
+    field_uvdist_modes : dict
+        For each field ID with data, the baseline lengths with shape (nant, nant).
+    '''
+
+    mymsmd = get_ms_metadata(myvis)
+
+    nfield = len(mymsmd.fieldnames())
+    nant = len(mymsmd.antennanames())
+    nbl = nant * nant
+
+    ddid_spw = mymsmd.meta['ddid_spw']
+
+    flag_counts = {}
 
-                # Get information for flagging percentage vs. uvdistance
-                myms.selectinit()
-                myms.selectchannel(1, 0, 1, 1) # look at data just for first channel - easily translates
-                gantdata = myms.getdata(['antenna1','antenna2','uvdist']) # get the points I need
+    # DATA_DESC_ID used for the baseline lengths of each field, and the rows kept.
+    uv_ddid = np.full(nfield, -1, dtype=int)
+    uv_rows = {'field': [], 'antenna1': [], 'antenna2': [], 'uvdist': []}
 
-                # create adictionary with flagging info
-                base_dict = create_baseline_dict(antenna_names, gantdata)
+    columns = ['FIELD_ID', 'ANTENNA1', 'ANTENNA2', 'UVW', 'FLAG']
 
-                # match flagging data to dictionary entry
-                datamatch = flag_match_baseline(flag_dict['baseline'], base_dict)
+    for ddid, rows, chunk in iter_ms_chunks(myvis, columns, memory_budget=memory_budget):
 
-                # 25 is the number of uvdist bins such that there is minimal error in uvdist.
-                binned_stats, barwidth = bin_statistics(datamatch, nbin)
+        spw = ddid_spw[ddid]
 
-                spw_vals = [spw] * len(binned_stats[0])
-                field_vals = [field] * len(binned_stats[0])
+        # Shape is (nrow, nchan, ncorr)
+        nrow, nchan, ncorr = chunk['FLAG'].shape
 
-                baseline_flagging_table.append([field_vals, spw_vals, binned_stats[0], binned_stats[1]])
+        if spw not in flag_counts:
+            flag_counts[spw] = (np.zeros((nfield, nbl)), np.zeros((nfield, nbl)))
 
-            baseline_flagging_table_hstack = np.hstack(baseline_flagging_table).T
+        flagged, total = flag_counts[spw]
 
-            out_table = np.zeros(baseline_flagging_table_hstack.shape[0],
-                                dtype=[("field", 'U32'),
-                                        ('spw', int),
-                                        ('uvdist', float),
-                                        ('frac', float)])
+        field_bl = (chunk['FIELD_ID'] * nbl + chunk['ANTENNA1'] * nant + chunk['ANTENNA2'])
 
-            out_table['field'] = baseline_flagging_table_hstack[:, 0].astype('U32')
-            out_table['spw'] = baseline_flagging_table_hstack[:, 1].astype(int)
-            out_table['uvdist'] = baseline_flagging_table_hstack[:, 2].astype(float)
-            out_table['frac'] = baseline_flagging_table_hstack[:, 3].astype(float)
+        flagged += np.bincount(field_bl, weights=chunk['FLAG'].sum(axis=(1, 2)),
+                               minlength=nfield * nbl).reshape(nfield, nbl)
+        total += nchan * ncorr * np.bincount(field_bl, minlength=nfield * nbl).reshape(nfield, nbl)
 
-            np.savetxt(save_name, out_table, fmt='%s %d %f %f', header="field,spw,uvdist,frac")
+        # Keep the baseline lengths once per field: only from the first DATA_DESC_ID
+        # with rows for that field.
+        new_fields = np.unique(chunk['FIELD_ID'])
+        new_fields = new_fields[uv_ddid[new_fields] < 0]
+        uv_ddid[new_fields] = ddid
 
+        keep = uv_ddid[chunk['FIELD_ID']] == ddid
 
-    mymsmd.close()
-    myms.close()
+        uv_rows['field'].append(chunk['FIELD_ID'][keep])
+        uv_rows['antenna1'].append(chunk['ANTENNA1'][keep])
+        uv_rows['antenna2'].append(chunk['ANTENNA2'][keep])
+        uv_rows['uvdist'].append(np.hypot(chunk['UVW'][keep, 0], chunk['UVW'][keep, 1]))
 
+    uv_rows = dict([(key, np.concatenate(uv_rows[key])) for key in uv_rows])
+
+    field_uvdist_modes = {}
+
+    for field_id in np.flatnonzero(uv_ddid >= 0):
+        this_field = uv_rows['field'] == field_id
+
+        field_uvdist_modes[int(field_id)] = \
+            baseline_uvdist_modes({'antenna1': uv_rows['antenna1'][this_field],
+                                   'antenna2': uv_rows['antenna2'][this_field],
+                                   'uvdist': uv_rows['uvdist'][this_field]},
+                                  nant)
+
+    return flag_counts, field_uvdist_modes
+
+
+def read_baseline_uvdist(myvis):
+    '''
+    Stream the antenna pairs and uv-distance of every row in the MS.
+
+    Returns
+    -------
+    antdata : dict
+        'antenna1', 'antenna2' and 'uvdist' arrays as from `ms.getdata`.
+    '''
+
+    antdata = {'antenna1': [], 'antenna2': [], 'uvdist': []}
+
+    for ddid, rows, chunk in iter_ms_chunks(myvis, ['ANTENNA1', 'ANTENNA2', 'UVW']):
+        antdata['antenna1'].append(chunk['ANTENNA1'])
+        antdata['antenna2'].append(chunk['ANTENNA2'])
+        antdata['uvdist'].append(np.hypot(chunk['UVW'][:, 0], chunk['UVW'][:, 1]))
+
+    return dict([(key, np.concatenate(antdata[key])) for key in antdata])
 
 
 ##########################
-# Code adapted from CHILES
-
-def create_baseline_dict(antenna_names, antdata):
-    '''create a dictionary to hold all UVdists for antenna pairs and correlate them to station IDs'''
-
-    ##Create dictionary
-    baseline_pairs = {}
-    i = 0
-    while i <= antdata['antenna1'].max(): #create a dictionary antenna for each antenna pair
-        j = i + 1
-        while j <= antdata['antenna2'].max():
-            temp_dict_key = str(antenna_names[i]) + '&&' + str(antenna_names[j])
-            baseline_pairs[temp_dict_key] = []
-            j += 1
-        i += 1
-    #add distances to dictionary
-    i = 0
-    while i < len(antdata['antenna1']):
-        temp_dict_key = str(antenna_names[antdata['antenna1'][i]]) + '&&' + str(antenna_names[antdata['antenna2'][i]])
-        baseline_pairs[temp_dict_key].append(antdata['uvdist'][i])
-        i += 1
-
-    return baseline_pairs
-
-def flag_match_baseline(flgdata, baselines):
-    '''match the CASA flagging data to the baseline dictionaries and return flagging statitistics'''
-
-    flagging_data = [[],[]] #list to fill data with
-    i = 0
-    dictkeys = list(flgdata.keys())
-    while i < len(dictkeys):
-        flagging_data[0].append(uvdist_max(baselines[dictkeys[i]])[0])
-        flagging_data[1].append([flgdata[dictkeys[i]]['flagged'],flgdata[dictkeys[i]]['total']])
-        i += 1
-
-    return flagging_data
-
-
-def uvdist_max(flg_data):
-    '''find the max of the uvdist distribution'''
-
-    yvals, edges = np.histogram(flg_data, bins = 20) #get some statistics on the histograms
-    max_index = yvals.argmax() #index of maximum value
-    uvdist_max = (edges[max_index] + edges[max_index+1])/2.
-    return [uvdist_max, np.std(flg_data)]
-
-
-def bin_statistics(dpoints, nbins):
-    '''bin the data based on a desired width'''
-
-    binned = [[],[]]
-    i = 0
-    width = int(1.05 * max(dpoints[0]) / nbins)
-
-    flg_tracker, tot_tracker = 0, 0
-    while i < nbins: #loop through number of bins
-        j = 0
-        temp_flg, temp_total = 0., 0. #to be filled with flagging stats
-        while j < len(dpoints[0]): #loop through data points
-            if dpoints[0][j] >= (i*width) and dpoints[0][j] <= ((i+1)*width):
-                temp_flg += dpoints[1][j][0]
-                temp_total += dpoints[1][j][1]
-                flg_tracker += dpoints[1][j][0]
-                tot_tracker += dpoints[1][j][1]
-            j += 1
-        binned[0].append(i*width)
-        if temp_total == 0:
-            binned[1].append(0)
-        else:
-            binned[1].append(temp_flg/temp_total)
-        i += 1
+# Vectorized versions of the uvdist binning adapted from CHILES.
+# The outputs match the original loops (see benchmarks/bench_uvdist_flag_binning.py).
+
+def baseline_uvdist_modes(antdata, nant, nbins=20):
+    '''
+    Peak of the uv-distance histogram of each antenna pair.
+
+    This matches `np.histogram(uvdists, bins=nbins)` per baseline, with the
+    peak taken as the centre of the (first) highest bin. Pairs without any
+    rows give the peak of an empty histogram (0.025 for 20 bins), as
+    `np.histogram` uses a range of (0, 1).
+
+    Parameters
+    ----------
+    antdata : dict
+        'antenna1', 'antenna2' and 'uvdist' arrays (e.g. from `read_baseline_uvdist`).
+    nant : int
+        Number of antennas.
+    nbins : int, optional
+        Number of histogram bins per baseline.
+
+    Returns
+    -------
+    modes : np.ndarray
+        Peak uv-distance with shape (nant, nant), indexed by (antenna1, antenna2).
+    '''
+
+    uvdist = np.asarray(antdata['uvdist'], dtype=float)
+
+    bl_idx = np.asarray(antdata['antenna1']) * nant + np.asarray(antdata['antenna2'])
+
+    nbl = nant * nant
+
+    # Range of each baseline. Empty baselines use (0, 1) like np.histogram.
+    first_edge = np.zeros(nbl)
+    last_edge = np.ones(nbl)
+
+    has_rows = np.bincount(bl_idx, minlength=nbl) > 0
+
+    first_edge[has_rows] = np.inf
+    last_edge[has_rows] = -np.inf
+    np.minimum.at(first_edge, bl_idx, uvdist)
+    np.maximum.at(last_edge, bl_idx, uvdist)
+
+    same_edge = first_edge == last_edge
+    first_edge[same_edge] -= 0.5
+    last_edge[same_edge] += 0.5
+
+    # Shape (nbl, nbins + 1). Elementwise identical to np.linspace per baseline.
+    bin_edges = np.linspace(first_edge, last_edge, nbins + 1, endpoint=True, axis=1)
+
+    # Same bin assignment as np.histogram for equal bins.
+    row_first = first_edge[bl_idx]
+    f_indices = (uvdist - row_first) / (last_edge[bl_idx] - row_first) * nbins
+    indices = f_indices.astype(np.intp)
+    indices[indices == nbins] -= 1
+
+    decrement = uvdist < bin_edges[bl_idx, indices]
+    indices[decrement] -= 1
+    increment = (uvdist >= bin_edges[bl_idx, indices + 1]) & (indices != nbins - 1)
+    indices[increment] += 1
+
+    counts = np.bincount(bl_idx * nbins + indices,
+                         minlength=nbl * nbins).reshape(nbl, nbins)
+
+    max_index = counts.argmax(axis=1)
+
+    modes = (bin_edges[np.arange(nbl), max_index] + bin_edges[np.arange(nbl), max_index + 1]) / 2.
+
+    return modes.reshape(nant, nant)
+
+
+def match_baseline_flags(flgdata, antenna_names, uvdist_modes):
+    '''
+    Match the flagdata baseline counts to the uv-distance of each baseline.
+
+    Parameters
+    ----------
+    flgdata : dict
+        The 'baseline' output of `flagdata(mode='summary', basecnt=True)`,
+        with keys of 'ant1name&&ant2name'.
+    antenna_names : list
+        Antenna names in ID order.
+    uvdist_modes : np.ndarray
+        Output of `baseline_uvdist_modes`.
+
+    Returns
+    -------
+    uvdist : np.ndarray
+        uv-distance of each baseline.
+    flagged : np.ndarray
+        Flagged counts of each baseline.
+    total : np.ndarray
+        Total counts of each baseline.
+    '''
+
+    ant_ids = dict([(name, ii) for ii, name in enumerate(antenna_names)])
+
+    keys = list(flgdata.keys())
+
+    ant1 = np.array([ant_ids[key.split('&&')[0]] for key in keys], dtype=int)
+    ant2 = np.array([ant_ids[key.split('&&')[1]] for key in keys], dtype=int)
+
+    flagged = np.array([flgdata[key]['flagged'] for key in keys], dtype=float)
+    total = np.array([flgdata[key]['total'] for key in keys], dtype=float)
+
+    return uvdist_modes[ant1, ant2], flagged, total
+
+
+def bin_flag_fraction(uvdist, flagged, total, nbins):
+    '''
+    Flagged fraction in bins of uv-distance.
+
+    Bins have an integer width of `int(1.05 * max(uvdist) / nbins)` and include
+    both edges, so a baseline exactly on an edge counts in both bins.
+
+    Returns
+    -------
+    binned : np.ndarray
+        The lower bin edges and flagged fraction, with shape (2, nbins).
+        Empty bins have a fraction of 0.
+    width : int
+        Bin width.
+    '''
+
+    uvdist = np.asarray(uvdist, dtype=float)
+
+    width = int(1.05 * max(uvdist) / nbins)
+
+    if width == 0:
+        # Every bin is [0, 0].
+        on_edge = uvdist == 0.
+        flg_sum = np.full(nbins, flagged[on_edge].sum())
+        tot_sum = np.full(nbins, total[on_edge].sum())
+
+    else:
+        # Lower bin of each point, corrected for any rounding in the division.
+        lower = np.floor(uvdist / width).astype(int)
+        lower[lower * width > uvdist] -= 1
+        lower[(lower + 1) * width <= uvdist] += 1
+
+        # Points on the lower edge are also in the bin below.
+        on_edge = (lower * width == uvdist) & (lower >= 1)
+
+        bins = np.concatenate([lower, lower[on_edge] - 1])
+        bin_flg = np.concatenate([flagged, flagged[on_edge]])
+        bin_tot = np.concatenate([total, total[on_edge]])
+
+        in_range = (bins >= 0) & (bins < nbins)
+
+        flg_sum = np.bincount(bins[in_range], weights=bin_flg[in_range], minlength=nbins)
+        tot_sum = np.bincount(bins[in_range], weights=bin_tot[in_range], minlength=nbins)
 
-    # total = (flg_tracker / tot_tracker) * 100.
+    frac = np.zeros(nbins)
+    np.divide(flg_sum, tot_sum, out=frac, where=tot_sum != 0)
 
-    return np.array(binned), width
\ No newline at end of file
+    return np.array([np.arange(nbins) * width, frac]), width
@@ -11,11 +11,23 @@ import numpy as np
 
 from casatools import logsink
 
+from lband_pipeline.parallel_tools import run_work_items, check_work_item_errors
+from lband_pipeline.ms_reader import iter_ms_chunks, DEFAULT_MEMORY_BUDGET
+from lband_pipeline.ms_metadata import get_ms_metadata
+from lband_pipeline.product_cache import (ProductManifest, make_cache_key,
+                                          ms_fingerprint)
+
+from .qa_table_engine import (QA_TABLE_PRODUCTS, qa_table_filename,
+                              scan_products, read_ms_setup,
+                              write_scan_qa_tables, compute_scan_tables,
+                              plotms_table_header)
+from .qa_store import QAStore
+
 casalog = logsink()
 
 
 def make_qa_scan_figures(ms_name, output_folder='scan_plots',
-                         outtype='png'):
+                         outtype='png', nworkers=1):
     '''
     Make a series of plots per scan for QA and
     flagging purposes.
@@ -28,74 +40,42 @@ def make_qa_scan_figures(ms_name, output_folder='scan_plots',
         MS name
     output_folder : str, optional
         Output plot folder name.
+    nworkers : int, optional
+        Number of processes used to make the plots. Default is 1.
 
     '''
 
-    from casatools import table
-    from casatools import msmetadata
-
-    tb = table()
-    msmd = msmetadata()
-
-    from casaplotms import plotms
+    # Field names, intents, scans and SPWs from the persistent metadata index.
+    ms_meta = get_ms_metadata(ms_name)
 
     # SPWs to loop through
-    tb.open(os.path.join(ms_name, "SPECTRAL_WINDOW"))
-    spws = range(len(tb.getcol("NAME")))
-    nchans = tb.getcol('NUM_CHAN')
-    tb.close()
+    spws = range(len(ms_meta.meta['spws']))
 
     # Read the field names
-    tb.open(os.path.join(ms_name, "FIELD"))
-    names = tb.getcol('NAME')
-    numFields = tb.nrows()
-    tb.close()
+    names = np.array(ms_meta.fieldnames())
+    numFields = len(names)
 
-    # Intent names
-    tb.open(os.path.join(ms_name, 'STATE'))
-    intentcol = tb.getcol('OBS_MODE')
-    tb.close()
+    # Number of unflagged visibilities per SPW and scan from a single pass over FLAG.
+    # Scans without any data for a SPW count as completely flagged.
+    is_all_flagged = scan_spw_occupancy(ms_name) == 0
 
-    tb.open(ms_name)
-    scanNums = np.unique(tb.getcol('SCAN_NUMBER'))
-    field_scans = []
+    field_scans = [ms_meta.scansforfield(ii) for ii in range(numFields)]
+    scanNums = np.unique(np.concatenate(field_scans))
     is_calibrator = np.empty_like(scanNums, dtype='bool')
-    is_all_flagged = np.empty((len(spws), len(scanNums)), dtype='bool')
     for ii in range(numFields):
-        subtable = tb.query('FIELD_ID==%s' % ii)
-        field_scan = np.unique(subtable.getcol('SCAN_NUMBER'))
-        field_scans.append(field_scan)
-
         # Is the intent for calibration?
-        scan_intents = intentcol[np.unique(subtable.getcol("STATE_ID"))]
-        is_calib = False
-        for intent in scan_intents:
-            if "CALIBRATE" in intent:
-                is_calib = True
-                break
-
-        is_calibrator[field_scan - 1] = is_calib
-
-        # Are any of the scans completely flagged?
-        for spw in spws:
-            for scan in field_scan:
-                scantable = \
-                    tb.query("SCAN_NUMBER=={0} AND DATA_DESC_ID=={1}".format(scan,
-                                                                             spw))
-                if scantable.getcol("FLAG").all():
-                    is_all_flagged[spw, scan - 1] = True
-                else:
-                    is_all_flagged[spw, scan - 1] = False
-
-    tb.close()
+        is_calibrator[field_scans[ii] - 1] = ms_meta.is_calibrator(ii)
 
     # Make folder for scan plots
     if not os.path.exists(output_folder):
         os.mkdir(output_folder)
 
     # Loop through SPWs and create plots.
+    # Each SPW, field and scan is an independent work item.
+    work_items = []
+
     for spw_num in spws:
-        casalog.post("On SPW {}".format(spw))
+        casalog.post("On SPW {}".format(spw_num))
 
         # Plotting the HI spw (0) takes so so long.
         # Make some simplifications to save time
@@ -118,200 +98,268 @@ def make_qa_scan_figures(ms_name, output_folder='scan_plots',
             for jj in field_scans[ii]:
 
                 # Check if all of the data is flagged.
-                if is_all_flagged[spw_num, jj - 1]:
+                if is_all_flagged[spw_num, jj]:
                     casalog.post("All data flagged in SPW {0} scan {1}"
                                  .format(spw_num, jj))
                     continue
 
                 casalog.post("On scan {}".format(jj))
 
-                # Amp vs. time
-                plotms(vis=ms_name,
-                       xaxis='time',
-                       yaxis='amp',
-                       ydatacolumn='corrected',
-                       selectdata=True,
-                       field=names[ii],
-                       scan=str(jj),
-                       spw=str(spw_num),
-                       avgchannel=str(avg_chan),
-                       correlation="",
-                       averagedata=True,
-                       avgbaseline=True,
-                       transform=False,
-                       extendflag=False,
-                       plotrange=[],
-                       title='Amp vs Time: Field {0} Scan {1}'.format(names[ii], jj),
-                       xlabel='Time',
-                       ylabel='Amp',
-                       showmajorgrid=False,
-                       showminorgrid=False,
-                       plotfile=os.path.join(spw_folder,
-                                             'field_{0}_amp_scan_{1}.{2}'.format(names[ii], jj, outtype)),
-                       overwrite=True,
-                       showgui=False)
-
-                # Amp vs. channel
-                plotms(vis=ms_name,
-                       xaxis='chan',
-                       yaxis='amp',
-                       ydatacolumn='corrected',
-                       selectdata=True,
-                       field=names[ii],
-                       scan=str(jj),
-                       spw=str(spw_num),
-                       avgchannel=str(avg_chan),
-                       avgtime="1e8",
-                       correlation="",
-                       averagedata=True,
-                       avgbaseline=True,
-                       transform=False,
-                       extendflag=False,
-                       plotrange=[],
-                       title='Amp vs Chan: Field {0} Scan {1}'.format(names[ii], jj),
-                       xlabel='Channel',
-                       ylabel='Amp',
-                       showmajorgrid=False,
-                       showminorgrid=False,
-                       plotfile=os.path.join(spw_folder,
-                                             'field_{0}_amp_chan_scan_{1}.{2}'.format(names[ii], jj, outtype)),
-                       overwrite=True,
-                       showgui=False)
-
-                # Plot amp vs uvdist
-                plotms(vis=ms_name,
-                       xaxis='uvdist',
-                       yaxis='amp',
-                       ydatacolumn='corrected',
-                       selectdata=True,
-                       field=names[ii],
-                       scan=str(jj),
-                       spw=str(spw_num),
-                       avgchannel=str(4096),
-                       avgtime='1e8',
-                       correlation="",
-                       averagedata=True,
-                       avgbaseline=False,
-                       transform=False,
-                       extendflag=False,
-                       plotrange=[],
-                       title='Amp vs UVDist: Field {0} Scan {1}'.format(names[ii], jj),
-                       xlabel='uv-dist',
-                       ylabel='Amp',
-                       showmajorgrid=False,
-                       showminorgrid=False,
-                       plotfile=os.path.join(spw_folder,
-                                             'field_{0}_amp_uvdist_scan_{1}.{2}'.format(names[ii], jj, outtype)),
-                       overwrite=True,
-                       showgui=False)
-
-                # Skip the phase plots for the HI SPW (0)
-                if is_calibrator[jj - 1]:
-                    # Plot phase vs time
-                    plotms(vis=ms_name,
-                           xaxis='time',
-                           yaxis='phase',
-                           ydatacolumn='corrected',
-                           selectdata=True,
-                           field=names[ii],
-                           scan=str(jj),
-                           spw=str(spw_num),
-                           correlation="",
-                           averagedata=True,
-                           avgbaseline=True,
-                           transform=False,
-                           extendflag=False,
-                           plotrange=[],
-                           title='Phase vs Time: Field {0} Scan {1}'.format(names[ii], jj),
-                           xlabel='Time',
-                           ylabel='Phase',
-                           showmajorgrid=False,
-                           showminorgrid=False,
-                           plotfile=os.path.join(spw_folder,
-                                                 'field_{0}_phase_time_scan_{1}.{2}'.format(names[ii], jj, outtype)),
-                           overwrite=True,
-                           showgui=False)
-
-                    # Plot phase vs channel
-                    plotms(vis=ms_name,
-                           xaxis='chan',
-                           yaxis='phase',
-                           ydatacolumn='corrected',
-                           selectdata=True,
-                           field=names[ii],
-                           scan=str(jj),
-                           spw=str(spw_num),
-                           avgchannel=str(avg_chan),
-                           avgtime="1e8",
-                           correlation="",
-                           averagedata=True,
-                           avgbaseline=True,
-                           transform=False,
-                           extendflag=False,
-                           plotrange=[],
-                           title='Phase vs Chan: Field {0} Scan {1}'.format(names[ii], jj),
-                           xlabel='Chan',
-                           ylabel='Phase',
-                           showmajorgrid=False,
-                           showminorgrid=False,
-                           plotfile=os.path.join(spw_folder,
-                                                 'field_{0}_phase_chan_scan_{1}.{2}'.format(names[ii], jj, outtype)),
-                           overwrite=True,
-                           showgui=False)
-
-                    # Plot phase vs uvdist
-                    plotms(vis=ms_name,
-                           xaxis='uvdist',
-                           yaxis='phase',
-                           ydatacolumn='corrected',
-                           selectdata=True,
-                           field=names[ii],
-                           scan=str(jj),
-                           spw=str(spw_num),
-                           correlation="",
-                           avgchannel="4096",
-                           avgtime='1e8',
-                           averagedata=True,
-                           avgbaseline=False,
-                           transform=False,
-                           extendflag=False,
-                           plotrange=[],
-                           title='Phase vs UVDist: Field {0} Scan {1}'.format(names[ii], jj),
-                           xlabel='uv-dist',
-                           ylabel='Phase',
-                           showmajorgrid=False,
-                           showminorgrid=False,
-                           plotfile=os.path.join(spw_folder,
-                                                 'field_{0}_phase_uvdist_scan_{1}.{2}'.format(names[ii], jj, outtype)),
-                           overwrite=True,
-                           showgui=False)
-
-                    # Plot amp vs phase
-                    plotms(vis=ms_name,
-                           xaxis='amp',
-                           yaxis='phase',
-                           ydatacolumn='corrected',
-                           selectdata=True,
-                           field=names[ii],
-                           scan=str(jj),
-                           spw=str(spw_num),
-                           correlation="",
-                           avgchannel="4096",
-                           # avgtime='1e8',
-                           averagedata=True,
-                           avgbaseline=False,
-                           transform=False,
-                           extendflag=False,
-                           plotrange=[],
-                           title='Amp vs Phase: Field {0} Scan {1}'.format(names[ii], jj),
-                           xlabel='Phase',
-                           ylabel='Amp',
-                           showmajorgrid=False,
-                           showminorgrid=False,
-                           plotfile=os.path.join(spw_folder,
-                                                 'field_{0}_amp_phase_scan_{1}.{2}'.format(names[ii], jj, outtype)),
-                           overwrite=True,
-                           showgui=False)
+                work_items.append(("SPW {0} field {1} scan {2}".format(spw_num, names[ii], jj),
+                                   plotms_scan_figures,
+                                   (ms_name, spw_num, names[ii], jj, is_calibrator[jj - 1], spw_folder),
+                                   {'outtype': outtype,
+                                    'avg_chan': avg_chan}))
+
+    run_work_items(work_items, nworkers=nworkers,
+                   log_prefix=os.path.join(output_folder, "make_qa_scan_figures") if nworkers > 1 else None,
+                   origin='make_qa_scan_figures')
+
+
+def plotms_scan_figures(ms_name, spw_num, fieldname, scan, is_calibrator,
+                        spw_folder, outtype='png', avg_chan="1"):
+    '''
+    Make the QA plots for one SPW, field and scan with plotms.
+    '''
+
+    from casaplotms import plotms
+
+    # Amp vs. time
+    plotms(vis=ms_name,
+           xaxis='time',
+           yaxis='amp',
+           ydatacolumn='corrected',
+           selectdata=True,
+           field=fieldname,
+           scan=str(scan),
+           spw=str(spw_num),
+           avgchannel=str(avg_chan),
+           correlation="",
+           averagedata=True,
+           avgbaseline=True,
+           transform=False,
+           extendflag=False,
+           plotrange=[],
+           title='Amp vs Time: Field {0} Scan {1}'.format(fieldname, scan),
+           xlabel='Time',
+           ylabel='Amp',
+           showmajorgrid=False,
+           showminorgrid=False,
+           plotfile=os.path.join(spw_folder,
+                                 'field_{0}_amp_scan_{1}.{2}'.format(fieldname, scan, outtype)),
+           overwrite=True,
+           showgui=False)
+
+    # Amp vs. channel
+    plotms(vis=ms_name,
+           xaxis='chan',
+           yaxis='amp',
+           ydatacolumn='corrected',
+           selectdata=True,
+           field=fieldname,
+           scan=str(scan),
+           spw=str(spw_num),
+           avgchannel=str(avg_chan),
+           avgtime="1e8",
+           correlation="",
+           averagedata=True,
+           avgbaseline=True,
+           transform=False,
+           extendflag=False,
+           plotrange=[],
+           title='Amp vs Chan: Field {0} Scan {1}'.format(fieldname, scan),
+           xlabel='Channel',
+           ylabel='Amp',
+           showmajorgrid=False,
+           showminorgrid=False,
+           plotfile=os.path.join(spw_folder,
+                                 'field_{0}_amp_chan_scan_{1}.{2}'.format(fieldname, scan, outtype)),
+           overwrite=True,
+           showgui=False)
+
+    # Plot amp vs uvdist
+    plotms(vis=ms_name,
+           xaxis='uvdist',
+           yaxis='amp',
+           ydatacolumn='corrected',
+           selectdata=True,
+           field=fieldname,
+           scan=str(scan),
+           spw=str(spw_num),
+           avgchannel=str(4096),
+           avgtime='1e8',
+           correlation="",
+           averagedata=True,
+           avgbaseline=False,
+           transform=False,
+           extendflag=False,
+           plotrange=[],
+           title='Amp vs UVDist: Field {0} Scan {1}'.format(fieldname, scan),
+           xlabel='uv-dist',
+           ylabel='Amp',
+           showmajorgrid=False,
+           showminorgrid=False,
+           plotfile=os.path.join(spw_folder,
+                                 'field_{0}_amp_uvdist_scan_{1}.{2}'.format(fieldname, scan, outtype)),
+           overwrite=True,
+           showgui=False)
+
+    # Skip the phase plots for the HI SPW (0)
+    if is_calibrator:
+        # Plot phase vs time
+        plotms(vis=ms_name,
+               xaxis='time',
+               yaxis='phase',
+               ydatacolumn='corrected',
+               selectdata=True,
+               field=fieldname,
+               scan=str(scan),
+               spw=str(spw_num),
+               correlation="",
+               averagedata=True,
+               avgbaseline=True,
+               transform=False,
+               extendflag=False,
+               plotrange=[],
+               title='Phase vs Time: Field {0} Scan {1}'.format(fieldname, scan),
+               xlabel='Time',
+               ylabel='Phase',
+               showmajorgrid=False,
+               showminorgrid=False,
+               plotfile=os.path.join(spw_folder,
+                                     'field_{0}_phase_time_scan_{1}.{2}'.format(fieldname, scan, outtype)),
+               overwrite=True,
+               showgui=False)
+
+        # Plot phase vs channel
+        plotms(vis=ms_name,
+               xaxis='chan',
+               yaxis='phase',
+               ydatacolumn='corrected',
+               selectdata=True,
+               field=fieldname,
+               scan=str(scan),
+               spw=str(spw_num),
+               avgchannel=str(avg_chan),
+               avgtime="1e8",
+               correlation="",
+               averagedata=True,
+               avgbaseline=True,
+               transform=False,
+               extendflag=False,
+               plotrange=[],
+               title='Phase vs Chan: Field {0} Scan {1}'.format(fieldname, scan),
+               xlabel='Chan',
+               ylabel='Phase',
+               showmajorgrid=False,
+               showminorgrid=False,
+               plotfile=os.path.join(spw_folder,
+                                     'field_{0}_phase_chan_scan_{1}.{2}'.format(fieldname, scan, outtype)),
+               overwrite=True,
+               showgui=False)
+
+        # Plot phase vs uvdist
+        plotms(vis=ms_name,
+               xaxis='uvdist',
+               yaxis='phase',
+               ydatacolumn='corrected',
+               selectdata=True,
+               field=fieldname,
+               scan=str(scan),
+               spw=str(spw_num),
+               correlation="",
+               avgchannel="4096",
+               avgtime='1e8',
+               averagedata=True,
+               avgbaseline=False,
+               transform=False,
+               extendflag=False,
+               plotrange=[],
+               title='Phase vs UVDist: Field {0} Scan {1}'.format(fieldname, scan),
+               xlabel='uv-dist',
+               ylabel='Phase',
+               showmajorgrid=False,
+               showminorgrid=False,
+               plotfile=os.path.join(spw_folder,
+                                     'field_{0}_phase_uvdist_scan_{1}.{2}'.format(fieldname, scan, outtype)),
+               overwrite=True,
+               showgui=False)
+
+        # Plot amp vs phase
+        plotms(vis=ms_name,
+               xaxis='amp',
+               yaxis='phase',
+               ydatacolumn='corrected',
+               selectdata=True,
+               field=fieldname,
+               scan=str(scan),
+               spw=str(spw_num),
+               correlation="",
+               avgchannel="4096",
+               # avgtime='1e8',
+               averagedata=True,
+               avgbaseline=False,
+               transform=False,
+               extendflag=False,
+               plotrange=[],
+               title='Amp vs Phase: Field {0} Scan {1}'.format(fieldname, scan),
+               xlabel='Phase',
+               ylabel='Amp',
+               showmajorgrid=False,
+               showminorgrid=False,
+               plotfile=os.path.join(spw_folder,
+                                     'field_{0}_amp_phase_scan_{1}.{2}'.format(fieldname, scan, outtype)),
+               overwrite=True,
+               showgui=False)
+
+
+def scan_spw_occupancy(ms_name, memory_budget=DEFAULT_MEMORY_BUDGET):
+    '''
+    Count the unflagged visibilities for every DATA_DESC_ID and scan.
+
+    FLAG is streamed once, in row chunks, for each DATA_DESC_ID (see
+    `lband_pipeline.ms_reader`). The per-row counts are summed per scan
+    with `np.bincount`.
+
+    Parameters
+    ----------
+    ms_name : str
+        MS name.
+    memory_budget : int, optional
+        Approximate maximum number of bytes read at once.
+
+    Returns
+    -------
+    occupancy : `~numpy.ndarray`
+        Unflagged counts with shape (ndatadesc, max scan number + 1), indexed
+        by the DATA_DESC_ID and the scan number.
+    '''
+
+    from casatools import table
+
+    tb = table()
+
+    tb.open(os.path.join(ms_name, "DATA_DESCRIPTION"))
+    ndatadesc = tb.nrows()
+    tb.close()
+
+    occupancy = np.zeros((ndatadesc, 1), dtype=int)
+
+    for ddid, rows, chunk in iter_ms_chunks(ms_name, ['SCAN_NUMBER', 'FLAG'],
+                                            memory_budget=memory_budget):
+
+        # Shape is (nrow, nchan, ncorr)
+        unflagged = (~chunk['FLAG']).sum(axis=(1, 2))
+
+        counts = np.bincount(chunk['SCAN_NUMBER'], weights=unflagged).astype(int)
+
+        # Extend to the highest scan number seen so far.
+        if counts.size > occupancy.shape[1]:
+            occupancy = np.pad(occupancy, ((0, 0), (0, counts.size - occupancy.shape[1])))
+
+        occupancy[ddid, :counts.size] += counts
+
+    return occupancy
 
 
 def remove_minsize(filename, min_size=50):
@@ -327,22 +375,30 @@ def remove_minsize(filename, min_size=50):
 
 def make_qa_tables(ms_name, output_folder='scan_plots_txt',
                    outtype='txt', overwrite=True,
-                   chanavg=4096,):
+                   chanavg=4096, use_plotms=False, nworkers=1,
+                   use_cache=True, store_filename=None):
 
     '''
     Specifically for saving txt tables. Replace the scan loop in
     `make_qa_scan_figures` to make fewer but larger tables.
 
-    '''
+    By default, each scan is read once and all of the tables are computed
+    together (see `qa_table_engine`). Set `use_plotms=True` to export each
+    table with a separate plotms call instead.
 
+    Set `nworkers > 1` to export the fields and scans over a process pool.
 
-    from casatools import table
-    from casatools import msmetadata
+    With `use_cache=True`, the tables of each scan are recorded in a manifest
+    (see `lband_pipeline.product_cache`) keyed on the MS flags/data and the
+    export settings. When `overwrite=False`, only scans whose inputs changed
+    since the last run are remade.
 
-    tb = table()
-    msmd = msmetadata()
+    With `store_filename`, the tables are saved in one compressed columnar
+    file per track (see `qa_store.QAStore`) instead of a text file per
+    table. The cache keys are then kept in the store itself. Use
+    `QAStore.export_txt` to re-create the text files for QAPlotter.
 
-    from casaplotms import plotms
+    '''
 
     casalog.post("Running make_qa_tables to export txt files for QA.")
     print("Running make_qa_tables to export txt files for QA.")
@@ -359,49 +415,37 @@ def make_qa_tables(ms_name, output_folder='scan_plots_txt',
             casalog.post("{} already exists. Will skip existing files.".format(output_folder))
             # raise ValueError("{} already exists. Enable overwrite=True to rerun.".format(output_folder))
 
-    # Read the field names
-    tb.open(os.path.join(ms_name, "FIELD"))
-    names = tb.getcol('NAME')
-    numFields = tb.nrows()
-    tb.close()
-
-    # Intent names
-    tb.open(os.path.join(ms_name, 'STATE'))
-    intentcol = tb.getcol('OBS_MODE')
-    tb.close()
-
-    # Determine the fields that are calibrators.
-    tb.open(ms_name)
-    is_calibrator = np.empty((numFields,), dtype='bool')
+    if store_filename is not None:
+        if not overwrite and os.path.exists(store_filename):
+            store = QAStore.load(store_filename)
+        else:
+            store = QAStore()
 
-    has_data = np.ones((numFields,), dtype='bool')
+    if use_cache:
+        if store_filename is None:
+            manifest = ProductManifest.for_folder(output_folder)
 
-    for ii in range(numFields):
-        subtable = tb.query('FIELD_ID==%s' % ii)
+            if overwrite:
+                manifest.clear()
 
-        # Is there any data for this field?
-        has_data[ii] = subtable.nrows() > 0
+        ms_key = ms_fingerprint(ms_name)
 
-        # Is the intent for calibration?
-        scan_intents = intentcol[np.unique(subtable.getcol("STATE_ID"))]
-        is_calib = False
-        for intent in scan_intents:
-            if "CALIBRATE" in intent:
-                is_calib = True
-                break
+    # Field names, intents and scans from the persistent metadata index.
+    ms_meta = get_ms_metadata(ms_name)
 
-        is_calibrator[ii] = is_calib
+    names = np.array(ms_meta.fieldnames())
+    numFields = len(names)
 
-    tb.close()
+    # Determine the fields that are calibrators and have any data.
+    is_calibrator = np.array([ms_meta.is_calibrator(ii) for ii in range(numFields)], dtype='bool')
+    has_data = np.array([ms_meta.has_data(ii) for ii in range(numFields)], dtype='bool')
 
     # Loop through scans
     scanlist_dict = {}
 
     # Loop through fields
-    msmd.open(ms_name)
     for ii in range(numFields):
-        scanlist_dict[names[ii]] = msmd.scansforfield(names[ii])
-    msmd.close()
+        scanlist_dict[names[ii]] = ms_meta.scansforfield(ii)
 
     casalog.post(message="Fields are: {}".format(names), origin='make_qa_tables')
     casalog.post(message="Calibrator fields are: {}".format(names[is_calibrator]), origin='make_qa_tables')
@@ -409,7 +453,14 @@ def make_qa_tables(ms_name, output_folder='scan_plots_txt',
     print("Fields are: {}".format(names))
     print("Calibrator fields are: {}".format(names[is_calibrator]))
 
+    # The antenna, SPW and correlation info is shared by all scans.
+    if not use_plotms:
+        ms_setup = read_ms_setup(ms_name)
+
     # Loop through fields. Make separate tables only for different targets.
+    # Each field and scan is an independent work item.
+    work_items = []
+    work_item_products = []
 
     for ii in range(numFields):
         casalog.post(message="On field {}".format(names[ii]), origin='make_qa_plots')
@@ -421,410 +472,192 @@ def make_qa_tables(ms_name, output_folder='scan_plots_txt',
                          origin='make_qa_plots')
             continue
 
+        if is_calibrator[ii]:
+            casalog.post("This is a calibrator. Exporting phase info, too.")
+            print("This is a calibrator. Exporting phase info, too.")
+
         # Loop through scans
         for this_scan in scanlist_dict[names[ii]]:
 
-            casalog.post(message="On scan {}".format(this_scan), origin='make_qa_plots')
-            print("On scan {}".format(this_scan))
-
-
-            # Amp vs. time
-            amptime_filename = os.path.join(output_folder,
-                                            'field_{0}_amp_time.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-            # Remove existing file if it exists and is very small
-            # indicating a plotms failure
-            remove_minsize(amptime_filename, min_size=50)
-
-            if not os.path.exists(amptime_filename):
-
-                plotms(vis=ms_name,
-                    xaxis='time',
-                    yaxis='amp',
-                    ydatacolumn='corrected',
-                    selectdata=True,
-                    field=names[ii],
-                    scan=f"{this_scan}",
-                    spw="",
-                    avgchannel=str(chanavg),
-                    avgtime='',
-                    correlation="",
-                    averagedata=True,
-                    avgbaseline=True,
-                    transform=False,
-                    extendflag=False,
-                    plotrange=[],
-                    # title='Amp vs Time: Field {0} Scan {1}'.format(names[ii], jj),
-                    xlabel='Time',
-                    ylabel='Amp',
-                    showmajorgrid=False,
-                    showminorgrid=False,
-                    plotfile=amptime_filename,
-                    overwrite=True,
-                    showgui=False)
-            else:
-                casalog.post(message="File {} already exists. Skipping".format(amptime_filename),
-                            origin='make_qa_tables')
-
-            # Amp vs. channel
-            ampchan_filename = os.path.join(output_folder,
-                                        'field_{0}_amp_chan.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-            # Remove existing file if it exists and is very small
-            # indicating a plotms failure
-            remove_minsize(ampchan_filename, min_size=50)
-
-            if not os.path.exists(ampchan_filename):
-
-                plotms(vis=ms_name,
-                    xaxis='chan',
-                    yaxis='amp',
-                    ydatacolumn='corrected',
-                    selectdata=True,
-                    field=names[ii],
-                    scan=f"{this_scan}",
-                    spw="",
-                    avgchannel="1",
-                    avgtime="1e8",
-                    correlation="",
-                    averagedata=True,
-                    avgbaseline=True,
-                    transform=False,
-                    extendflag=False,
-                    plotrange=[],
-                    # title='Amp vs Chan: Field {0} Scan {1}'.format(names[ii], jj),
-                    xlabel='Channel',
-                    ylabel='Amp',
-                    showmajorgrid=False,
-                    showminorgrid=False,
-                    plotfile=ampchan_filename,
-                    overwrite=True,
-                    showgui=False)
-            else:
-                casalog.post(message="File {0} already exists. Skipping".format(ampchan_filename),
-                            origin='make_qa_tables')
-
-            # Plot amp vs uvdist
-            ampuvdist_filename = os.path.join(output_folder,
-                                        'field_{0}_amp_uvdist.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-            # Remove existing file if it exists and is very small
-            # indicating a plotms failure
-            remove_minsize(ampuvdist_filename, min_size=50)
-
-            if not os.path.exists(ampuvdist_filename):
-
-                plotms(vis=ms_name,
-                    xaxis='uvdist',
-                    yaxis='amp',
-                    ydatacolumn='corrected',
-                    selectdata=True,
-                    field=names[ii],
-                    scan=f"{this_scan}",
-                    spw="",
-                    avgchannel=str(chanavg),
-                    avgtime='1e8',
-                    correlation="",
-                    averagedata=True,
-                    avgbaseline=False,
-                    transform=False,
-                    extendflag=False,
-                    plotrange=[],
-                    # title='Amp vs UVDist: Field {0} Scan {1}'.format(names[ii], jj),
-                    xlabel='uv-dist',
-                    ylabel='Amp',
-                    showmajorgrid=False,
-                    showminorgrid=False,
-                    plotfile=ampuvdist_filename,
-                    overwrite=True,
-                    showgui=False)
+            label = "field {0} scan {1}".format(names[ii], this_scan)
+
+            scan_filenames = [qa_table_filename(output_folder, names[ii], product, this_scan,
+                                                outtype=outtype)
+                              for product in scan_products(is_calibrator[ii])]
+
+            scan_key = None
+
+            if use_cache:
+                scan_key = make_cache_key(ms=ms_key, field=names[ii], scan=int(this_scan),
+                                          chanavg=chanavg, use_plotms=use_plotms)
+
+            if store_filename is not None:
+                if use_cache and store.keys.get(label) == scan_key:
+                    casalog.post(message="Tables for {} are up to date. Skipping".format(label),
+                                 origin='make_qa_tables')
+                    continue
+
+                store.remove([os.path.basename(this_filename) for this_filename in scan_filenames])
+                store.keys.pop(label, None)
+
+            elif use_cache:
+                # Remove outputs made from different inputs (e.g., before re-flagging)
+                if len(manifest.remove_stale(scan_filenames, scan_key)) == 0:
+                    casalog.post(message="Tables for {} are up to date. Skipping".format(label),
+                                 origin='make_qa_tables')
+                    continue
+
+            work_item_products.append((label, names[ii], this_scan, is_calibrator[ii],
+                                       scan_filenames, scan_key))
+
+            if use_plotms:
+                work_items.append((label, plotms_scan_tables,
+                                   (ms_name, names[ii], this_scan, is_calibrator[ii]),
+                                   {'output_folder': output_folder,
+                                    'outtype': outtype,
+                                    'chanavg': chanavg}))
+            elif store_filename is not None:
+                work_items.append((label, compute_scan_tables,
+                                   (ms_name, ii, this_scan, scan_products(is_calibrator[ii])),
+                                   {'ms_setup': ms_setup,
+                                    'chanavg': chanavg}))
             else:
-                casalog.post(message="File {} already exists. Skipping".format(ampuvdist_filename),
-                            origin='make_qa_tables')
-
-            # Make phase plots if a calibrator source.
-
-            if is_calibrator[ii]:
-
-                casalog.post("This is a calibrator. Exporting phase info, too.")
-                print("This is a calibrator. Exporting phase info, too.")
-
-                # Plot phase vs time
-
-                phasetime_filename = os.path.join(output_folder,
-                                            'field_{0}_phase_time.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-                # Remove existing file if it exists and is very small
-                # indicating a plotms failure
-                remove_minsize(phasetime_filename, min_size=50)
-
-                if not os.path.exists(phasetime_filename):
-
-                    plotms(vis=ms_name,
-                        xaxis='time',
-                        yaxis='phase',
-                        ydatacolumn='corrected',
-                        selectdata=True,
-                        field=names[ii],
-                        scan=f"{this_scan}",
-                        spw="",
-                        correlation="",
-                        avgchannel=str(chanavg),
-                        avgtime='',
-                        averagedata=True,
-                        avgbaseline=True,
-                        transform=False,
-                        extendflag=False,
-                        plotrange=[],
-                        # title='Phase vs Time: Field {0} Scan {1}'.format(names[ii], jj),
-                        xlabel='Time',
-                        ylabel='Phase',
-                        showmajorgrid=False,
-                        showminorgrid=False,
-                        plotfile=phasetime_filename,
-                        overwrite=True,
-                        showgui=False)
-                else:
-                    casalog.post(message="File {} already exists. Skipping".format(phasetime_filename),
-                                origin='make_qa_tables')
-
-                # Plot phase vs channel
-                phasechan_filename = os.path.join(output_folder,
-                                            'field_{0}_phase_chan.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-                # Remove existing file if it exists and is very small
-                # indicating a plotms failure
-                remove_minsize(phasechan_filename, min_size=50)
-
-                if not os.path.exists(phasechan_filename):
-
-                    plotms(vis=ms_name,
-                        xaxis='chan',
-                        yaxis='phase',
-                        ydatacolumn='corrected',
-                        selectdata=True,
-                        field=names[ii],
-                        scan=f"{this_scan}",
-                        spw="",
-                        avgchannel="1",
-                        avgtime="1e8",
-                        correlation="",
-                        averagedata=True,
-                        avgbaseline=True,
-                        transform=False,
-                        extendflag=False,
-                        plotrange=[],
-                        # title='Phase vs Chan: Field {0} Scan {1}'.format(names[ii], jj),
-                        xlabel='Chan',
-                        ylabel='Phase',
-                        showmajorgrid=False,
-                        showminorgrid=False,
-                        plotfile=phasechan_filename,
-                        overwrite=True,
-                        showgui=False)
-                else:
-                    casalog.post(message="File {} already exists. Skipping".format(phasechan_filename),
-                                origin='make_qa_tables')
-
-                # Plot phase vs uvdist
-                phaseuvdist_filename = os.path.join(output_folder,
-                                            'field_{0}_phase_uvdist.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-                # Remove existing file if it exists and is very small
-                # indicating a plotms failure
-                remove_minsize(phaseuvdist_filename, min_size=50)
-
-                if not os.path.exists(phaseuvdist_filename):
-
-
-                    plotms(vis=ms_name,
-                        xaxis='uvdist',
-                        yaxis='phase',
-                        ydatacolumn='corrected',
-                        selectdata=True,
-                        field=names[ii],
-                        scan=f"{this_scan}",
-                        spw="",
-                        correlation="",
-                        avgchannel=str(chanavg),
-                        avgtime='1e8',
-                        averagedata=True,
-                        avgbaseline=False,
-                        transform=False,
-                        extendflag=False,
-                        plotrange=[],
-                        # title='Phase vs UVDist: Field {0} Scan {1}'.format(names[ii], jj),
-                        xlabel='uv-dist',
-                        ylabel='Phase',
-                        showmajorgrid=False,
-                        showminorgrid=False,
-                        plotfile=phaseuvdist_filename,
-                        overwrite=True,
-                        showgui=False)
+                work_items.append((label, write_scan_qa_tables,
+                                   (ms_name, ii, names[ii], this_scan, is_calibrator[ii]),
+                                   {'output_folder': output_folder,
+                                    'outtype': outtype,
+                                    'chanavg': chanavg,
+                                    'ms_setup': ms_setup,
+                                    'skip_existing': True}))
 
-                else:
-                    casalog.post(message="File {} already exists. Skipping".format(phaseuvdist_filename),
-                                origin='make_qa_tables')
-
-                # Plot amp vs phase
-                ampphase_filename = os.path.join(output_folder,
-                                            'field_{0}_amp_phase.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-                # Remove existing file if it exists and is very small
-                # indicating a plotms failure
-                remove_minsize(ampphase_filename, min_size=50)
-
-                if not os.path.exists(ampphase_filename):
-
-                    plotms(vis=ms_name,
-                        xaxis='amp',
-                        yaxis='phase',
-                        ydatacolumn='corrected',
-                        selectdata=True,
-                        field=names[ii],
-                        scan=f"{this_scan}",
-                        spw="",
-                        correlation="",
-                        avgchannel=str(chanavg),
-                        avgtime='1e8',
-                        averagedata=True,
-                        avgbaseline=False,
-                        transform=False,
-                        extendflag=False,
-                        plotrange=[],
-                        # title='Amp vs Phase: Field {0} Scan {1}'.format(names[ii], jj),
-                        xlabel='Phase',
-                        ylabel='Amp',
-                        showmajorgrid=False,
-                        showminorgrid=False,
-                        plotfile=ampphase_filename,
-                        overwrite=True,
-                        showgui=False)
-                else:
-                    casalog.post(message="File {} already exists. Skipping".format(ampphase_filename),
-                                origin='make_qa_tables')
-
-                # Plot uv-wave vs, amp - model residual
-                # Check how good the point-source calibrator model is.
-
-                ampresid_filename = os.path.join(output_folder,
-                                            'field_{0}_ampresid_uvwave.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-                # Remove existing file if it exists and is very small
-                # indicating a plotms failure
-                remove_minsize(ampresid_filename, min_size=50)
-
-                if not os.path.exists(ampresid_filename):
-
-                    plotms(vis=ms_name,
-                        xaxis='uvwave',
-                        yaxis='amp',
-                        ydatacolumn='corrected-model_scalar',
-                        selectdata=True,
-                        field=names[ii],
-                        scan=f"{this_scan}",
-                        spw="",
-                        correlation="",
-                        avgchannel=str(chanavg),
-                        avgtime='1e8',
-                        averagedata=True,
-                        avgbaseline=False,
-                        transform=False,
-                        extendflag=False,
-                        plotrange=[],
-                        xlabel='uv-dist',
-                        ylabel='Phase',
-                        showmajorgrid=False,
-                        showminorgrid=False,
-                        plotfile=ampresid_filename,
-                        overwrite=True,
-                        showgui=False)
+    results = run_work_items(work_items, nworkers=nworkers,
+                             log_prefix=os.path.join(output_folder, "make_qa_tables") if nworkers > 1 else None,
+                             origin='make_qa_tables', best_effort=True)
 
-                else:
-                    casalog.post(message="File {} already exists. Skipping".format(ampresid_filename),
-                                origin='make_qa_tables')
-
-                # Plot amplitude vs antenna 1.
-                # Check for ant outliers
-
-                ampant_filename = os.path.join(output_folder,
-                                            'field_{0}_amp_ant1.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-                # Remove existing file if it exists and is very small
-                # indicating a plotms failure
-                remove_minsize(ampant_filename, min_size=50)
-
-                if not os.path.exists(ampant_filename):
-
-                    plotms(vis=ms_name,
-                        xaxis='antenna1',
-                        yaxis='amp',
-                        ydatacolumn='corrected',
-                        selectdata=True,
-                        field=names[ii],
-                        scan=f"{this_scan}",
-                        spw="",
-                        correlation="",
-                        avgchannel=str(chanavg),
-                        avgtime='1e8',
-                        averagedata=True,
-                        avgbaseline=False,
-                        transform=False,
-                        extendflag=False,
-                        plotrange=[],
-                        xlabel='antenna 1',
-                        ylabel='Amp',
-                        showmajorgrid=False,
-                        showminorgrid=False,
-                        plotfile=ampant_filename,
-                        overwrite=True,
-                        showgui=False)
+    if store_filename is not None:
+        _add_scan_results_to_store(store, results, work_item_products, use_plotms)
 
-                else:
-                    casalog.post(message="File {} already exists. Skipping".format(ampant_filename),
-                                origin='make_qa_tables')
-
-
-                # Plot phase vs antenna 1.
-                # Check for ant outliers
-
-                phaseant_filename = os.path.join(output_folder,
-                                            'field_{0}_phase_ant1.scan_{1}.{2}'.format(names[ii], this_scan, outtype))
-
-                # Remove existing file if it exists and is very small
-                # indicating a plotms failure
-                remove_minsize(phaseant_filename, min_size=50)
-
-                if not os.path.exists(phaseant_filename):
-
-                    plotms(vis=ms_name,
-                        xaxis='antenna1',
-                        yaxis='phase',
-                        ydatacolumn='corrected',
-                        selectdata=True,
-                        field=names[ii],
-                        scan=f"{this_scan}",
-                        spw="",
-                        correlation="",
-                        avgchannel=str(chanavg),
-                        avgtime='1e8',
-                        averagedata=True,
-                        avgbaseline=False,
-                        transform=False,
-                        extendflag=False,
-                        plotrange=[],
-                        xlabel='antenna 1',
-                        ylabel='Phase',
-                        showmajorgrid=False,
-                        showminorgrid=False,
-                        plotfile=phaseant_filename,
-                        overwrite=True,
-                        showgui=False)
+        store.save(store_filename)
+
+        casalog.post(message="Saved QA tables to {}".format(store_filename),
+                     origin='make_qa_tables')
+
+    elif use_cache:
+        for result, this_item in zip(results, work_item_products):
+            if result['error'] is not None:
+                continue
+
+            scan_filenames, scan_key = this_item[-2:]
+
+            for this_filename in scan_filenames:
+                # Failed plotms exports are removed and retried on the next run.
+                if os.path.exists(this_filename) and os.path.getsize(this_filename) < 50:
+                    os.remove(this_filename)
+                    continue
+
+                manifest.record(this_filename, scan_key)
+
+        manifest.save()
+
+    # The finished scans are kept above. Now raise on any failure.
+    check_work_item_errors(results, origin='make_qa_tables')
 
+
+def _add_scan_results_to_store(store, results, work_item_products, use_plotms):
+    '''
+    Add the tables of each finished field and scan to the store. The
+    plotms text exports are read in and removed.
+    '''
+
+    for result, this_item in zip(results, work_item_products):
+        label, fieldname, scan, is_calibrator, scan_filenames, scan_key = this_item
+
+        if result['error'] is not None:
+            continue
+
+        for product, this_filename in zip(scan_products(is_calibrator), scan_filenames):
+
+            if use_plotms:
+                if not os.path.exists(this_filename):
+                    continue
+
+                # Failed plotms exports are not kept so they are retried on the next run.
+                if os.path.getsize(this_filename) >= 50:
+                    store.add_txt(product, this_filename)
+                    os.remove(this_filename)
                 else:
-                    casalog.post(message="File {} already exists. Skipping".format(phaseant_filename),
-                                origin='make_qa_tables')
+                    os.remove(this_filename)
+                    scan_key = None
+
+            else:
+                # Residual products are dropped without a MODEL_DATA column.
+                if product not in result['result']:
+                    continue
+
+                # Tables without unflagged data are kept (empty) so the cache
+                # does not try to remake them.
+                datacolumn = QA_TABLE_PRODUCTS[product]['plotms']['ydatacolumn']
+
+                store.add(product, result['result'][product], os.path.basename(this_filename),
+                          header=plotms_table_header(product, datacolumn=datacolumn))
+
+        if scan_key is not None:
+            store.keys[label] = scan_key
+
+
+def plotms_scan_tables(ms_name, fieldname, scan, is_calibrator,
+                       output_folder='scan_plots_txt', outtype='txt',
+                       chanavg=4096):
+    '''
+    Export the QA tables for one field and scan with plotms. Each table
+    is a separate plotms call.
+    '''
+
+    from casaplotms import plotms
+
+    for product in scan_products(is_calibrator):
+
+        this_filename = qa_table_filename(output_folder, fieldname, product, scan,
+                                          outtype=outtype)
+
+        # Remove existing file if it exists and is very small
+        # indicating a plotms failure
+        remove_minsize(this_filename, min_size=50)
+
+        if os.path.exists(this_filename):
+            casalog.post(message="File {} already exists. Skipping".format(this_filename),
+                         origin='make_qa_tables')
+            continue
 
+        plotms_settings = QA_TABLE_PRODUCTS[product]['plotms']
+
+        avgchannel = plotms_settings['avgchannel']
+        if avgchannel is None:
+            avgchannel = str(chanavg)
+
+        plotms(vis=ms_name,
+               xaxis=plotms_settings['xaxis'],
+               yaxis=plotms_settings['yaxis'],
+               ydatacolumn=plotms_settings['ydatacolumn'],
+               selectdata=True,
+               field=fieldname,
+               scan=f"{scan}",
+               spw="",
+               avgchannel=avgchannel,
+               avgtime=plotms_settings['avgtime'],
+               correlation="",
+               averagedata=True,
+               avgbaseline=plotms_settings['avgbaseline'],
+               transform=False,
+               extendflag=False,
+               plotrange=[],
+               xlabel=plotms_settings['xlabel'],
+               ylabel=plotms_settings['ylabel'],
+               showmajorgrid=False,
+               showminorgrid=False,
+               plotfile=this_filename,
+               overwrite=True,
+               showgui=False)
 
 
 def extract_and_append_fieldnames(tablename, txtfilename,
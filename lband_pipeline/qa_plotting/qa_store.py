@@ -0,0 +1,400 @@
+
+'''
+Columnar store for the QA tables of one track.
+
+The per-scan and calibration table exports are thousands of small text files
+per track, which is slow to write, copy and tar on a shared file system. The
+store keeps all of them in a single compressed numpy archive (`.npz`) with one
+columnar table per product (e.g. 'amp_time' or 'caltable_bandpass_amp'). Each
+table holds the plotms columns (x, y, chan, scan, field, ant1, ant2, spw, etc.)
+and an index to the legacy text file each row belongs to, so the text files
+read by QAPlotter can be re-created with `QAStore.export_txt`. Only the
+engine tables are re-created byte for byte; packed plotms exports are
+re-formatted.
+
+Only numeric and unicode arrays are saved; the store is read without pickle.
+
+'''
+
+import os
+import numpy as np
+
+from casatools import logsink
+
+from .qa_table_engine import PLOTMS_TXT_DTYPE
+
+casalog = logsink()
+
+
+# Printing formats per numpy dtype kind for the text export.
+TXT_FORMATS = {'f': '%.12g', 'i': '%d', 'u': '%d', 'b': '%d', 'U': '%s'}
+
+# Types of the known plotms export columns.
+PLOTMS_COLUMN_DTYPES = dict(PLOTMS_TXT_DTYPE)
+
+
+def plotms_txt_cache_filename(filename):
+    '''
+    Name of the binary cache of a text export, e.g. `plotms_amp_uvwave_field_J1234.txt.npy`.
+    '''
+    return "{}.npy".format(filename)
+
+
+def read_plotms_txt(filename, use_cache=False, mmap_mode=None):
+    '''
+    Read a plotms text export (or one written by `qa_table_engine`).
+
+    The column names are taken from the comment line starting with "x y".
+    When all columns are in `PLOTMS_COLUMN_DTYPES`, the file is parsed with
+    `np.loadtxt` and that schema. Otherwise, or if the typed parse fails, the
+    types are inferred with `np.genfromtxt`.
+
+    Parameters
+    ----------
+    filename : str
+        Text file name.
+    use_cache : bool, optional
+        Load the table from a `.npy` file next to the text file when it is newer
+        than the text file. Otherwise, parse the text and write the `.npy` file.
+    mmap_mode : str, optional
+        Passed to `np.load` when reading from the cache, e.g. 'r' for a
+        read-only memory map.
+
+    Returns
+    -------
+    header : str
+        The comment lines (without the leading '# ').
+    table : np.ndarray
+        Structured array with one field per column.
+    '''
+
+    header_lines = []
+    with open(filename, 'r') as txtfile:
+        for line in txtfile:
+            if not line.startswith("#"):
+                break
+            header_lines.append(line[1:].strip())
+
+    header = "\n".join(header_lines)
+
+    cache_filename = plotms_txt_cache_filename(filename)
+
+    if use_cache and os.path.exists(cache_filename):
+        if os.path.getmtime(cache_filename) >= os.path.getmtime(filename):
+            return header, np.load(cache_filename, mmap_mode=mmap_mode, allow_pickle=False)
+
+    names = None
+    for line in header_lines:
+        if line.split()[:2] == ['x', 'y']:
+            names = line.split()
+            break
+
+    table = None
+
+    if names is not None and all([name in PLOTMS_COLUMN_DTYPES for name in names]):
+        try:
+            table = np.loadtxt(filename, comments='#', encoding=None, ndmin=1,
+                               dtype=[(name, PLOTMS_COLUMN_DTYPES[name]) for name in names])
+        except ValueError:
+            casalog.post(message="Unable to read {} with the plotms column types. "
+                                 "Inferring the types instead.".format(filename),
+                         origin='read_plotms_txt', priority='WARN')
+
+    if table is None:
+        table = np.atleast_1d(np.genfromtxt(filename, comments='#', dtype=None,
+                                            encoding=None, names=names))
+
+    if use_cache and table.dtype.names is not None:
+        tmp_filename = "{}.tmp".format(cache_filename)
+
+        try:
+            # Pass a file object so numpy does not append '.npy' to the name.
+            with open(tmp_filename, 'wb') as cachefile:
+                np.save(cachefile, table, allow_pickle=False)
+
+            os.replace(tmp_filename, cache_filename)
+
+        except OSError:
+            casalog.post(message="Unable to write the cache {}".format(cache_filename),
+                         origin='read_plotms_txt', priority='WARN')
+
+    return header, table
+
+
+class QAStore(object):
+    '''
+    In-memory collection of QA tables that is saved as one compressed file.
+
+    Tables are added per product and per legacy text file name. A table for
+    a file name that is already in the store replaces the old one.
+
+    `keys` maps a label (e.g. a field and scan) to the cache key of the
+    inputs used to make its tables (see `lband_pipeline.product_cache`).
+    '''
+
+    def __init__(self):
+
+        # product -> {filename: (header, table)}. Dictionaries keep the insertion order.
+        self.products = {}
+
+        self.keys = {}
+
+    def add(self, product, table, filename, header=''):
+        '''
+        Add the table of one legacy text file to a product.
+
+        Parameters
+        ----------
+        product : str
+            Product name, e.g. 'amp_time'.
+        table : np.ndarray
+            Structured array. All tables of a product must have the same columns.
+        filename : str
+            Legacy text file name (without the output folder).
+        header : str, optional
+            Header lines of the legacy text file.
+        '''
+
+        self.products.setdefault(product, {})[filename] = (header, table)
+
+    def add_txt(self, product, filename):
+        '''
+        Add an existing text export (e.g. from plotms) to a product. Files
+        without any rows are skipped.
+        '''
+
+        header, table = read_plotms_txt(filename)
+
+        if table.dtype.names is None or table.size == 0:
+            casalog.post(message="No rows in {}. Skipping".format(filename),
+                         origin='QAStore.add_txt')
+            return
+
+        self.add(product, table, os.path.basename(filename), header=header)
+
+    def remove(self, filenames):
+        '''
+        Remove the tables of these legacy file names from all products.
+        '''
+
+        for product in list(self.products):
+            for filename in filenames:
+                self.products[product].pop(filename, None)
+
+            if len(self.products[product]) == 0:
+                del self.products[product]
+
+    def filenames(self, product=None):
+        '''
+        Legacy file names in the store, optionally for one product only.
+        '''
+
+        products = self.products if product is None else [product]
+
+        return [filename for this_product in products
+                for filename in self.products.get(this_product, {})]
+
+    def table(self, product):
+        '''
+        Return all rows of a product as one structured array.
+        '''
+
+        tables = [table for header, table in self.products[product].values()]
+
+        return _concatenate_columns(tables)
+
+    def save(self, store_filename):
+        '''
+        Write the store. The file is replaced atomically.
+        '''
+
+        arrays = {'_products': np.array(list(self.products), dtype='U'),
+                  '_key_labels': np.array(list(self.keys), dtype='U'),
+                  '_keys': np.array([self.keys[label] for label in self.keys], dtype='U')}
+
+        for product in self.products:
+
+            filenames = list(self.products[product])
+            headers = [self.products[product][filename][0] for filename in filenames]
+            tables = [self.products[product][filename][1] for filename in filenames]
+
+            table = _concatenate_columns(tables)
+
+            arrays["{}/_columns".format(product)] = np.array(table.dtype.names, dtype='U')
+            arrays["{}/_files".format(product)] = np.array(filenames, dtype='U')
+            arrays["{}/_headers".format(product)] = np.array(headers, dtype='U')
+            arrays["{}/_file_index".format(product)] = \
+                np.repeat(np.arange(len(tables), dtype=np.int32),
+                          [this_table.size for this_table in tables])
+
+            for name in table.dtype.names:
+                arrays["{0}/{1}".format(product, name)] = table[name]
+
+        tmp_filename = "{}.tmp".format(store_filename)
+
+        # Pass a file object so numpy does not append '.npz' to the name.
+        with open(tmp_filename, 'wb') as storefile:
+            np.savez_compressed(storefile, **arrays)
+
+        os.replace(tmp_filename, store_filename)
+
+    @classmethod
+    def load(cls, store_filename):
+        '''
+        Load a store written with `QAStore.save`.
+        '''
+
+        store = cls()
+
+        with np.load(store_filename, allow_pickle=False) as data:
+
+            store.keys = dict(zip(data['_key_labels'].tolist(), data['_keys'].tolist()))
+
+            for product in data['_products']:
+
+                table = _read_product(data, product)
+
+                filenames = data["{}/_files".format(product)]
+                headers = data["{}/_headers".format(product)]
+
+                # Rows are saved in file order.
+                bounds = np.cumsum(np.bincount(data["{}/_file_index".format(product)],
+                                               minlength=len(filenames)))
+                starts = np.append(0, bounds[:-1])
+
+                for filename, header, start, end in zip(filenames, headers, starts, bounds):
+                    store.add(str(product), table[start:end], str(filename), header=str(header))
+
+        return store
+
+    def export_txt(self, output_folder, products=None, skip_empty=True):
+        '''
+        Write the legacy text files (e.g. `field_3C48_amp_time.scan_2.txt`)
+        into `output_folder`.
+
+        Tables from `qa_table_engine` are written exactly as `write_plotms_table`
+        writes them. Text exports packed with `add_txt` (e.g. the plotms
+        caltable exports) keep their columns and comment lines, but not the
+        spacing of the comment lines or the original number formatting.
+
+        Parameters
+        ----------
+        output_folder : str
+            Output folder. Created if it does not exist.
+        products : list, optional
+            Only export these products. Default is all.
+        skip_empty : bool, optional
+            Do not write files for tables without rows, matching the exports
+            where all data were flagged.
+
+        Returns
+        -------
+        written : list
+            The file names written.
+        '''
+
+        if not os.path.exists(output_folder):
+            os.mkdir(output_folder)
+
+        if products is None:
+            products = list(self.products)
+
+        written = []
+
+        for product in products:
+            for filename, (header, table) in self.products[product].items():
+
+                if skip_empty and table.size == 0:
+                    continue
+
+                out_filename = os.path.join(output_folder, filename)
+
+                fmt = " ".join([TXT_FORMATS.get(table.dtype[name].kind, '%s')
+                                for name in table.dtype.names])
+
+                np.savetxt(out_filename, table, fmt=fmt, header=header)
+
+                written.append(out_filename)
+
+        casalog.post(message="Exported {0} text files to {1}".format(len(written), output_folder),
+                     origin='QAStore.export_txt')
+
+        return written
+
+
+def _concatenate_columns(tables):
+    '''
+    Concatenate structured arrays column by column. Unlike `np.concatenate`,
+    this allows string columns of different widths (e.g. from `np.genfromtxt`).
+    '''
+
+    names = tables[0].dtype.names
+
+    for table in tables[1:]:
+        if table.dtype.names != names:
+            raise ValueError("Tables must have the same columns. Found {0} and {1}".format(names,
+                                                                                        table.dtype.names))
+
+    columns = [np.concatenate([table[name] for table in tables]) for name in names]
+
+    return _structured_from_columns(names, columns)
+
+
+def _structured_from_columns(names, columns):
+    '''
+    Build a structured array from a list of columns.
+    '''
+
+    table = np.empty(len(columns[0]),
+                     dtype=[(name, column.dtype) for name, column in zip(names, columns)])
+
+    for name, column in zip(names, columns):
+        table[name] = column
+
+    return table
+
+
+def _read_product(data, product):
+    '''
+    Read the columns of one product from an open store.
+    '''
+
+    names = data["{}/_columns".format(product)].tolist()
+
+    columns = [data["{0}/{1}".format(product, name)] for name in names]
+
+    return _structured_from_columns(names, columns)
+
+
+def read_qa_store(store_filename, product):
+    '''
+    Read all rows of one product from a store. Only the columns of that
+    product are decompressed.
+
+    Parameters
+    ----------
+    store_filename : str
+        Store file name.
+    product : str
+        Product name, e.g. 'amp_time'.
+
+    Returns
+    -------
+    table : np.ndarray
+        Structured array with the plotms columns.
+    '''
+
+    with np.load(store_filename, allow_pickle=False) as data:
+
+        if product not in data['_products']:
+            raise KeyError("No product {0} in {1}".format(product, store_filename))
+
+        return _read_product(data, product)
+
+
+def export_qa_store_txt(store_filename, output_folder, products=None):
+    '''
+    Re-create the legacy text files from a store. See `QAStore.export_txt`.
+    '''
+
+    return QAStore.load(store_filename).export_txt(output_folder, products=products)
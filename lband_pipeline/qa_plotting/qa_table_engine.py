@@ -0,0 +1,637 @@
+
+'''
+Single-pass engine for the per-scan QA tables.
+
+`make_qa_tables` used to call plotms once per product for every scan, re-reading
+the same rows of the CORRECTED column each time. Here each scan is read once
+with the table tool and all of the averaged products are accumulated in numpy.
+The outputs use the same file names and text layout as the plotms exports so
+QAPlotter (and `uvresid_plot.get_uvdata`) read them unchanged.
+
+'''
+
+import os
+import numpy as np
+
+from casatools import logsink
+
+from lband_pipeline.ms_reader import iter_table_chunks, DEFAULT_MEMORY_BUDGET
+
+casalog = logsink()
+
+
+# Speed of light in m/s
+CLIGHT = 299792458.0
+
+# Correlation type codes from the POLARIZATION table (casacore Stokes enum)
+CORR_TYPES = {1: 'I', 2: 'Q', 3: 'U', 4: 'V',
+              5: 'RR', 6: 'RL', 7: 'LR', 8: 'LL',
+              9: 'XX', 10: 'XY', 11: 'YX', 12: 'YY'}
+
+# Products written per scan. The order matches the original plotms calls.
+# 'avg' sets the averaging:
+#   'time': average channels (by chanavg) and baselines, keep each integration.
+#   'chan': average the whole scan and baselines, keep each channel.
+#   'baseline': average channels (by chanavg) and the whole scan per baseline.
+# 'plotms' holds the equivalent plotms settings used with `use_plotms=True`.
+QA_TABLE_PRODUCTS = {'amp_time': {'x': 'time', 'y': 'amp', 'avg': 'time',
+                                  'calibrator_only': False,
+                                  'plotms': {'xaxis': 'time', 'yaxis': 'amp',
+                                             'ydatacolumn': 'corrected',
+                                             'avgchannel': None, 'avgtime': '',
+                                             'avgbaseline': True,
+                                             'xlabel': 'Time', 'ylabel': 'Amp'}},
+                     'amp_chan': {'x': 'chan', 'y': 'amp', 'avg': 'chan',
+                                  'calibrator_only': False,
+                                  'plotms': {'xaxis': 'chan', 'yaxis': 'amp',
+                                             'ydatacolumn': 'corrected',
+                                             'avgchannel': '1', 'avgtime': '1e8',
+                                             'avgbaseline': True,
+                                             'xlabel': 'Channel', 'ylabel': 'Amp'}},
+                     'amp_uvdist': {'x': 'uvdist', 'y': 'amp', 'avg': 'baseline',
+                                    'calibrator_only': False,
+                                    'plotms': {'xaxis': 'uvdist', 'yaxis': 'amp',
+                                               'ydatacolumn': 'corrected',
+                                               'avgchannel': None, 'avgtime': '1e8',
+                                               'avgbaseline': False,
+                                               'xlabel': 'uv-dist', 'ylabel': 'Amp'}},
+                     'phase_time': {'x': 'time', 'y': 'phase', 'avg': 'time',
+                                    'calibrator_only': True,
+                                    'plotms': {'xaxis': 'time', 'yaxis': 'phase',
+                                               'ydatacolumn': 'corrected',
+                                               'avgchannel': None, 'avgtime': '',
+                                               'avgbaseline': True,
+                                               'xlabel': 'Time', 'ylabel': 'Phase'}},
+                     'phase_chan': {'x': 'chan', 'y': 'phase', 'avg': 'chan',
+                                    'calibrator_only': True,
+                                    'plotms': {'xaxis': 'chan', 'yaxis': 'phase',
+                                               'ydatacolumn': 'corrected',
+                                               'avgchannel': '1', 'avgtime': '1e8',
+                                               'avgbaseline': True,
+                                               'xlabel': 'Chan', 'ylabel': 'Phase'}},
+                     'phase_uvdist': {'x': 'uvdist', 'y': 'phase', 'avg': 'baseline',
+                                      'calibrator_only': True,
+                                      'plotms': {'xaxis': 'uvdist', 'yaxis': 'phase',
+                                                 'ydatacolumn': 'corrected',
+                                                 'avgchannel': None, 'avgtime': '1e8',
+                                                 'avgbaseline': False,
+                                                 'xlabel': 'uv-dist', 'ylabel': 'Phase'}},
+                     'amp_phase': {'x': 'amp', 'y': 'phase', 'avg': 'baseline',
+                                   'calibrator_only': True,
+                                   'plotms': {'xaxis': 'amp', 'yaxis': 'phase',
+                                              'ydatacolumn': 'corrected',
+                                              'avgchannel': None, 'avgtime': '1e8',
+                                              'avgbaseline': False,
+                                              'xlabel': 'Phase', 'ylabel': 'Amp'}},
+                     'ampresid_uvwave': {'x': 'uvwave', 'y': 'amp', 'avg': 'baseline',
+                                         'calibrator_only': True,
+                                         'resid': True,
+                                         'plotms': {'xaxis': 'uvwave', 'yaxis': 'amp',
+                                                    'ydatacolumn': 'corrected-model_scalar',
+                                                    'avgchannel': None, 'avgtime': '1e8',
+                                                    'avgbaseline': False,
+                                                    'xlabel': 'uv-dist', 'ylabel': 'Phase'}},
+                     'amp_ant1': {'x': 'ant1', 'y': 'amp', 'avg': 'baseline',
+                                  'calibrator_only': True,
+                                  'plotms': {'xaxis': 'antenna1', 'yaxis': 'amp',
+                                             'ydatacolumn': 'corrected',
+                                             'avgchannel': None, 'avgtime': '1e8',
+                                             'avgbaseline': False,
+                                             'xlabel': 'antenna 1', 'ylabel': 'Amp'}},
+                     'phase_ant1': {'x': 'ant1', 'y': 'phase', 'avg': 'baseline',
+                                    'calibrator_only': True,
+                                    'plotms': {'xaxis': 'antenna1', 'yaxis': 'phase',
+                                               'ydatacolumn': 'corrected',
+                                               'avgchannel': None, 'avgtime': '1e8',
+                                               'avgbaseline': False,
+                                               'xlabel': 'antenna 1', 'ylabel': 'Phase'}},
+                     }
+
+# Column layout of the plotms text exports
+PLOTMS_TXT_DTYPE = [('x', float), ('y', float), ('chan', int), ('scan', int),
+                    ('field', int), ('ant1', int), ('ant2', int),
+                    ('ant1name', 'U16'), ('ant2name', 'U16'),
+                    ('time', float), ('freq', float), ('spw', int),
+                    ('corr', 'U4'), ('obs', int)]
+
+PLOTMS_TXT_FMT = '%.12g %.12g %d %d %d %d %d %s %s %.12g %.12g %d %s %d'
+
+PLOTMS_TXT_UNITS = {'time': 'MJD(seconds)', 'chan': 'None', 'uvdist': 'm',
+                    'uvwave': 'lambda', 'amp': 'None', 'phase': 'deg',
+                    'ant1': 'None'}
+
+
+def qa_table_filename(output_folder, fieldname, product, scan, outtype='txt'):
+    '''
+    Name of the per-scan QA table, e.g. `field_3C48_amp_time.scan_2.txt`.
+    '''
+
+    return os.path.join(output_folder,
+                        'field_{0}_{1}.scan_{2}.{3}'.format(fieldname, product, scan, outtype))
+
+
+def scan_products(is_calibrator):
+    '''
+    Return the product names exported for a field.
+    '''
+
+    return [product for product in QA_TABLE_PRODUCTS
+            if is_calibrator or not QA_TABLE_PRODUCTS[product]['calibrator_only']]
+
+
+def read_ms_setup(ms_name):
+    '''
+    Read the sub-table information needed to label the QA tables.
+
+    Returns
+    -------
+    ms_setup : dict
+        Antenna names, the DATA_DESC_ID -> SPW mapping, channel frequencies per SPW,
+        and the correlation labels per DATA_DESC_ID.
+    '''
+
+    from casatools import table
+
+    tb = table()
+
+    tb.open(os.path.join(ms_name, "ANTENNA"))
+    ant_names = np.array(tb.getcol('NAME'))
+    tb.close()
+
+    tb.open(os.path.join(ms_name, "SPECTRAL_WINDOW"))
+    # Variable channel numbers per SPW, so read row by row.
+    chan_freqs = [tb.getcell('CHAN_FREQ', ii) for ii in range(tb.nrows())]
+    tb.close()
+
+    tb.open(os.path.join(ms_name, "POLARIZATION"))
+    corr_types = [tb.getcell('CORR_TYPE', ii) for ii in range(tb.nrows())]
+    tb.close()
+
+    tb.open(os.path.join(ms_name, "DATA_DESCRIPTION"))
+    ddid_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    ddid_pol = tb.getcol('POLARIZATION_ID')
+    tb.close()
+
+    ddid_corrs = [[CORR_TYPES.get(int(code), str(code)) for code in corr_types[pol]]
+                  for pol in ddid_pol]
+
+    return {'ant_names': ant_names,
+            'ddid_spw': ddid_spw,
+            'ddid_corrs': ddid_corrs,
+            'chan_freqs': chan_freqs}
+
+
+class ScanAccumulator(object):
+    '''
+    Weighted sums of the visibilities for one scan and one DATA_DESC_ID.
+
+    Rows are added in chunks. All of the per-scan products are simple weighted
+    averages so only the sums and weights need to be kept in memory.
+
+    Parameters
+    ----------
+    time_idx : `~numpy.ndarray`
+        Index of the unique integration for every row.
+    bl_idx : `~numpy.ndarray`
+        Index of the unique baseline for every row.
+    ntime : int
+        Number of unique integrations.
+    nbl : int
+        Number of unique baselines.
+    nchan : int
+        Number of channels.
+    ncorr : int
+        Number of correlations.
+    chanavg : int
+        Number of channels to average for the time and baseline products.
+    do_resid : bool
+        Also accumulate MODEL for the residual products. As for plotms'
+        'corrected-model_scalar', the residual is the difference of the averaged
+        amplitudes, not the amplitude of the averaged difference.
+    '''
+
+    def __init__(self, time_idx, bl_idx, ntime, nbl, nchan, ncorr,
+                 chanavg, do_resid=False):
+
+        self.time_idx = time_idx
+        self.bl_idx = bl_idx
+
+        chanavg = int(max(1, min(int(chanavg), nchan)))
+        self.bin_starts = np.arange(0, nchan, chanavg)
+        nbin = len(self.bin_starts)
+
+        self.do_resid = do_resid
+
+        self.time_vis = np.zeros((ntime, nbin, ncorr), dtype=complex)
+        self.time_wt = np.zeros((ntime, nbin, ncorr))
+
+        self.chan_vis = np.zeros((nchan, ncorr), dtype=complex)
+        self.chan_wt = np.zeros((nchan, ncorr))
+
+        self.bl_vis = np.zeros((nbl, nbin, ncorr), dtype=complex)
+        self.bl_wt = np.zeros((nbl, nbin, ncorr))
+
+        if do_resid:
+            self.bl_model = np.zeros((nbl, nbin, ncorr), dtype=complex)
+
+    def add(self, rows, data, flag, weight, model=None):
+        '''
+        Add a chunk of rows.
+
+        Parameters
+        ----------
+        rows : slice
+            Rows of the chunk within the scan selection.
+        data : `~numpy.ndarray`
+            Visibilities with shape (nrow, nchan, ncorr).
+        flag : `~numpy.ndarray`
+            Flags with shape (nrow, nchan, ncorr).
+        weight : `~numpy.ndarray`
+            Weights with shape (nrow, ncorr).
+        model : `~numpy.ndarray`, optional
+            Model visibilities with shape (nrow, nchan, ncorr). Required when
+            `do_resid=True`.
+        '''
+
+        wt = np.where(flag, 0., weight[:, np.newaxis, :])
+        wdata = wt * data
+
+        self.chan_vis += wdata.sum(0)
+        self.chan_wt += wt.sum(0)
+
+        wdata_binned = np.add.reduceat(wdata, self.bin_starts, axis=1)
+        wt_binned = np.add.reduceat(wt, self.bin_starts, axis=1)
+
+        time_idx = self.time_idx[rows]
+        bl_idx = self.bl_idx[rows]
+
+        np.add.at(self.time_vis, time_idx, wdata_binned)
+        np.add.at(self.time_wt, time_idx, wt_binned)
+
+        np.add.at(self.bl_vis, bl_idx, wdata_binned)
+        np.add.at(self.bl_wt, bl_idx, wt_binned)
+
+        if self.do_resid:
+            wmodel_binned = np.add.reduceat(wt * model, self.bin_starts, axis=1)
+            np.add.at(self.bl_model, bl_idx, wmodel_binned)
+
+    def averages(self):
+        '''
+        Return the weighted averages for the time, channel and baseline products.
+        Bins without any unflagged data are NaN. The residual is a real amplitude
+        difference, |<CORRECTED>| - |<MODEL>|, per baseline.
+        '''
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out = {'time': self.time_vis / self.time_wt,
+                   'chan': self.chan_vis / self.chan_wt,
+                   'baseline': self.bl_vis / self.bl_wt}
+
+            if self.do_resid:
+                out['resid'] = (np.abs(self.bl_vis / self.bl_wt) -
+                                np.abs(self.bl_model / self.bl_wt))
+
+        return out
+
+
+def _yvalue(vis, yaxis):
+    if yaxis == 'amp':
+        return np.abs(vis)
+    elif yaxis == 'phase':
+        return np.angle(vis, deg=True)
+    else:
+        raise ValueError("Unexpected y-axis {}".format(yaxis))
+
+
+def _product_table(product, avgs, block, spw, corrs, scan, field_id, obs_id,
+                   ant_names):
+    '''
+    Convert the averages of one DATA_DESC_ID block into rows of a plotms-style table.
+    '''
+
+    props = QA_TABLE_PRODUCTS[product]
+
+    if props.get('resid', False):
+        vis = avgs['resid']
+    else:
+        vis = avgs[props['avg']]
+
+    good = np.isfinite(vis)
+
+    # Broadcast the labels for each axis to the shape of vis.
+    if props['avg'] == 'time':
+        ntime, nbin, ncorr = vis.shape
+        times = block['utimes'][:, np.newaxis, np.newaxis]
+        chans = block['bin_starts'][np.newaxis, :, np.newaxis]
+        freqs = block['bin_freqs'][np.newaxis, :, np.newaxis]
+        ant1 = np.array(-1)
+        ant2 = np.array(-1)
+        ant1name = np.array('*')
+        ant2name = np.array('*')
+        uvdist = np.array(np.nan)
+    elif props['avg'] == 'chan':
+        nchan, ncorr = vis.shape
+        times = np.array(block['mean_time'])
+        chans = np.arange(nchan)[:, np.newaxis]
+        freqs = block['chan_freqs'][:, np.newaxis]
+        ant1 = np.array(-1)
+        ant2 = np.array(-1)
+        ant1name = np.array('*')
+        ant2name = np.array('*')
+        uvdist = np.array(np.nan)
+    else:
+        nbl, nbin, ncorr = vis.shape
+        times = block['bl_time'][:, np.newaxis, np.newaxis]
+        chans = block['bin_starts'][np.newaxis, :, np.newaxis]
+        freqs = block['bin_freqs'][np.newaxis, :, np.newaxis]
+        ant1 = block['bl_ant1'][:, np.newaxis, np.newaxis]
+        ant2 = block['bl_ant2'][:, np.newaxis, np.newaxis]
+        ant1name = ant_names[block['bl_ant1']][:, np.newaxis, np.newaxis]
+        ant2name = ant_names[block['bl_ant2']][:, np.newaxis, np.newaxis]
+        uvdist = block['bl_uvdist'][:, np.newaxis, np.newaxis]
+
+    corr_labels = np.array(corrs)
+
+    shape = vis.shape
+    table = np.zeros(good.sum(), dtype=PLOTMS_TXT_DTYPE)
+
+    def _fill(values):
+        return np.broadcast_to(values, shape)[good]
+
+    if props.get('resid', False):
+        # Already the scalar amplitude difference
+        yvals = vis
+    else:
+        yvals = _yvalue(vis, props['y'])
+
+    if props['x'] == 'time':
+        table['x'] = _fill(times)
+    elif props['x'] == 'chan':
+        table['x'] = _fill(chans)
+    elif props['x'] == 'uvdist':
+        table['x'] = _fill(uvdist)
+    elif props['x'] == 'uvwave':
+        # uv-distance in wavelengths at the frequency of the channel bin
+        table['x'] = _fill(uvdist * freqs / CLIGHT)
+    elif props['x'] == 'ant1':
+        table['x'] = _fill(ant1)
+    elif props['x'] == 'amp':
+        table['x'] = np.abs(vis)[good]
+
+    table['y'] = yvals[good]
+    table['chan'] = _fill(chans)
+    table['scan'] = scan
+    table['field'] = field_id
+    table['ant1'] = _fill(ant1)
+    table['ant2'] = _fill(ant2)
+    table['ant1name'] = _fill(ant1name)
+    table['ant2name'] = _fill(ant2name)
+    table['time'] = _fill(times)
+    # plotms writes frequencies in GHz
+    table['freq'] = _fill(freqs) / 1e9
+    table['spw'] = spw
+    table['corr'] = _fill(corr_labels)
+    table['obs'] = obs_id
+
+    return table
+
+
+def plotms_table_header(product, datacolumn='corrected'):
+    '''
+    Header lines of the plotms text export layout for a product.
+    '''
+
+    props = QA_TABLE_PRODUCTS[product]
+
+    header = ["From plot 0",
+              "x: {}".format(props['plotms']['xaxis']),
+              "y: {}".format(props['plotms']['yaxis']),
+              "Datacolumn (y): {}".format(datacolumn),
+              "Averaging: {}".format(props['avg']),
+              "Exported by lband_pipeline.qa_plotting.qa_table_engine",
+              " ".join([name for name, _ in PLOTMS_TXT_DTYPE]),
+              " ".join([PLOTMS_TXT_UNITS.get(props['x'], 'None'),
+                        PLOTMS_TXT_UNITS.get(props['y'], 'None'),
+                        "None None None None None None None MJD(seconds) GHz None None None"])]
+
+    return "\n".join(header)
+
+
+def write_plotms_table(filename, table, product, datacolumn='corrected'):
+    '''
+    Write a table in the plotms text export layout.
+
+    Six comment lines are followed by the column names and the units so the
+    output can be read with `np.genfromtxt(..., names=True, skip_header=6)`.
+    '''
+
+    np.savetxt(filename, table, fmt=PLOTMS_TXT_FMT,
+               header=plotms_table_header(product, datacolumn=datacolumn))
+
+
+def compute_scan_tables(ms_name, field_id, scan, products, ms_setup=None,
+                        chanavg=4096, memory_budget=DEFAULT_MEMORY_BUDGET):
+    '''
+    Read one scan of one field once and compute all of the requested QA products.
+
+    Parameters
+    ----------
+    ms_name : str
+        MS name.
+    field_id : int
+        Field ID.
+    scan : int
+        Scan number.
+    products : list
+        Names of products in `QA_TABLE_PRODUCTS`.
+    ms_setup : dict, optional
+        Output of `read_ms_setup`. Read from the MS when not given.
+    chanavg : int, optional
+        Number of channels to average for the time and baseline products.
+    memory_budget : int, optional
+        Approximate maximum number of bytes of the data columns read at once.
+
+    Returns
+    -------
+    tables : dict
+        Structured arrays in the plotms text layout for each product.
+    '''
+
+    from casatools import table
+
+    if ms_setup is None:
+        ms_setup = read_ms_setup(ms_name)
+
+    ant_names = ms_setup['ant_names']
+    nant = len(ant_names)
+
+    do_resid = any([QA_TABLE_PRODUCTS[product].get('resid', False)
+                    for product in products])
+
+    tb = table()
+    tb.open(ms_name)
+    scantable = tb.query("FIELD_ID=={0} AND SCAN_NUMBER=={1}".format(field_id, scan))
+
+    if do_resid and 'MODEL_DATA' not in scantable.colnames():
+        casalog.post(message="No MODEL_DATA column in {}. Skipping residual products.".format(ms_name),
+                     origin='compute_scan_tables')
+        do_resid = False
+        products = [product for product in products
+                    if not QA_TABLE_PRODUCTS[product].get('resid', False)]
+
+    ddids = np.unique(scantable.getcol('DATA_DESC_ID'))
+
+    tables = dict([(product, []) for product in products])
+
+    for ddid in ddids:
+
+        ddtable = scantable.query("DATA_DESC_ID=={}".format(ddid))
+
+        nrow = ddtable.nrows()
+        if nrow == 0:
+            ddtable.close()
+            continue
+
+        spw = int(ms_setup['ddid_spw'][ddid])
+        corrs = ms_setup['ddid_corrs'][ddid]
+        chan_freqs = np.asarray(ms_setup['chan_freqs'][spw])
+
+        # Small per-row columns are read in full to define the averaging groups.
+        times = ddtable.getcol('TIME')
+        ant1 = ddtable.getcol('ANTENNA1')
+        ant2 = ddtable.getcol('ANTENNA2')
+        uvw = ddtable.getcol('UVW')
+        obs_id = int(ddtable.getcell('OBSERVATION_ID', 0))
+
+        utimes, time_idx = np.unique(times, return_inverse=True)
+        ubl, bl_idx = np.unique(ant1 * nant + ant2, return_inverse=True)
+
+        nchan = len(chan_freqs)
+        ncorr = len(corrs)
+
+        accum = ScanAccumulator(time_idx, bl_idx, len(utimes), len(ubl),
+                                nchan, ncorr, chanavg, do_resid=do_resid)
+
+        data_columns = ['CORRECTED_DATA', 'FLAG', 'WEIGHT']
+        if do_resid:
+            data_columns.append('MODEL_DATA')
+
+        for rows, chunk in iter_table_chunks(ddtable, data_columns,
+                                             memory_budget=memory_budget):
+            accum.add(rows, chunk['CORRECTED_DATA'], chunk['FLAG'], chunk['WEIGHT'],
+                      model=chunk.get('MODEL_DATA'))
+
+        ddtable.close()
+
+        bl_counts = np.bincount(bl_idx, minlength=len(ubl))
+
+        block = {'utimes': utimes,
+                 'mean_time': times.mean(),
+                 'bin_starts': accum.bin_starts,
+                 'bin_freqs': np.add.reduceat(chan_freqs, accum.bin_starts) /
+                    np.diff(np.append(accum.bin_starts, nchan)),
+                 'chan_freqs': chan_freqs,
+                 'bl_ant1': ubl // nant,
+                 'bl_ant2': ubl % nant,
+                 'bl_time': np.bincount(bl_idx, weights=times) / bl_counts,
+                 'bl_uvdist': np.bincount(bl_idx, weights=np.hypot(uvw[0], uvw[1])) / bl_counts}
+
+        avgs = accum.averages()
+
+        for product in products:
+            tables[product].append(_product_table(product, avgs, block, spw, corrs,
+                                                  scan, field_id, obs_id, ant_names))
+
+    scantable.close()
+    tb.close()
+
+    for product in products:
+        if len(tables[product]) > 0:
+            tables[product] = np.concatenate(tables[product])
+        else:
+            tables[product] = np.zeros(0, dtype=PLOTMS_TXT_DTYPE)
+
+    return tables
+
+
+def write_scan_qa_tables(ms_name, field_id, fieldname, scan, is_calibrator,
+                         output_folder='scan_plots_txt', outtype='txt',
+                         chanavg=4096, ms_setup=None, skip_existing=True,
+                         min_size=50):
+    '''
+    Compute and write all QA tables for one field and scan in a single pass.
+
+    Parameters
+    ----------
+    ms_name : str
+        MS name.
+    field_id : int
+        Field ID.
+    fieldname : str
+        Field name used in the output file names.
+    scan : int
+        Scan number.
+    is_calibrator : bool
+        Also write the phase, residual and antenna products for calibrators.
+    output_folder : str, optional
+        Output folder name.
+    outtype : str, optional
+        Output file extension.
+    chanavg : int, optional
+        Number of channels to average for the time and baseline products.
+    ms_setup : dict, optional
+        Output of `read_ms_setup`. Read from the MS when not given.
+    skip_existing : bool, optional
+        Skip products whose file already exists.
+    min_size : int, optional
+        Existing files smaller than this (in bytes) are treated as failed exports.
+
+    Returns
+    -------
+    written : list
+        The filenames that were written.
+    '''
+
+    products = scan_products(is_calibrator)
+
+    filenames = dict([(product, qa_table_filename(output_folder, fieldname, product,
+                                                  scan, outtype=outtype))
+                      for product in products])
+
+    if skip_existing:
+        todo = []
+        for product in products:
+            this_filename = filenames[product]
+
+            if os.path.exists(this_filename) and os.path.getsize(this_filename) >= min_size:
+                casalog.post(message="File {} already exists. Skipping".format(this_filename),
+                             origin='write_scan_qa_tables')
+                continue
+
+            todo.append(product)
+
+        products = todo
+
+    if len(products) == 0:
+        return []
+
+    tables = compute_scan_tables(ms_name, field_id, scan, products,
+                                 ms_setup=ms_setup, chanavg=chanavg)
+
+    written = []
+
+    for product in tables:
+
+        if tables[product].size == 0:
+            casalog.post(message="No unflagged data for {0} in field {1} scan {2}".format(product, fieldname, scan),
+                         origin='write_scan_qa_tables')
+            continue
+
+        datacolumn = QA_TABLE_PRODUCTS[product]['plotms']['ydatacolumn']
+
+        write_plotms_table(filenames[product], tables[product], product,
+                           datacolumn=datacolumn)
+
+        written.append(filenames[product])
+
+    return written
@@ -0,0 +1,181 @@
+
+'''
+Mergeable quantile sketches for many groups at once.
+
+The uv-residual statistics need the quartiles and medians per baseline and per
+baseline and scan. Keeping every value (as `np.percentile` needs) is only
+tractable for heavily averaged data. A `GroupedQuantileSketch` keeps counts in
+logarithmic buckets instead (as in DDSketch; Masson et al. 2019), so any
+quantile is returned to within a fixed relative accuracy. Sketches built from
+different chunks or workers are merged by adding their counts, and only the
+buckets with values are stored.
+
+'''
+
+import numpy as np
+
+
+class GroupedQuantileSketch(object):
+    '''
+    Quantile sketch of the values of many groups.
+
+    Values with `|v| <= min_value` are counted as zero, and larger values are
+    placed in logarithmic buckets. Quantiles are returned to within
+    `relative_accuracy` of a value of that rank.
+
+    Parameters
+    ----------
+    relative_accuracy : float, optional
+        Relative accuracy of the quantiles.
+    min_value : float, optional
+        Values with a smaller magnitude are counted as zero.
+    max_value : float, optional
+        Values with a larger magnitude are counted in the last bucket.
+    '''
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-6, max_value=1e12):
+
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1. "
+                             "Given {}".format(relative_accuracy))
+
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.max_value = max_value
+
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self.gamma)
+
+        # Buckets are -nbucket to nbucket, in value order, with 0 as the zero bucket.
+        self.nbucket = int(np.ceil(np.log(max_value / min_value) / self._log_gamma))
+        self._nkey = 2 * self.nbucket + 1
+
+        # Sorted keys of the occupied (group, bucket) pairs and their counts.
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _buckets(self, values):
+        '''
+        Signed bucket index of each value.
+        '''
+
+        absval = np.abs(values)
+
+        with np.errstate(divide='ignore'):
+            index = np.ceil(np.log(absval / self.min_value) / self._log_gamma)
+
+        index = np.clip(np.where(absval > self.min_value, index, 0),
+                        0, self.nbucket).astype(np.int64)
+
+        return np.sign(values).astype(np.int64) * index
+
+    def _bucket_values(self, buckets):
+        '''
+        Representative value of each signed bucket index.
+        '''
+
+        index = np.abs(buckets)
+
+        values = self.min_value * 2 * self.gamma**index / (self.gamma + 1)
+
+        return np.where(index == 0, 0., np.sign(buckets) * values)
+
+    def _add_counts(self, keys, counts):
+        '''
+        Add counts to (possibly repeated) keys.
+        '''
+
+        all_keys, inverse = np.unique(np.append(self.keys, keys), return_inverse=True)
+
+        all_counts = np.bincount(inverse.ravel(), weights=np.append(self.counts, counts),
+                                 minlength=all_keys.size)
+
+        self.keys = all_keys
+        self.counts = np.round(all_counts).astype(np.int64)
+
+    def add(self, groups, values):
+        '''
+        Add values to their groups. NaN values are skipped.
+
+        Parameters
+        ----------
+        groups : np.ndarray
+            Non-negative integer group of each value.
+        values : np.ndarray
+            Values with the same shape as `groups`.
+        '''
+
+        groups = np.asarray(groups, dtype=np.int64).ravel()
+        values = np.asarray(values, dtype=float).ravel()
+
+        good = np.isfinite(values)
+
+        keys = groups[good] * self._nkey + self._buckets(values[good]) + self.nbucket
+
+        keys, counts = np.unique(keys, return_counts=True)
+
+        self._add_counts(keys, counts)
+
+    def merge(self, other):
+        '''
+        Add the counts of another sketch with the same parameters.
+        '''
+
+        if (other.relative_accuracy, other.min_value, other.max_value) != \
+                (self.relative_accuracy, self.min_value, self.max_value):
+            raise ValueError("Sketches must have the same relative_accuracy, min_value and max_value.")
+
+        self._add_counts(other.keys, other.counts)
+
+        return self
+
+    def groups(self):
+        '''
+        Groups with any values, in increasing order.
+        '''
+        return np.unique(self.keys // self._nkey)
+
+    def quantiles(self, q):
+        '''
+        Quantiles of every group.
+
+        The value of rank `q * (n - 1)` is returned for each quantile, to within
+        the relative accuracy.
+
+        Parameters
+        ----------
+        q : float or list
+            Quantiles between 0 and 1.
+
+        Returns
+        -------
+        groups : np.ndarray
+            Groups with any values, in increasing order.
+        counts : np.ndarray
+            Number of values in each group.
+        values : np.ndarray
+            Quantiles with shape (len(q), ngroup).
+        '''
+
+        q = np.atleast_1d(q)
+
+        key_groups = self.keys // self._nkey
+
+        groups, starts = np.unique(key_groups, return_index=True)
+
+        cumcounts = np.cumsum(self.counts)
+
+        counts = np.add.reduceat(self.counts, starts) if groups.size > 0 else np.zeros(0, dtype=np.int64)
+        before = cumcounts[starts] - self.counts[starts] if groups.size > 0 else counts
+
+        values = np.zeros((q.size, groups.size))
+
+        for ii, this_q in enumerate(q):
+            rank = this_q * (counts - 1)
+
+            # First bucket where the cumulative count exceeds the rank.
+            pos = np.searchsorted(cumcounts, before + rank, side='right')
+
+            values[ii] = self._bucket_values(self.keys[pos] % self._nkey - self.nbucket)
+
+        return groups, counts, values
@@ -5,60 +5,412 @@ import matplotlib.pyplot as plt
 
 from casatools import logsink
 
+from lband_pipeline.parallel_tools import run_work_items
+from lband_pipeline.ms_metadata import get_ms_metadata
+from lband_pipeline.ms_reader import iter_ms_chunks, DEFAULT_MEMORY_BUDGET
+
+from .qa_store import read_plotms_txt
+from .qa_table_engine import CLIGHT, read_ms_setup
+from .quantile_sketch import GroupedQuantileSketch
+
 casalog = logsink()
 
 
 # read from plotms output file
-def get_uvdata(infile):
-    dat = np.genfromtxt(infile, names=True, dtype=None, skip_header=6, encoding=None)
-    spws = sorted(np.unique(dat['spw']))
-    median_flux = []
-    for spw in spws:
-        median_flux.append(np.median(dat[dat['spw'] == spw]['y']))
-        dat['y'][dat['spw'] == spw] = 100. * (dat['y'][dat['spw'] == spw] / np.median(dat[dat['spw'] == spw]['y']) - 1.)
-    x = dat['x']
-    y = dat['y']
-    xi = x.argsort()
-    x = x[xi]
-    y = y[xi]
-    return dat, np.median(median_flux)
+def get_uvdata(infile, use_cache=True):
+    '''
+    Read a plotms amp vs. uvwave export and normalize the amplitudes of each
+    SPW to a percentage residual from that SPW's median.
+
+    The parsed table is cached next to `infile` (see `read_plotms_txt`).
+
+    Returns
+    -------
+    dat : np.ndarray
+        Structured array with the normalized residuals in 'y'.
+    median_flux : float
+        Median of the per-SPW median amplitudes.
+    '''
+
+    header, dat = read_plotms_txt(infile, use_cache=use_cache)
+
+    # Sort by SPW, then amplitude to find the median of every SPW at once.
+    spws, spw_index = np.unique(dat['spw'], return_inverse=True)
+    spw_index = spw_index.ravel()
+
+    order = np.lexsort([dat['y'], spw_index])
+
+    counts = np.bincount(spw_index, minlength=len(spws))
+    starts = np.cumsum(counts) - counts
+
+    spw_medians = _sorted_median(dat['y'][order], starts, counts)
+
+    dat['y'] = 100. * (dat['y'] / spw_medians[spw_index] - 1.)
+
+    return dat, np.median(spw_medians)
 
 
 # put data in bins; may need to combine SPWs here
 # current alternative functions for VLASS use hard-coded SPW ranges
-def bin_uvdata(dat):
-    list_x, list_y, list_yerr = [], [], []
-    for ant1 in np.unique(dat['ant1']):
-        for ant2 in np.unique(dat['ant2']):
-            hits = np.where((dat['ant1'] == ant1) & (dat['ant2'] == ant2))[0]
-            if len(hits) > 5:
-                q25, q50, q75 = np.percentile(dat['y'][hits], [25, 50, 75])
-                iqr = (1 / 1.35) * (q75 - q25)
-                bin_median = q50
-                bin_std = np.abs(iqr) / np.sqrt(len(hits))
-                bin_x = np.median(dat['x'][hits])
-                list_x.append(bin_x)
-                list_y.append(bin_median)
-                list_yerr.append(bin_std)
-    return np.array([list_x, list_y, list_yerr])
-
-
-def bin_uvdata_perscan(dat):
-    list_x, list_y, list_yerr = [], [], []
-    for ant1 in np.unique(dat['ant1']):
-        for ant2 in np.unique(dat['ant2']):
-            for scan in np.unique(dat['scan']):
-                hits = np.where((dat['ant1'] == ant1) & (dat['ant2'] == ant2) & (dat['scan'] == scan))[0]
-                if len(hits) > 5:
-                    q25, q50, q75 = np.percentile(dat['y'][hits], [25, 50, 75])
-                    iqr = (1 / 1.35) * (q75 - q25)
-                    bin_median = q50
-                    bin_std = np.abs(iqr) / np.sqrt(len(hits))
-                    bin_x = np.median(dat['x'][hits])
-                    list_x.append(bin_x)
-                    list_y.append(bin_median)
-                    list_yerr.append(bin_std)
-    return np.array([list_x, list_y, list_yerr])
+def bin_uvdata(dat, min_count=5):
+    '''
+    Median residual, IQR-derived error and median uv-distance per baseline.
+    '''
+    return bin_uvdata_groups(dat, ['ant1', 'ant2'], min_count=min_count)
+
+
+def bin_uvdata_perscan(dat, min_count=5):
+    '''
+    Median residual, IQR-derived error and median uv-distance per baseline and scan.
+    '''
+    return bin_uvdata_groups(dat, ['ant1', 'ant2', 'scan'], min_count=min_count)
+
+
+def bin_uvdata_groups(dat, keys, min_count=5):
+    '''
+    Bin the residuals for each unique combination of the `keys` columns with
+    more than `min_count` points.
+
+    The data are sorted once by the keys (`np.lexsort`) so every group is a
+    contiguous block, and the statistics of all groups are computed together.
+    The outputs are identical to looping over each group with `np.percentile`
+    and `np.median`, and are ordered by the keys.
+
+    Parameters
+    ----------
+    dat : np.ndarray
+        Structured array from `get_uvdata`.
+    keys : list
+        Columns to group by, from the slowest to the fastest varying, e.g.
+        ['ant1', 'ant2', 'scan'].
+    min_count : int, optional
+        Groups need more than this number of points.
+
+    Returns
+    -------
+    binned : np.ndarray
+        Array of shape (3, ngroup) with the median x, median y and y error.
+    '''
+
+    if len(dat) == 0:
+        return np.empty((3, 0))
+
+    key_cols = [dat[key] for key in keys]
+
+    # Sort by the keys, then by the values within each group.
+    # np.lexsort sorts by the last key first.
+    order_y = np.lexsort([dat['y']] + key_cols[::-1])
+    order_x = np.lexsort([dat['x']] + key_cols[::-1])
+
+    # Groups start where any key changes.
+    sorted_keys = [key_col[order_y] for key_col in key_cols]
+
+    new_group = np.zeros(len(dat), dtype=bool)
+    new_group[0] = True
+    for sorted_key in sorted_keys:
+        new_group[1:] |= sorted_key[1:] != sorted_key[:-1]
+
+    starts = np.flatnonzero(new_group)
+    counts = np.diff(np.append(starts, len(dat)))
+
+    keep = counts > min_count
+    starts = starts[keep]
+    counts = counts[keep]
+
+    y_sorted = dat['y'][order_y]
+    x_sorted = dat['x'][order_x]
+
+    q25, q50, q75 = [_sorted_percentile(y_sorted, starts, counts, q) for q in [25, 50, 75]]
+
+    iqr = (1 / 1.35) * (q75 - q25)
+    bin_median = q50
+    bin_std = np.abs(iqr) / np.sqrt(counts)
+    bin_x = _sorted_median(x_sorted, starts, counts)
+
+    return np.array([bin_x, bin_median, bin_std])
+
+
+def _sorted_percentile(vals, starts, counts, q):
+    '''
+    `np.percentile` (linear method) of contiguous sorted groups. The
+    interpolation follows numpy's so the values are identical. Groups with a
+    NaN are NaN.
+    '''
+
+    quantile = np.true_divide(q, 100)
+
+    virtual_index = (counts - 1) * quantile
+    prev_index = np.floor(virtual_index)
+    gamma = virtual_index - prev_index
+
+    prev_index = prev_index.astype(int)
+    next_index = np.minimum(prev_index + 1, counts - 1)
+
+    below = vals[starts + prev_index]
+    above = vals[starts + next_index]
+
+    diff = above - below
+    percentile = below + diff * gamma
+    percentile = np.where(gamma >= 0.5, above - diff * (1 - gamma), percentile)
+
+    return _nan_groups(vals, starts, counts, percentile)
+
+
+def _sorted_median(vals, starts, counts):
+    '''
+    `np.median` of contiguous sorted groups. Groups with a NaN are NaN.
+    '''
+
+    lower = vals[starts + (counts - 1) // 2]
+    upper = vals[starts + counts // 2]
+
+    median = np.where(counts % 2 == 1, upper, (lower + upper) / 2.)
+
+    return _nan_groups(vals, starts, counts, median)
+
+
+def _nan_groups(vals, starts, counts, stat):
+    '''
+    Set `stat` to NaN for groups with a NaN. NaNs are sorted to the end of each group.
+    '''
+    return np.where(np.isnan(vals[starts + counts - 1]), np.nan, stat)
+
+
+def stream_uvdata(myvis, field_name, datacolumn='corrected', chanavg=1,
+                  corrs=['RR', 'LL'], relative_accuracy=0.01, min_count=5,
+                  memory_budget=DEFAULT_MEMORY_BUDGET, nworkers=1):
+    '''
+    Binned uv residuals per baseline and per baseline and scan, streamed from
+    the MS instead of a plotms export.
+
+    The visibilities of the field are read in chunks (see `ms_reader`), so the
+    residuals can be checked without (or with light) channel averaging in
+    bounded memory. A first pass finds the median amplitude of each SPW. A
+    second pass adds the residuals (in %) and uv-distances to quantile
+    sketches (`GroupedQuantileSketch`) per baseline and per baseline and scan.
+    Both passes are split per DATA_DESC_ID over `nworkers` processes and the
+    sketches are merged.
+
+    Parameters
+    ----------
+    myvis : str
+        MS name.
+    field_name : str
+        Field name.
+    datacolumn : str, optional
+        Data column to read.
+    chanavg : int, optional
+        Number of channels to average (vector average of the unflagged channels).
+    corrs : list, optional
+        Correlations to use.
+    relative_accuracy : float, optional
+        Relative accuracy of the residual and uv-distance quantiles.
+    min_count : int, optional
+        Groups need more than this number of points.
+    memory_budget : int, optional
+        Approximate maximum number of bytes read at once per process.
+    nworkers : int, optional
+        Number of processes.
+
+    Returns
+    -------
+    binned_dat : np.ndarray
+        Binned residuals per baseline, as from `bin_uvdata`.
+    binned_dat_perscan : np.ndarray
+        Binned residuals per baseline and scan, as from `bin_uvdata_perscan`.
+    median_flux : float
+        Median of the per-SPW median amplitudes.
+    '''
+
+    mymsmd = get_ms_metadata(myvis)
+
+    field_id = mymsmd.fieldnames().index(field_name)
+
+    field_spws = mymsmd.spwsforfield(field_id)
+    ddids = [ddid for ddid, spw in enumerate(mymsmd.meta['ddid_spw']) if spw in field_spws]
+
+    stream_kwargs = {'datacolumn': datacolumn,
+                     'chanavg': chanavg,
+                     'corrs': corrs,
+                     'memory_budget': memory_budget}
+
+    # Pass 1: median amplitude per SPW. The SPW medians set the residuals of
+    # every point, so use a finer accuracy than for the residuals.
+    work_items = [("{0} DATA_DESC_ID {1}".format(field_name, ddid),
+                   sketch_spw_amplitudes, (myvis, field_id, [ddid]), stream_kwargs)
+                  for ddid in ddids]
+
+    spw_sketch = _merge_sketch_results(run_work_items(work_items, nworkers=nworkers,
+                                                      origin='stream_uvdata'))
+
+    spws, counts, spw_medians = spw_sketch.quantiles(0.5)
+    spw_medians = dict(zip(spws.tolist(), spw_medians[0]))
+
+    # Pass 2: residuals per baseline and per baseline and scan.
+    work_items = [("{0} DATA_DESC_ID {1}".format(field_name, ddid),
+                   sketch_uv_residuals, (myvis, field_id, spw_medians, [ddid]),
+                   dict(relative_accuracy=relative_accuracy, **stream_kwargs))
+                  for ddid in ddids]
+
+    results = [result['result'] for result in run_work_items(work_items, nworkers=nworkers,
+                                                             origin='stream_uvdata')
+               if result['result'] is not None]
+
+    if len(results) == 0:
+        raise ValueError("No data streamed for field {}".format(field_name))
+
+    sketches = results[0]
+    for result in results[1:]:
+        for group_type in sketches:
+            for axis in sketches[group_type]:
+                sketches[group_type][axis].merge(result[group_type][axis])
+
+    binned_dat = bin_uvdata_sketch(sketches['baseline']['y'], sketches['baseline']['x'],
+                                   min_count=min_count)
+    binned_dat_perscan = bin_uvdata_sketch(sketches['baseline_scan']['y'],
+                                           sketches['baseline_scan']['x'],
+                                           min_count=min_count)
+
+    return binned_dat, binned_dat_perscan, np.median(list(spw_medians.values()))
+
+
+def sketch_spw_amplitudes(myvis, field_id, ddids, relative_accuracy=1e-4, **stream_kwargs):
+    '''
+    Quantile sketch of the amplitudes of one field grouped by SPW.
+    See `stream_uvdata` for the keywords.
+    '''
+
+    sketch = GroupedQuantileSketch(relative_accuracy=relative_accuracy)
+
+    for spw, chunk, amp, uvwave in _stream_amplitudes(myvis, field_id, ddids, **stream_kwargs):
+        sketch.add(np.full(amp.shape, spw), amp)
+
+    return sketch
+
+
+def sketch_uv_residuals(myvis, field_id, spw_medians, ddids, relative_accuracy=0.01,
+                        **stream_kwargs):
+    '''
+    Quantile sketches of the residuals (%) and uv-distances of one field per
+    baseline and per baseline and scan.
+
+    The baseline group is `ant1 * nant + ant2`, and the baseline and scan group
+    is `baseline * nscan + scan`, so the groups are in the same order as
+    `bin_uvdata` and `bin_uvdata_perscan`.
+
+    Returns
+    -------
+    sketches : dict
+        {'baseline': {'y': sketch, 'x': sketch}, 'baseline_scan': {'y': sketch, 'x': sketch}}
+    '''
+
+    mymsmd = get_ms_metadata(myvis)
+
+    nant = len(mymsmd.antennanames())
+    nscan = max([int(scan) for scan in mymsmd.meta['scan_fields']] + [0]) + 1
+
+    sketches = dict([(group_type, {'y': GroupedQuantileSketch(relative_accuracy=relative_accuracy),
+                                   'x': GroupedQuantileSketch(relative_accuracy=relative_accuracy)})
+                     for group_type in ['baseline', 'baseline_scan']])
+
+    for spw, chunk, amp, uvwave in _stream_amplitudes(myvis, field_id, ddids, **stream_kwargs):
+
+        resid = 100. * (amp / spw_medians[spw] - 1.)
+
+        baseline = chunk['ANTENNA1'] * nant + chunk['ANTENNA2']
+
+        groups = {'baseline': baseline,
+                  'baseline_scan': baseline * nscan + chunk['SCAN_NUMBER']}
+
+        for group_type in groups:
+            this_group = np.broadcast_to(groups[group_type][:, np.newaxis, np.newaxis], amp.shape)
+
+            sketches[group_type]['y'].add(this_group, resid)
+            # Only count the uv-distance of points with a residual.
+            sketches[group_type]['x'].add(this_group,
+                                          np.where(np.isnan(resid), np.nan, uvwave[:, :, np.newaxis]))
+
+    return sketches
+
+
+def _stream_amplitudes(myvis, field_id, ddids, datacolumn='corrected', chanavg=1,
+                       corrs=['RR', 'LL'], memory_budget=DEFAULT_MEMORY_BUDGET):
+    '''
+    Yield the SPW, the row columns, the amplitudes (nrow, nbin, ncorr) and
+    uv-distances in wavelengths (nrow, nbin) for chunks of one field.
+    Fully flagged bins are NaN.
+    '''
+
+    ms_setup = read_ms_setup(myvis)
+
+    data_column = datacolumn.upper()
+    if data_column == 'CORRECTED':
+        data_column = 'CORRECTED_DATA'
+
+    columns = ['ANTENNA1', 'ANTENNA2', 'SCAN_NUMBER', 'UVW', data_column, 'FLAG']
+
+    for ddid, rows, chunk in iter_ms_chunks(myvis, columns, taql="FIELD_ID=={}".format(field_id),
+                                            ddids=ddids, memory_budget=memory_budget):
+
+        spw = int(ms_setup['ddid_spw'][ddid])
+
+        corr_idx = [ii for ii, corr in enumerate(ms_setup['ddid_corrs'][ddid]) if corr in corrs]
+
+        data = chunk[data_column][:, :, corr_idx]
+        good = ~chunk['FLAG'][:, :, corr_idx]
+
+        nchan = data.shape[1]
+        bin_starts = np.arange(0, nchan, int(max(1, min(int(chanavg), nchan))))
+
+        nvis = np.add.reduceat(good, bin_starts, axis=1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            amp = np.abs(np.add.reduceat(np.where(good, data, 0.), bin_starts, axis=1) / nvis)
+
+        amp[nvis == 0] = np.nan
+
+        freqs = np.add.reduceat(ms_setup['chan_freqs'][spw], bin_starts) / np.diff(np.append(bin_starts, nchan))
+
+        uvdist = np.hypot(chunk['UVW'][:, 0], chunk['UVW'][:, 1])
+        uvwave = uvdist[:, np.newaxis] * freqs[np.newaxis] / CLIGHT
+
+        yield spw, chunk, amp, uvwave
+
+
+def _merge_sketch_results(results):
+    '''
+    Merge the sketches returned from `run_work_items`. Failed items are skipped.
+    '''
+
+    sketches = [result['result'] for result in results if result['result'] is not None]
+
+    if len(sketches) == 0:
+        raise ValueError("No sketches to merge.")
+
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+
+    return merged
+
+
+def bin_uvdata_sketch(y_sketch, x_sketch, min_count=5):
+    '''
+    Binned residuals from the sketches of `sketch_uv_residuals`, in the same
+    layout as `bin_uvdata`: the median x, median y and IQR-derived error of
+    every group with more than `min_count` points.
+    '''
+
+    groups, counts, (q25, q50, q75) = y_sketch.quantiles([0.25, 0.5, 0.75])
+    x_groups, x_counts, x_median = x_sketch.quantiles(0.5)
+
+    # The x sketches have the same points as the y sketches.
+    keep = counts > min_count
+
+    iqr = (1 / 1.35) * (q75 - q25)
+    bin_std = np.abs(iqr) / np.sqrt(counts)
+
+    return np.array([x_median[0][keep], q50[keep], bin_std[keep]])
 
 
 # make plots
@@ -102,130 +454,238 @@ def run_all_uvstats(myvis, out_path, uv_threshold=3, uv_nsigma=3,
                     try_phase_selfcal=True,
                     cleanup_calsplit=True,
                     cleanup_phaseselfcal=True,
-                    remake_split=True):
+                    remake_split=True,
+                    split_per_field=True,
+                    stream_kwargs=None,
+                    nworkers=1):
+    '''
+    Export, bin and plot the uv residuals of each calibrator, before and after
+    a phase-only self-calibration.
+
+    With `split_per_field=True`, the residuals before the self-calibration are
+    exported from `myvis` directly, and each field is split on its own only for
+    the self-calibration (see `uvstats_field`). The fields are independent and
+    are run over `nworkers` processes.
+
+    With `split_per_field=False`, all calibrators are first split into
+    `{out_path}/cal_fields.ms` and the fields are run in series on that MS.
+
+    With `stream_kwargs` (e.g. `{'chanavg': 64}`), the residuals are streamed
+    from the MS into quantile sketches (see `stream_uvdata`) instead of being
+    exported with plotms, so lightly averaged data can be checked.
+    '''
 
     if not os.path.isdir(out_path):
         os.mkdir(out_path)
 
-    from casatasks import split, gaincal, applycal
-    from casaplotms import plotms
+    from casatasks import split
 
-    # from taskinit import msmdtool, casalog
-    # from taskinit import msmdtool, casalog
+    mymsmd = get_ms_metadata(myvis)
 
-    from casatools import ms
+    cal_fields = np.unique(mymsmd.fieldsforintent('CALIBRATE*'))
+    field_names = mymsmd.namesforfields(cal_fields)
 
-    myms = ms()
+    # There are the flux cals which have built in models in CASA.
+    skip_fields = ['3C286', '3C48', '3C147', '3C138']
 
-    # msmd = msmdtool()
-    # get metadata
+    field_names = [field_name for field_name in field_names
+                   if not np.any([field_name in skip1 for skip1 in skip_fields])]
 
-    myms.open(myvis)
-    mymsmd = myms.metadata()
+    uvstats_kwargs = {'try_phase_selfcal': try_phase_selfcal,
+                      'cleanup_phaseselfcal': cleanup_phaseselfcal,
+                      'remake_split': remake_split,
+                      'stream_kwargs': stream_kwargs}
 
-    # mymsmd.open(myvis)
-    cal_fields = np.unique(mymsmd.fieldsforintent('CALIBRATE*'))
-    field_names = mymsmd.namesforfields(cal_fields)
-    myms.close()
+    if split_per_field:
+        uvstats_kwargs['cleanup_selfcal_vis'] = cleanup_calsplit
 
-    # split calibrator visibilities
-    field_str = ','.join([str(f) for f in cal_fields])
+    else:
+        # split calibrator visibilities
+        field_str = ','.join([str(f) for f in cal_fields])
 
-    output_cal_ms = out_path + '/cal_fields.ms'
+        output_cal_ms = out_path + '/cal_fields.ms'
 
-    if os.path.exists(output_cal_ms) and remake_split:
-        os.system('rm -r {0}'.format(output_cal_ms))
+        if os.path.exists(output_cal_ms) and remake_split:
+            os.system('rm -r {0}'.format(output_cal_ms))
 
-    if not os.path.exists(output_cal_ms):
-        split(vis=myvis, field=field_str,
-              keepflags=True, timebin='0s', outputvis=output_cal_ms)
+        if not os.path.exists(output_cal_ms):
+            split(vis=myvis, field=field_str,
+                  keepflags=True, timebin='0s', outputvis=output_cal_ms)
 
-    # There are the flux cals which have built in models in CASA.
-    skip_fields = ['3C286', '3C48', '3C147', '3C138']
+        # The split MS has the corrected data in DATA. All fields
+        # write to this MS so they cannot run in parallel.
+        myvis = output_cal_ms
+        uvstats_kwargs['datacolumn'] = 'data'
+        uvstats_kwargs['selfcal_vis'] = output_cal_ms
 
-    gaincal_tables = []
+        nworkers = 1
 
-    for field_name in field_names:
+    work_items = [("field {}".format(field_name), uvstats_field,
+                   (myvis, field_name, out_path), uvstats_kwargs)
+                  for field_name in field_names]
 
-        if np.any([field_name in skip1 for skip1 in skip_fields]):
-            continue
+    results = run_work_items(work_items, nworkers=nworkers,
+                             log_prefix=os.path.join(out_path, "run_all_uvstats") if nworkers > 1 else None,
+                             origin='run_all_uvstats')
 
-        plotms_outfile = out_path + '/plotms_amp_uvwave_field_{0}.txt'.format(field_name)
-        casalog.post(message='Exporting from plotms: {0}'.format(plotms_outfile), origin='run_all_uvstats')
+    # Delete calibrator split
+    if not split_per_field and cleanup_calsplit:
+        os.system("rm -r {}".format(output_cal_ms))
+        os.system("rm -r {}.flagversions".format(output_cal_ms))
 
-        if not os.path.exists(plotms_outfile):
-            plotms(vis=out_path + '/cal_fields.ms',
-                field=field_name, xaxis='UVwave', yaxis='Amp', ydatacolumn='data',
-                averagedata=True, scalar=False,
-                avgchannel='4096', avgtime='1000', avgscan=False,
-                correlation='RR,LL', plotfile=plotms_outfile, showgui=False, overwrite=True)
-        else:
-            casalog.post(message='File {0} already exists. Skipping'.format(plotms_outfile), origin='run_all_uvstats')
+    return results
+
+
+def uvstats_field(myvis, field_name, out_path, datacolumn='corrected',
+                  selfcal_vis=None, try_phase_selfcal=True,
+                  cleanup_selfcal_vis=True, cleanup_phaseselfcal=True,
+                  remake_split=True, stream_kwargs=None):
+    '''
+    Export, bin and plot the uv residuals of one calibrator, then repeat on the
+    corrected data after a phase-only self-calibration.
+
+    Parameters
+    ----------
+    myvis : str
+        MS to export the residuals before the self-calibration from.
+    field_name : str
+        Calibrator field name.
+    out_path : str
+        Output folder.
+    datacolumn : str, optional
+        Data column in `myvis` with the calibrated data.
+    selfcal_vis : str, optional
+        MS to self-calibrate. When None, only this field is split from `myvis`
+        into `{out_path}/cal_field_{field_name}.ms`.
+    try_phase_selfcal : bool, optional
+        Run the phase-only self-calibration.
+    cleanup_selfcal_vis : bool, optional
+        Remove the per-field split when finished. Only used when `selfcal_vis` is None.
+    cleanup_phaseselfcal : bool, optional
+        Remove the gain table when finished.
+    remake_split : bool, optional
+        Remake an existing per-field split.
+    stream_kwargs : dict, optional
+        Stream the residuals with `stream_uvdata` and these keywords instead of
+        exporting with plotms.
+
+    Returns
+    -------
+    plotted : list
+        The names of the binned and plotted data (the plotms text exports, or the
+        names the figures are based on when streaming).
+    '''
 
-        infile = out_path + '/plotms_amp_uvwave_field_{0}.txt'.format(field_name)
-        casalog.post(message='Analyzing UV stats for {0}'.format(infile), origin='run_all_uvstats')
+    from casatasks import split, gaincal, applycal
 
-        # Read in txt from plotms
-        dat, median_flux = get_uvdata(infile)
-        # n_scans = len(np.unique(dat['scan']))
-        binned_dat = bin_uvdata(dat)
-        binned_dat_perscan = bin_uvdata_perscan(dat)
-        if binned_dat.shape[1] == 0:
-            continue
-        if binned_dat_perscan.shape[1] == 0:
-            continue
-        plot_uvdata_perscan(binned_dat_perscan, binned_dat, infile, bin_type='combined')
+    plotted = []
 
-        # try phase-only selfcal
-        if try_phase_selfcal:
+    prefix = 'plotms' if stream_kwargs is None else 'stream'
 
-            gaincal_table = out_path + '/cal_field_{0}.g'.format(field_name)
+    plotms_outfile = out_path + '/{0}_amp_uvwave_field_{1}.txt'.format(prefix, field_name)
 
-            try:
-                gaincal(vis=output_cal_ms,
-                        caltable=gaincal_table,
-                        field=field_name, solint='int', refant='', calmode='p')
-                applycal(vis=output_cal_ms,
-                         gaintable=gaincal_table,
-                         field=field_name, calwt=False)
+    if not _uvstats(myvis, field_name, plotms_outfile, datacolumn, stream_kwargs):
+        return plotted
 
-                gaincal_tables.append(gaincal_table)
+    plotted.append(plotms_outfile)
 
-                plotms_outfile = out_path + '/plotms_amp_uvwave_cal_field_{0}.txt'.format(field_name)
-                casalog.post(message='Exporting from plotms: {0}'.format(plotms_outfile), origin='run_all_uvstats')
+    # try phase-only selfcal
+    if not try_phase_selfcal:
+        return plotted
 
-                if not os.path.exists(plotms_outfile):
+    split_field = selfcal_vis is None
 
-                    plotms(vis=output_cal_ms, field=field_name, xaxis='UVwave', yaxis='Amp',
-                        ydatacolumn='corrected', averagedata=True,
-                        scalar=False, avgchannel='4096', avgtime='1000', avgscan=False,
-                        correlation='RR,LL', plotfile=plotms_outfile, showgui=False, overwrite=True)
+    if split_field:
+        selfcal_vis = out_path + '/cal_field_{0}.ms'.format(field_name)
 
-                else:
-                    casalog.post(message='File {0} already exists. Skipping'.format(plotms_outfile), origin='run_all_uvstats')
+        if os.path.exists(selfcal_vis) and remake_split:
+            os.system('rm -r {0}'.format(selfcal_vis))
 
-                infile = out_path + '/plotms_amp_uvwave_cal_field_{0}.txt'.format(field_name)
-                casalog.post(message='Analyzing UV stats for {0}'.format(infile), origin='run_all_uvstats')
+        if not os.path.exists(selfcal_vis):
+            split(vis=myvis, field=field_name, datacolumn=datacolumn,
+                  keepflags=True, timebin='0s', outputvis=selfcal_vis)
 
-                dat, median_flux = get_uvdata(infile)
-                # n_scans = len(np.unique(dat['scan']))
-                binned_dat = bin_uvdata(dat)
-                binned_dat_perscan = bin_uvdata_perscan(dat)
-                if binned_dat.shape[1] == 0:
-                    continue
-                if binned_dat_perscan.shape[1] == 0:
-                    continue
-                plot_uvdata_perscan(binned_dat_perscan, binned_dat, infile, bin_type='combined')
+    gaincal_table = out_path + '/cal_field_{0}.g'.format(field_name)
 
-            except:
-                casalog.post(message='Problem calibrating field {0}'.format(field_name), origin='run_all_uvstats')
+    try:
+        gaincal(vis=selfcal_vis,
+                caltable=gaincal_table,
+                field=field_name, solint='int', refant='', calmode='p')
+        applycal(vis=selfcal_vis,
+                 gaintable=gaincal_table,
+                 field=field_name, calwt=False)
 
-    # Delete calibrator split
-    if cleanup_calsplit:
-        os.system("rm -r {}".format(output_cal_ms))
-        os.system("rm -r {}.flagversions".format(output_cal_ms))
+        plotms_outfile = out_path + '/{0}_amp_uvwave_cal_field_{1}.txt'.format(prefix, field_name)
+
+        if _uvstats(selfcal_vis, field_name, plotms_outfile, 'corrected', stream_kwargs):
+            plotted.append(plotms_outfile)
+
+    except Exception:
+        casalog.post(message='Problem calibrating field {0}'.format(field_name), origin='uvstats_field')
+
+    if split_field and cleanup_selfcal_vis:
+        os.system("rm -r {}".format(selfcal_vis))
+        os.system("rm -r {}.flagversions".format(selfcal_vis))
 
     # Delete gaincal tables
     if cleanup_phaseselfcal:
-        for gaincal_table in gaincal_tables:
-            os.system("rm -r {}".format(gaincal_table))
+        os.system("rm -r {}".format(gaincal_table))
+
+    return plotted
+
+
+def _uvstats(vis, field_name, plotms_outfile, ydatacolumn, stream_kwargs=None):
+    '''
+    Bin and plot the residuals of one field, from a plotms export or streamed
+    from the MS (with `stream_kwargs`). Returns False when there are no binned
+    points to plot.
+    '''
+
+    if stream_kwargs is None:
+        return _uvstats_from_plotms(vis, field_name, plotms_outfile, ydatacolumn)
+
+    casalog.post(message='Streaming UV stats for {0}'.format(field_name), origin='run_all_uvstats')
+
+    binned_dat, binned_dat_perscan, median_flux = \
+        stream_uvdata(vis, field_name, datacolumn=ydatacolumn, **stream_kwargs)
+
+    if binned_dat.shape[1] == 0 or binned_dat_perscan.shape[1] == 0:
+        return False
+
+    plot_uvdata_perscan(binned_dat_perscan, binned_dat, plotms_outfile, bin_type='combined')
+
+    return True
+
+
+def _uvstats_from_plotms(vis, field_name, plotms_outfile, ydatacolumn):
+    '''
+    Export amp vs. uvwave for one field, then bin and plot the residuals.
+    Returns False when there are no binned points to plot.
+    '''
+
+    from casaplotms import plotms
+
+    casalog.post(message='Exporting from plotms: {0}'.format(plotms_outfile), origin='run_all_uvstats')
+
+    if not os.path.exists(plotms_outfile):
+        plotms(vis=vis,
+               field=field_name, xaxis='UVwave', yaxis='Amp', ydatacolumn=ydatacolumn,
+               averagedata=True, scalar=False,
+               avgchannel='4096', avgtime='1000', avgscan=False,
+               correlation='RR,LL', plotfile=plotms_outfile, showgui=False, overwrite=True)
+    else:
+        casalog.post(message='File {0} already exists. Skipping'.format(plotms_outfile), origin='run_all_uvstats')
+
+    casalog.post(message='Analyzing UV stats for {0}'.format(plotms_outfile), origin='run_all_uvstats')
+
+    # Read in txt from plotms
+    dat, median_flux = get_uvdata(plotms_outfile)
+    binned_dat = bin_uvdata(dat)
+    binned_dat_perscan = bin_uvdata_perscan(dat)
+
+    if binned_dat.shape[1] == 0 or binned_dat_perscan.shape[1] == 0:
+        return False
+
+    plot_uvdata_perscan(binned_dat_perscan, binned_dat, plotms_outfile, bin_type='combined')
+
+    return True
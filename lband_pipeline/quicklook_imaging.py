@@ -6,18 +6,19 @@ import numpy as np
 from casatasks import (tclean, rmtables, exportfits, apparentsens)
 
 from casatools import logsink
-from casatools import ms
 from casatools import imager
 from casatools import synthesisutils
-from casatools import msmetadata
 
 casalog = logsink()
 
-from lband_pipeline.spw_setup import linerest_dict_GHz
+from lband_pipeline.spw_setup import line_catalogue
 
 # from lband_pipeline.target_setup import (target_line_range_kms,
 #                                          target_vsys_kms)
 from lband_pipeline.read_config_files import read_target_vsys_cfg, read_targets_vrange_cfg
+from lband_pipeline.product_cache import (ProductManifest, make_cache_key,
+                                          ms_fingerprint)
+from lband_pipeline.ms_metadata import get_ms_metadata
 
 
 def cleanup_misc_quicklook(filename, remove_residual=True,
@@ -42,6 +43,29 @@ def cleanup_misc_quicklook(filename, remove_residual=True,
         rmtables(f"{filename}.image")
 
 
+def _quicklook_products(imagename, export_fits=True):
+    '''
+    Products recorded in the cache for one quicklook image.
+    '''
+
+    if export_fits:
+        return [f"{imagename}.image.fits", f"{imagename}.empty"]
+
+    return [f"{imagename}.image", f"{imagename}.empty"]
+
+
+def _record_quicklook(manifest, imagename, image_key, export_fits=True):
+    '''
+    Record a finished (or empty) quicklook image in the cache manifest.
+    '''
+
+    for product in _quicklook_products(imagename, export_fits=export_fits):
+        manifest.record(product, image_key)
+
+    # Save after each image so a failed run can restart where it stopped.
+    manifest.save()
+
+
 def quicklook_line_imaging(myvis, thisgal, linespw_dict,
                            nchan_vel=5,
                            # channel_width_kms=20.,
@@ -51,7 +75,14 @@ def quicklook_line_imaging(myvis, thisgal, linespw_dict,
                            export_fits=True,
                            target_vsys_kms=None,
                            target_line_range_kms=None,
-                           calc_apparentsens=False):
+                           calc_apparentsens=False,
+                           use_cache=True):
+    '''
+    Per-SPW and per-line dirty cubes of the targets.
+
+    With `use_cache=True`, existing images are remade when the MS flags or data
+    have changed since they were made (see `lband_pipeline.product_cache`).
+    '''
 
     if target_vsys_kms is None:
         # Will read from config file defined in `config_files/master_config.cfg`
@@ -105,19 +136,16 @@ def quicklook_line_imaging(myvis, thisgal, linespw_dict,
 
     synthutil = synthesisutils()
 
-    myms = ms()
+    mymsmd = get_ms_metadata(myvis)
 
     # if no fields are provided use observe_target intent
     # I saw once a calibrator also has this intent so check carefully
-    # mymsmd.open(vis)
-    myms.open(myvis)
-
-    mymsmd = myms.metadata()
-
     target_fields = mymsmd.fieldsforintent("*TARGET*", True)
 
-    mymsmd.close()
-    myms.close()
+    if use_cache:
+        manifest = ProductManifest.for_folder("quicklook_imaging")
+        ms_key = ms_fingerprint(myvis)
+        image_keys = {}
 
     # record expected sensitivity
     exp_sens = {}
@@ -145,6 +173,17 @@ def quicklook_line_imaging(myvis, thisgal, linespw_dict,
 
             this_imagename = f"quicklook_imaging/quicklook-{target_field_label}-spw{thisspw}-{line_name}-{myvis}"
 
+            if use_cache:
+                image_key = make_cache_key(ms=ms_key, field=target_field, spw=thisspw,
+                                           line=line_name, nchan_vel=nchan_vel,
+                                           start=start_vel, width=width_vel_str,
+                                           niter=niter, nsigma=nsigma, imsize_max=imsize_max)
+                image_keys[this_imagename] = image_key
+
+                # Remove images made from different inputs (e.g., before re-flagging)
+                manifest.remove_stale(_quicklook_products(this_imagename, export_fits=export_fits),
+                                      image_key)
+
             if export_fits:
                 check_exists = os.path.exists(f"{this_imagename}.image.fits")
             else:
@@ -178,14 +217,16 @@ def quicklook_line_imaging(myvis, thisgal, linespw_dict,
                 casalog.post(f"All data flagged for {this_imagename}. Skipping")
                 # Write out an empty file so we skip this one from additional uv checks
                 os.system(f"touch {this_imagename}.empty")
+
+                if use_cache:
+                    _record_quicklook(manifest, this_imagename, image_keys[this_imagename],
+                                      export_fits=export_fits)
+
                 continue
 
             # For the image size, we will do an approx scaling was
             # theta_PB = 45 / nu (arcmin)
-            this_msmd = msmetadata()
-            this_msmd.open(myvis)
-            mean_freq = this_msmd.chanfreqs(int(thisspw)).mean() / 1.e9 # Hz to GHz
-            this_msmd.close()
+            mean_freq = mymsmd.chanfreqs(int(thisspw)).mean() / 1.e9 # Hz to GHz
 
             approx_pbsize = 1.2 * (45. / mean_freq) * 60 # arcsec
             approx_imsize = synthutil.getOptimumSize(int(approx_pbsize / image_settings[2]['value']))
@@ -250,7 +291,7 @@ def quicklook_line_imaging(myvis, thisgal, linespw_dict,
                    niter=this_niter,
                    nsigma=this_nsigma,
                    imagename=this_imagename,
-                   restfreq=f"{linerest_dict_GHz[line_name]}GHz",
+                   restfreq=f"{line_catalogue[line_name]}GHz",
                    pblimit=this_pblim)
 
             # Estimate the expected sensitivity
@@ -268,7 +309,7 @@ def quicklook_line_imaging(myvis, thisgal, linespw_dict,
                 # width used.
                 bandwidth = linespw_dict[int(thisspw)]['bandwidth'] / 1.e9
                 # v / c in km/s
-                width_freq = (width_vel / 3.e5) * linerest_dict_GHz[line_name]
+                width_freq = (width_vel / 3.e5) * line_catalogue[line_name]
                 chan_to_bandwidth_ratio = width_freq / bandwidth
 
                 exp_sens[f"{target_field_label}-spw{thisspw}"] = \
@@ -288,6 +329,10 @@ def quicklook_line_imaging(myvis, thisgal, linespw_dict,
                                     remove_residual=this_niter == 0,
                                     remove_image=True if export_fits else False)
 
+            if use_cache:
+                _record_quicklook(manifest, this_imagename, image_keys[this_imagename],
+                                  export_fits=export_fits)
+
     # Save the dictionary of expected sensitivity
     if calc_apparentsens:
         np.save(f"quicklook_imaging/expected_sensitivity_dict.npy", exp_sens,
@@ -304,9 +349,13 @@ def quicklook_continuum_imaging(myvis, contspw_dict,
                                 overwrite_imaging=False,
                                 export_fits=True,
                                 calc_apparentsens=False,
-                                only_continuum_spws=True):
+                                only_continuum_spws=True,
+                                use_cache=True):
     '''
     Per-SPW MFS, nterm=1, dirty images of the targets
+
+    With `use_cache=True`, existing images are remade when the MS flags or data
+    have changed since they were made (see `lband_pipeline.product_cache`).
     '''
 
     if not os.path.exists("quicklook_imaging"):
@@ -329,19 +378,16 @@ def quicklook_continuum_imaging(myvis, contspw_dict,
 
     synthutil = synthesisutils()
 
-    myms = ms()
+    mymsmd = get_ms_metadata(myvis)
 
     # if no fields are provided use observe_target intent
     # I saw once a calibrator also has this intent so check carefully
-    # mymsmd.open(vis)
-    myms.open(myvis)
-
-    mymsmd = myms.metadata()
-
     target_fields = mymsmd.fieldsforintent("*TARGET*", True)
 
-    mymsmd.close()
-    myms.close()
+    if use_cache:
+        manifest = ProductManifest.for_folder("quicklook_imaging")
+        ms_key = ms_fingerprint(myvis)
+        image_keys = {}
 
     # record expected sensitivity
     exp_sens = {}
@@ -367,6 +413,15 @@ def quicklook_continuum_imaging(myvis, contspw_dict,
 
             this_imagename = f"quicklook_imaging/quicklook-{target_field_label}-spw{thisspw}-continuum-{myvis}"
 
+            if use_cache:
+                image_key = make_cache_key(ms=ms_key, field=target_field, spw=thisspw,
+                                           niter=niter, nsigma=nsigma, imsize_max=imsize_max)
+                image_keys[this_imagename] = image_key
+
+                # Remove images made from different inputs (e.g., before re-flagging)
+                manifest.remove_stale(_quicklook_products(this_imagename, export_fits=export_fits),
+                                      image_key)
+
             if export_fits:
                 check_exists = os.path.exists(f"{this_imagename}.image.fits")
             else:
@@ -399,14 +454,16 @@ def quicklook_continuum_imaging(myvis, contspw_dict,
                 casalog.post(f"All data flagged for {this_imagename}. Skipping")
                 # Write out an empty file so we skip this one from additional uv checks
                 os.system(f"touch {this_imagename}.empty")
+
+                if use_cache:
+                    _record_quicklook(manifest, this_imagename, image_keys[this_imagename],
+                                      export_fits=export_fits)
+
                 continue
 
             # For the image size, we will do an approx scaling was
             # theta_PB = 45 / nu (arcmin)
-            this_msmd = msmetadata()
-            this_msmd.open(myvis)
-            mean_freq = this_msmd.chanfreqs(int(thisspw)).mean() / 1.e9 # Hz to GHz
-            this_msmd.close()
+            mean_freq = mymsmd.chanfreqs(int(thisspw)).mean() / 1.e9 # Hz to GHz
 
             approx_pbsize = 1.2 * (45. / mean_freq) * 60 # arcsec
             approx_imsize = synthutil.getOptimumSize(int(approx_pbsize / image_settings[2]['value']))
@@ -497,6 +554,10 @@ def quicklook_continuum_imaging(myvis, contspw_dict,
                                     remove_residual=this_niter == 0,
                                     remove_image=True if export_fits else False)
 
+            if use_cache:
+                _record_quicklook(manifest, this_imagename, image_keys[this_imagename],
+                                  export_fits=export_fits)
+
     # Save the dictionary of expected sensitivity
     if calc_apparentsens:
         np.save(f"quicklook_imaging/expected_sensitivity_dict.npy", exp_sens,
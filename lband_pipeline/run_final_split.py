@@ -2,10 +2,8 @@
 import sys
 import os
 
-import numpy as np
-
 from lband_pipeline.ms_split_tools import split_ms_final_all
-from lband_pipeline.spw_setup import create_spw_dict
+from lband_pipeline.spw_setup import create_spw_dict, load_spw_dict
 
 
 mySDM = sys.argv[-1]
@@ -13,10 +11,10 @@ myvis = mySDM if mySDM.endswith("ms") else mySDM + ".ms"
 
 output_path = sys.argv[-2]
 
-spwdict_filename = "spw_definitions.npy"
+spwdict_filename = "spw_definitions.json"
 
 if os.path.exists(spwdict_filename):
-    spw_dict = np.load(spwdict_filename, allow_pickle=True).item()
+    spw_dict = load_spw_dict(spwdict_filename)
 else:
     spw_dict = create_spw_dict(myvis, save_spwdict=False)
 
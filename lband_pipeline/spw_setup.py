@@ -12,12 +12,22 @@ Currently only tested for 20A-346, 13A-213 (NGC6822 track).
 
 '''
 
+import re
+import json
+import hashlib
 import numpy as np
 import os
 
+from casatools import logsink
+
 from lband_pipeline.line_tools.line_flagging import lines_rest2obs
+from lband_pipeline.ms_metadata import get_ms_metadata
+from lband_pipeline.product_cache import table_checksum, make_cache_key
 from lband_pipeline.read_config_files import read_target_vsys_cfg
 
+casalog = logsink()
+
+
 # This is all lines in L-band that we care about
 # Most of the RRLs aren't observed, this is just complete
 # so every choice is always available to match.
@@ -67,32 +77,275 @@ linerest_dict_GHz = {"HI": 1.420405752,
                      }
 
 
+class LineCatalogue(object):
+    '''
+    Rest frequencies of spectral lines, sorted in frequency so the lines within
+    many frequency ranges are found by binary search. This scales to catalogues
+    of thousands of lines (e.g., all RRLs, OH and molecular lines).
+
+    Matches are returned in the order the lines were given, which sets the SPW
+    labels (e.g., "OH1665-OH1667").
+
+    Parameters
+    ----------
+    line_freqs_GHz : dict
+        Rest frequency (GHz) of each line name.
+    species : dict, optional
+        Species of each line name, used to match the velocity ranges in
+        the target config files (e.g., "OH" for "OH1612"). Default is the
+        leading letters of the line name.
+    '''
+
+    def __init__(self, line_freqs_GHz, species=None):
+
+        names = list(line_freqs_GHz)
+
+        if species is None:
+            species = dict([(name, re.match(r"[A-Za-z]*", name).group()) for name in names])
+
+        restfreqs = np.array([line_freqs_GHz[name] for name in names], dtype=float)
+
+        order = np.argsort(restfreqs, kind='stable')
+
+        self.names = np.array(names)[order]
+        self.restfreqs = restfreqs[order]
+        self.species = np.array([species[name] for name in names])[order]
+        # Position of each line in the input, for ordering matches.
+        self.input_order = order
+
+        self._line_index = dict([(name, ii) for ii, name in enumerate(self.names)])
+
+    def __len__(self):
+        return self.names.size
+
+    def __contains__(self, name):
+        return name in self._line_index
+
+    def __getitem__(self, name):
+        '''
+        Rest frequency (GHz) of a line.
+        '''
+        return float(self.restfreqs[self._line_index[name]])
+
+    def checksum(self):
+        '''
+        Checksum of the line names, rest frequencies and species, in the input
+        order. Used to key products that depend on the line matching.
+        '''
+
+        order = np.argsort(self.input_order, kind='stable')
+
+        lines = [[str(name), float(freq), str(species)]
+                 for name, freq, species in zip(self.names[order], self.restfreqs[order],
+                                                self.species[order])]
+
+        return hashlib.sha1(json.dumps(lines).encode()).hexdigest()
+
+    def _matches(self, start, stop, mask=None):
+        '''
+        Names of the sorted lines in [start, stop), in the input order.
+        '''
+
+        index = np.arange(start, max(start, stop))
+
+        if mask is not None:
+            index = index[mask[index]]
+
+        return list(self.names[index[np.argsort(self.input_order[index], kind='stable')]])
+
+    def lines_in_ranges(self, fmins, fmaxs, vsys=0.):
+        '''
+        Lines with an observed frequency strictly within each frequency range.
+
+        Parameters
+        ----------
+        fmins, fmaxs : np.ndarray
+            Lower and upper frequencies (Hz) of each range.
+        vsys : float, optional
+            Systemic velocity (km/s; radio) used to shift the rest frequencies.
+
+        Returns
+        -------
+        matches : list
+            List of the matching line names for each range.
+        '''
+
+        obsfreqs = lines_rest2obs(self.restfreqs, vsys) * 1e9
+
+        starts = np.searchsorted(obsfreqs, fmins, side='right')
+        stops = np.searchsorted(obsfreqs, fmaxs, side='left')
+
+        return [self._matches(start, stop) for start, stop in zip(np.atleast_1d(starts),
+                                                                   np.atleast_1d(stops))]
+
+    def lines_overlapping(self, fmin, fmax, vel_range, species=None):
+        '''
+        Lines whose observed frequencies over a velocity range overlap
+        [fmin, fmax].
+
+        Parameters
+        ----------
+        fmin, fmax : float
+            Frequency range (Hz).
+        vel_range : list
+            Start and stop velocities (km/s; radio).
+        species : str, optional
+            Only return lines of this species (e.g., "HI" or "OH") or with this name.
+
+        Returns
+        -------
+        names : list
+            Matching line names.
+        freq_ranges : np.ndarray
+            Observed frequencies (Hz) of the start and stop velocities of each line.
+        '''
+
+        restfreqs = self.restfreqs * 1e9
+
+        obs_starts = lines_rest2obs(restfreqs, vel_range[0])
+        obs_stops = lines_rest2obs(restfreqs, vel_range[1])
+
+        # Both are sorted, so the overlapping lines are a contiguous block.
+        # Lines that overlap have obs_start <= fmax and obs_stop >= fmin.
+        start = np.searchsorted(obs_stops, fmin, side='left')
+        stop = np.searchsorted(obs_starts, fmax, side='right')
+
+        mask = None if species is None else (self.species == species) | (self.names == species)
+
+        names = self._matches(start, stop, mask=mask)
+
+        index = [self._line_index[name] for name in names]
+
+        return names, np.vstack([obs_starts[index], obs_stops[index]]).T
+
+
+# Catalogue of the lines above, shared by the SPW setup, cont.dat and imaging.
+line_catalogue = LineCatalogue(linerest_dict_GHz)
+
+
+# Sub-tables that define the SPW dict. The target field sets the line matching.
+SPW_DICT_SUBTABLES = ['SPECTRAL_WINDOW', 'FIELD']
+
+
+def spw_dict_cache_filename(myvis):
+    '''
+    Name of the SPW dict saved next to the MS.
+    '''
+    return "{}.spw_definitions.json".format(myvis.rstrip("/"))
+
+
+def spw_dict_cache_key(myvis, **kwargs):
+    '''
+    Key of the SPW dict from the checksums of the SPECTRAL_WINDOW and FIELD
+    tables, the line catalogue and the `create_spw_dict` arguments. Only the
+    sub-table files are read.
+    '''
+
+    checksums = dict([(subtable, table_checksum(os.path.join(myvis, subtable)))
+                      for subtable in SPW_DICT_SUBTABLES])
+
+    return make_cache_key(checksums=checksums,
+                          line_catalogue=line_catalogue.checksum(),
+                          **kwargs)
+
+
+def save_spw_dict(filename, spw_dict, key=None):
+    '''
+    Save the SPW dict as JSON. The file is replaced atomically.
+    '''
+
+    spws = {}
+    for spwid in spw_dict:
+        spws[str(spwid)] = dict([(name, value.item() if isinstance(value, np.generic) else value)
+                                 for name, value in spw_dict[spwid].items()])
+
+    tmp_filename = "{}.tmp".format(filename)
+
+    with open(tmp_filename, 'w') as spw_file:
+        json.dump({'key': key, 'spws': spws}, spw_file, indent=1)
+
+    os.replace(tmp_filename, filename)
+
+
+def load_spw_dict(filename, key=None):
+    '''
+    Load a SPW dict saved with `save_spw_dict`. Returns None when `key` is
+    given and does not match the saved key.
+    '''
+
+    with open(filename, 'r') as spw_file:
+        saved = json.load(spw_file)
+
+    if key is not None and saved.get('key') != key:
+        return None
+
+    return dict([(int(spwid), saved['spws'][spwid]) for spwid in saved['spws']])
+
+
 def create_spw_dict(myvis,
                     continuum_only=False,
                     target_vsys_kms=None,
                     min_continuum_chanwidth_kHz=50,
                     save_spwdict=False,
-                    spwdict_filename="spw_definitions.npy",
-                    allow_failed_line_identification=True):
+                    spwdict_filename="spw_definitions.json",
+                    allow_failed_line_identification=True,
+                    use_cache=True):
     '''
     Create the SPW dict from MS metadata. Split based on continuum and
     use the line dictionary to match line identifications.
+
+    With `use_cache=True`, the SPW dict is saved next to the MS (see
+    `spw_dict_cache_filename`) and loaded from there while the SPECTRAL_WINDOW
+    and FIELD tables and the arguments are unchanged, so the MS is not opened.
+    With `save_spwdict=True`, a copy is also written to `spwdict_filename` as JSON.
     '''
 
     if target_vsys_kms is None and not continuum_only:
         # Will read from config file defined in `config_files/master_config.cfg`
         target_vsys_kms = read_target_vsys_cfg(filename=None)
 
-    from casatools import ms
+    spw_dict = None
+
+    if use_cache:
+        cache_filename = spw_dict_cache_filename(myvis)
 
-    myms = ms()
-    myms.open(myvis)
+        cache_key = spw_dict_cache_key(myvis,
+                                       continuum_only=continuum_only,
+                                       target_vsys_kms=target_vsys_kms,
+                                       min_continuum_chanwidth_kHz=min_continuum_chanwidth_kHz,
+                                       allow_failed_line_identification=allow_failed_line_identification)
 
-    metadata = myms.metadata()
+        if os.path.exists(cache_filename):
+            spw_dict = load_spw_dict(cache_filename, key=cache_key)
 
-    # metadata = msmdtool()
+    if spw_dict is None:
+        spw_dict = _build_spw_dict(myvis,
+                                   continuum_only=continuum_only,
+                                   target_vsys_kms=target_vsys_kms,
+                                   min_continuum_chanwidth_kHz=min_continuum_chanwidth_kHz,
+                                   allow_failed_line_identification=allow_failed_line_identification)
+
+        if use_cache:
+            try:
+                save_spw_dict(cache_filename, spw_dict, key=cache_key)
+            except OSError:
+                casalog.post(message="Unable to save the SPW dict next to {}".format(myvis),
+                             origin='create_spw_dict', priority='WARN')
+
+    if save_spwdict:
+        save_spw_dict(spwdict_filename, spw_dict)
+
+    return spw_dict
+
+
+def _build_spw_dict(myvis, continuum_only, target_vsys_kms,
+                    min_continuum_chanwidth_kHz, allow_failed_line_identification):
+    '''
+    Build the SPW dict from the MS metadata. See `create_spw_dict`.
+    '''
 
-    # metadata.open(myvis)
+    # Field, scan and SPW info from the persistent metadata index.
+    metadata = get_ms_metadata(myvis)
 
     spw_dict = {}
 
@@ -108,7 +361,6 @@ def create_spw_dict(myvis,
     # Some of the archival data has a setup scan labeled as a target.
     # Because of this, we will loop through targets until we find one defined
     # in our target dictionary.
-    lineobs_dict_GHz = {}
 
     if not continuum_only:
         for targ_scan in science_scans:
@@ -133,10 +385,17 @@ def create_spw_dict(myvis,
         # multiple target galaxies.
         # np.array(metadata.fieldnames())[metadata.fieldsforintent("*TARGET*")]
 
-        # Convert rest to observed based on the target
-        for line in linerest_dict_GHz:
+    # Match the lines to all SPWs at once, with the rest frequencies shifted to the target.
+    spw_line_matches = {}
+
+    if gal_vsys is not None:
+        freqs_lsrk_all = [metadata.chanfreqs(spwid, frame='LSRK') for spwid in spw_ids]
+
+        line_matches = line_catalogue.lines_in_ranges([freqs.min() for freqs in freqs_lsrk_all],
+                                                      [freqs.max() for freqs in freqs_lsrk_all],
+                                                      vsys=gal_vsys)
 
-            lineobs_dict_GHz[line] = lines_rest2obs(linerest_dict_GHz[line], gal_vsys)
+        spw_line_matches = dict(zip(spw_ids, line_matches))
 
     # Counters for continuum windows in basebands A0C0, B0D0.
     cont_A_count = 0
@@ -159,8 +418,8 @@ def create_spw_dict(myvis,
 
         # Centre freq.
         # ctr_freq = metadata.chanfreqs
-        freqs_lsrk = myms.cvelfreqs(spwids=[spwid], outframe='LSRK')
-        freqs_topo = myms.cvelfreqs(spwids=[spwid], outframe='TOPO')
+        freqs_lsrk = metadata.chanfreqs(spwid, frame='LSRK')
+        freqs_topo = metadata.chanfreqs(spwid, frame='TOPO')
 
         # Convert from Hz to kHz
         ctr_freq = freqs_lsrk[nchan // 2 - 1] / 1e3
@@ -192,15 +451,7 @@ def create_spw_dict(myvis,
         # Otherwise do a line match
         else:
 
-            line_match = []
-
-            for line in lineobs_dict_GHz:
-
-                obs_freq = lineobs_dict_GHz[line] * 1e9
-
-                if obs_freq > freqs_lsrk.min() and obs_freq < freqs_lsrk.max():
-
-                    line_match.append(line)
+            line_match = spw_line_matches.get(spwid, [])
 
             if len(line_match) == 0:
                 if allow_failed_line_identification:
@@ -220,16 +471,6 @@ def create_spw_dict(myvis,
                            'baseband': bband,
                            'freq_0_topo': freq_0_topo}
 
-    myms.close()
-
-    if save_spwdict:
-        # Remove existing saved file
-        if os.path.exists(spwdict_filename):
-            os.remove(spwdict_filename)
-
-        # Save a pickled version of the dictionary as a npy file
-        np.save(spwdict_filename, spw_dict)
-
     return spw_dict
 
 
@@ -12,6 +12,7 @@ smaller range to be flagged instead of the whole galaxy range (e.g., M31).
 '''
 
 from lband_pipeline.read_config_files import read_target_vsys_cfg
+from lband_pipeline.ms_metadata import get_ms_metadata
 
 from casatools import logsink
 
@@ -27,22 +28,10 @@ def identify_target(vis, fields=None, raise_missing_target=True):
     if fields is None:
         fields = []
 
-    from casatools import ms
-
-    myms = ms()
-
     # if no fields are provided use observe_target intent
     # I saw once a calibrator also has this intent so check carefully
-    # mymsmd.open(vis)
-    myms.open(vis)
-
-    mymsmd = myms.metadata()
-
     if len(fields) < 1:
-        fields = mymsmd.fieldsforintent("*TARGET*", True)
-
-    mymsmd.close()
-    myms.close()
+        fields = get_ms_metadata(vis).fieldsforintent("*TARGET*", True)
 
     if len(fields) < 1:
         casalog.post("ERROR: no fields given to identify.")
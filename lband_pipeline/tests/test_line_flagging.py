@@ -0,0 +1,84 @@
+
+import numpy as np
+
+from lband_pipeline.line_tools.line_flagging import partition_cont_range
+
+
+def partition_cont_range_loops(line_freqs, spw_start, spw_end):
+    '''
+    The original chunk-editing implementation, kept as the reference.
+    '''
+
+    line_freqs = np.array(line_freqs)
+
+    line_starts = line_freqs[:, 0]
+    line_ends = line_freqs[:, 1]
+
+    cont_chunks = [dict(start=spw_start, end=spw_end)]
+
+    for i in range(len(line_starts)):
+        j = 0
+        while j < len(cont_chunks):
+            if line_ends[i] < cont_chunks[j]["start"] or line_starts[i] > cont_chunks[j]["end"]:
+                pass
+            elif line_starts[i] <= cont_chunks[j]["start"] and line_ends[i] >= cont_chunks[j]["end"]:
+                cont_chunks.pop(j)
+                j = j - 1
+            elif line_starts[i] < cont_chunks[j]["start"] and line_ends[i] >= cont_chunks[j]["start"]:
+                cont_chunks[j]["start"] = line_ends[i]
+            elif line_starts[i] <= cont_chunks[j]["end"] and line_ends[i] > cont_chunks[j]["end"]:
+                cont_chunks[j]["end"] = line_starts[i]
+            elif line_starts[i] > cont_chunks[j]["start"] and line_ends[i] < cont_chunks[j]["end"]:
+                cont_chunks.insert(j + 1, dict(start=line_ends[i], end=cont_chunks[j]["end"]))
+                cont_chunks[j]["end"] = line_starts[i]
+                j = j + 1
+            j = j + 1
+
+    return cont_chunks
+
+
+def test_partition_cont_range_matches_loops():
+    '''
+    Random line ranges within and around the SPW, with distinct edges.
+    '''
+
+    rng = np.random.default_rng(2021)
+
+    for trial in range(500):
+        nlines = rng.integers(1, 40)
+
+        spw_start, spw_end = 1.0, 1.128
+
+        line_starts = rng.uniform(0.95, 1.15, nlines)
+        line_widths = rng.exponential(rng.choice([1e-4, 1e-3, 1e-2]), nlines)
+
+        line_freqs = np.vstack([line_starts, line_starts + line_widths]).T
+
+        out = partition_cont_range(line_freqs, spw_start, spw_end)
+        ref = partition_cont_range_loops(line_freqs, spw_start, spw_end)
+
+        assert out == ref
+
+
+def test_partition_cont_range_edges():
+
+    # A line at the SPW start, and lines sharing an edge.
+    out = partition_cont_range([[1.0, 1.1], [1.3, 1.4], [1.4, 1.5]], 1.0, 2.0)
+
+    assert out == [dict(start=1.1, end=1.3), dict(start=1.5, end=2.0)]
+
+    # A reversed range is treated as (min, max). A line ending at the SPW end
+    # removes the end of the SPW.
+    out = partition_cont_range([[1.6, 1.5], [1.9, 2.0]], 1.0, 2.0)
+
+    assert out == [dict(start=1.0, end=1.5), dict(start=1.6, end=1.9)]
+
+    # No lines in the SPW
+    out = partition_cont_range([[2.5, 2.6]], 1.0, 2.0)
+
+    assert out == [dict(start=1.0, end=2.0)]
+
+    # A line covering the whole SPW
+    out = partition_cont_range([[0.5, 2.6]], 1.0, 2.0)
+
+    assert out == []
@@ -0,0 +1,118 @@
+
+import numpy as np
+
+from lband_pipeline.line_tools.line_tools import rolling_window, masked_savgol
+
+
+def masked_savgol_loops(series, window_size, poly_order):
+    '''
+    The original per-channel `np.ma.polyfit` smoothing, kept as the reference.
+    '''
+
+    x_polyfit = np.arange(window_size) - np.floor(window_size / 2.)
+
+    rolled_array = rolling_window(series, window_size)
+
+    smoothed = np.full(series.shape, np.nan, dtype=complex)
+
+    for i in range(series.size):
+        if (~rolled_array[i].mask).sum() < poly_order + 1:
+            continue
+
+        smoothed[i] = np.ma.polyfit(x_polyfit, rolled_array[i], poly_order)[-1]
+
+    return smoothed
+
+
+def test_masked_savgol_matches_polyfit():
+
+    rng = np.random.default_rng(15)
+
+    nchan = 64
+    chans = np.arange(nchan)
+
+    values = ((1 + 0.01 * chans + 1e-4 * chans**2) * np.exp(0.02j * chans) +
+              0.05 * (rng.normal(size=nchan) + 1j * rng.normal(size=nchan)))
+
+    mask = np.zeros(nchan, dtype=bool)
+    # A gap and flagged edge channels
+    mask[25:36] = True
+    mask[:3] = True
+    mask[-2:] = True
+
+    for window_size, poly_order in [(27, 2), (9, 1), (15, 3)]:
+
+        ref = masked_savgol_loops(np.ma.array(values, mask=mask), window_size, poly_order)
+        out = masked_savgol(values, mask, window_size, poly_order)[0]
+
+        assert np.all(np.isnan(out) == np.isnan(ref))
+        assert np.allclose(out[np.isfinite(ref)], ref[np.isfinite(ref)])
+
+
+def test_masked_savgol_too_few_points():
+
+    nchan = 30
+    values = np.ones(nchan, dtype=complex)
+
+    mask = np.zeros(nchan, dtype=bool)
+    mask[5:25] = True
+
+    out = masked_savgol(values, mask, window_size=5, poly_order=2)[0]
+
+    ref = masked_savgol_loops(np.ma.array(values, mask=mask), 5, 2)
+
+    # Channels in the middle of the gap have no unmasked points in their window.
+    assert np.all(np.isnan(out[10:20]))
+    assert np.all(np.isnan(out) == np.isnan(ref))
+    assert np.allclose(out[np.isfinite(out)], 1.)
+
+    # Everything masked
+    out = masked_savgol(values, np.ones(nchan, dtype=bool), window_size=5, poly_order=2)
+
+    assert np.all(np.isnan(out))
+
+
+def test_interpolate_spw_gaps_workers_match():
+    '''
+    The filled gaps, including the resampled residuals, do not depend on the
+    number of workers.
+    '''
+
+    from lband_pipeline.line_tools.line_tools import _interpolate_spw_gaps
+
+    rng = np.random.default_rng(17)
+
+    npol, nchan, nrow = 2, 128, 6
+    chans = np.arange(nchan)
+
+    data = ((1 + 1e-3 * chans)[np.newaxis, :, np.newaxis] *
+            np.ones((npol, nchan, nrow)) +
+            0.02 * (rng.normal(size=(npol, nchan, nrow)) +
+                    1j * rng.normal(size=(npol, nchan, nrow))))
+
+    mask = np.zeros(data.shape, dtype=bool)
+    # Edge channels and a gap common to every row
+    mask[:, :4] = True
+    mask[:, -4:] = True
+    mask[:, 60:68] = True
+    # A second gap in a single antenna, and a fully flagged antenna.
+    mask[1, 90:95, 2] = True
+    mask[:, :, 4] = True
+
+    outs = []
+    for n_workers in [1, 4]:
+        dat = np.ma.array(data.copy(), mask=mask.copy())
+
+        out, spw_gaps = _interpolate_spw_gaps(dat, 3, 2.5, 2, add_residuals=True,
+                                              n_workers=n_workers, seed=42)
+        outs.append(out)
+
+        assert spw_gaps == [[60, 68]]
+
+    assert np.array_equal(outs[0].data, outs[1].data)
+    assert np.array_equal(outs[0].mask, outs[1].mask)
+
+    # The gaps are filled and unmasked, apart from the fully flagged antenna.
+    assert not outs[0].mask[:, 60:68, :4].any()
+    assert outs[0].mask[:, :, 4].all()
+    assert not np.allclose(outs[0].data[:, 60:68, :4], data[:, 60:68, :4])
@@ -0,0 +1,132 @@
+
+import numpy as np
+import pytest
+from scipy.special import erf
+
+import casatools
+
+from lband_pipeline import ms_split_tools
+from lband_pipeline.ms_split_tools import (max_bandwidth_ratio, max_time_average,
+                                           smearing_limited_averaging)
+
+
+def test_smearing_limits():
+
+    # Invert the peak losses for a Gaussian bandpass (B&S) and time
+    # averaging (B&S 18-43).
+    for max_smearing in [0.001, 0.01, 0.05]:
+        beta = max_bandwidth_ratio(max_smearing)
+        assert np.isclose(1 / np.sqrt(1 + 2 * np.log(2) / 3 * beta**2), 1 - max_smearing)
+
+        for beam_distance in [1., 30., 1000.]:
+            tavg = max_time_average(max_smearing, beam_distance)
+            assert np.isclose(1.0830e-9 * (tavg * beam_distance)**2, max_smearing)
+
+    # 1% loss: ~0.21 beam-bandwidth product, ~3039 s at one beam
+    assert np.isclose(max_bandwidth_ratio(0.01), 0.2096, atol=1e-4)
+
+    # Close to the square-bandpass loss at small losses.
+    beta = max_bandwidth_ratio(0.01)
+    square_loss = 1 - np.sqrt(np.pi / (4 * np.log(2))) * erf(np.sqrt(np.log(2)) * beta) / beta
+    assert np.isclose(square_loss, 0.01, rtol=0.01)
+    assert np.isclose(max_time_average(0.01, 1.), 3038.8, atol=0.1)
+
+
+class _FakeTable(object):
+    '''
+    ANTENNA and MAIN tables of a 3-antenna array with 3 s integrations.
+    '''
+
+    max_baseline = 1000.
+
+    def open(self, tablename):
+        self.tablename = tablename
+
+    def close(self):
+        pass
+
+    def nrows(self):
+        return 10
+
+    def getcol(self, column, startrow=0, nrow=-1):
+        if column == 'POSITION':
+            # The flagged antenna is the furthest away.
+            return np.array([[0., 0., 0.], [self.max_baseline, 0., 0.],
+                             [0., 0.5 * self.max_baseline, 0.],
+                             [1e5, 0., 0.]]).T
+        if column == 'FLAG_ROW':
+            return np.array([False, False, False, True])
+        if column == 'INTERVAL':
+            return np.full(10, 3.)
+
+
+class _FakeMetadata(object):
+
+    meta = {'ddid_spw': [0, 1]}
+
+    # A 128 MHz continuum SPW with 1 MHz channels and a 4 MHz line SPW with
+    # 1 kHz channels.
+    _freqs = {0: 1.0e9 + 1e6 * np.arange(128),
+              1: 1.42e9 + 1e3 * np.arange(4096)}
+
+    def chanfreqs(self, spw):
+        return self._freqs[spw]
+
+    def chanwidths(self, spw):
+        return np.diff(self._freqs[spw])[:1].repeat(self._freqs[spw].size)
+
+
+@pytest.fixture
+def fake_ms(monkeypatch):
+
+    monkeypatch.setattr(casatools, 'table', _FakeTable, raising=False)
+    monkeypatch.setattr(ms_split_tools, 'get_ms_metadata', lambda ms_name: _FakeMetadata())
+
+    return _FakeTable
+
+
+def test_smearing_limited_averaging_configs(fake_ms, monkeypatch):
+
+    # D-configuration-like: 1.1 km longest baseline. The time limit is set by
+    # the top of the continuum SPW at its primary beam FWHM (45'),
+    # ~55 beams out, so 3039 s / 55 = 55.2 s -> 18 integrations.
+    monkeypatch.setattr(fake_ms, 'max_baseline', 1000.)
+
+    out = smearing_limited_averaging("fake.ms", max_smearing=0.01)
+
+    assert out['integration'] == 3.
+    # The flagged antenna is ignored.
+    assert np.isclose(out['max_baseline'], np.sqrt(1000.**2 + 500.**2))
+
+    assert out['time_bin'] == 54.
+    # 4.3 MHz in 1 MHz channels; 6.1 MHz in 1 kHz channels is clipped to
+    # the whole SPW.
+    assert out['chan_bin'] == {0: 4, 1: 4096}
+
+    # A-configuration-like: 36.4 km. The time limit of ~1.7 s is below two
+    # integrations so there is no time averaging. 132 kHz is less than one
+    # continuum channel.
+    monkeypatch.setattr(fake_ms, 'max_baseline', 36400. / np.sqrt(1.25))
+
+    out = smearing_limited_averaging("fake.ms", max_smearing=0.01)
+
+    assert np.isclose(out['max_baseline'], 36400.)
+    assert out['time_bin'] == 0
+    assert out['chan_bin'] == {0: 1, 1: 187}
+
+
+def test_smearing_limited_averaging_time_bins(fake_ms):
+
+    # Whole integrations within max_time_bin
+    out = smearing_limited_averaging("fake.ms", max_smearing=0.01, max_time_bin=20.)
+    assert out['time_bin'] == 18.
+
+    # A single integration is no averaging.
+    out = smearing_limited_averaging("fake.ms", max_smearing=0.01, max_time_bin=5.)
+    assert out['time_bin'] == 0
+
+    # A small field of view allows more averaging, up to the SPW size.
+    out = smearing_limited_averaging("fake.ms", spws=[0], max_smearing=0.01,
+                                     fov_radius_arcmin=1.)
+    assert out['chan_bin'] == {0: 128}
+    assert out['time_bin'] > 54.
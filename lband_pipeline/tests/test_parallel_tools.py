@@ -0,0 +1,24 @@
+
+import pytest
+
+from lband_pipeline.parallel_tools import run_work_items
+
+
+def _divide(num, denom):
+    return num / denom
+
+
+def test_run_work_items_failures():
+
+    work_items = [("item {}".format(denom), _divide, (1., denom), {})
+                  for denom in [1., 0., 2.]]
+
+    # Failures raise once all of the items have run.
+    with pytest.raises(RuntimeError, match="item 0.0"):
+        run_work_items(work_items, nworkers=1)
+
+    results = run_work_items(work_items, nworkers=1, best_effort=True)
+
+    assert [result['result'] for result in results] == [1., None, 0.5]
+    assert results[1]['error'] is not None
+    assert "ZeroDivisionError" in results[1]['error']
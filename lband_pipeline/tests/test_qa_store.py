@@ -0,0 +1,34 @@
+
+import numpy as np
+
+from lband_pipeline.qa_plotting.qa_store import QAStore
+from lband_pipeline.qa_plotting.qa_table_engine import (PLOTMS_TXT_DTYPE, plotms_table_header,
+                                                        write_plotms_table)
+
+
+def test_export_engine_tables_byte_for_byte(tmp_path):
+
+    rng = np.random.default_rng(5)
+
+    table = np.zeros(20, dtype=PLOTMS_TXT_DTYPE)
+    table['x'] = rng.uniform(0, 1e5, table.size)
+    table['y'] = rng.lognormal(0., 2., table.size)
+    table['chan'] = rng.integers(0, 4096, table.size)
+    table['scan'] = 3
+    table['ant1name'] = 'ea01'
+    table['ant2name'] = 'ea25'
+    table['time'] = 5.1e9 + rng.uniform(0, 100, table.size)
+    table['freq'] = rng.uniform(1., 2., table.size)
+    table['corr'] = 'RR'
+
+    filename = 'field_3C48_amp_uvdist.scan_3.txt'
+
+    write_plotms_table(str(tmp_path / filename), table, 'amp_uvdist')
+
+    store = QAStore()
+    store.add('amp_uvdist', table, filename, header=plotms_table_header('amp_uvdist'))
+
+    store.export_txt(str(tmp_path / 'export'))
+
+    with open(tmp_path / filename, 'rb') as orig, open(tmp_path / 'export' / filename, 'rb') as out:
+        assert orig.read() == out.read()
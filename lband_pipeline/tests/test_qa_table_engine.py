@@ -0,0 +1,62 @@
+
+import numpy as np
+
+from lband_pipeline.qa_plotting.qa_table_engine import ScanAccumulator
+
+
+def test_resid_is_scalar_amplitude_difference():
+    '''
+    The residual product follows plotms' 'corrected-model_scalar':
+    |<CORRECTED>| - |<MODEL>| averaged per baseline, not |<CORRECTED - MODEL>|.
+    '''
+
+    rng = np.random.default_rng(11)
+
+    ntime, nbl, nchan, ncorr = 3, 2, 8, 2
+    nrow = ntime * nbl
+
+    time_idx = np.repeat(np.arange(ntime), nbl)
+    bl_idx = np.tile(np.arange(nbl), ntime)
+
+    data = (rng.normal(size=(nrow, nchan, ncorr)) +
+            1j * rng.normal(size=(nrow, nchan, ncorr)))
+    # Same amplitude as the data but rotated in phase. The scalar residual is
+    # then close to zero while the vector residual is not.
+    model = data * np.exp(1j * rng.uniform(0, 2 * np.pi, size=data.shape))
+
+    flag = rng.random((nrow, nchan, ncorr)) < 0.2
+    weight = rng.uniform(0.5, 2., (nrow, ncorr))
+
+    acc = ScanAccumulator(time_idx, bl_idx, ntime, nbl, nchan, ncorr,
+                          chanavg=4, do_resid=True)
+
+    # Add in two chunks to check the accumulation across chunks.
+    acc.add(slice(0, 4), data[:4], flag[:4], weight[:4], model=model[:4])
+    acc.add(slice(4, nrow), data[4:], flag[4:], weight[4:], model=model[4:])
+
+    resid = acc.averages()['resid']
+
+    assert np.isrealobj(resid)
+    assert resid.shape == (nbl, 2, ncorr)
+
+    wt = np.where(flag, 0., weight[:, np.newaxis, :])
+
+    for bl in range(nbl):
+        these = bl_idx == bl
+        for jj, start in enumerate([0, 4]):
+            chans = slice(start, start + 4)
+
+            this_wt = wt[these, chans].sum((0, 1))
+            avg_data = (wt * data)[these, chans].sum((0, 1)) / this_wt
+            avg_model = (wt * model)[these, chans].sum((0, 1)) / this_wt
+
+            assert np.allclose(resid[bl, jj], np.abs(avg_data) - np.abs(avg_model))
+
+    # Matching amplitudes but different phases: the scalar residual of the
+    # unaveraged values would be zero.
+    acc1 = ScanAccumulator(np.zeros(1, dtype=int), np.zeros(1, dtype=int),
+                           1, 1, 1, 1, chanavg=1, do_resid=True)
+    acc1.add(slice(0, 1), np.array([[[1. + 0j]]]), np.zeros((1, 1, 1), dtype=bool),
+             np.ones((1, 1)), model=np.array([[[1j]]]))
+
+    assert np.allclose(acc1.averages()['resid'], 0.)
@@ -0,0 +1,78 @@
+
+import numpy as np
+import pytest
+
+from lband_pipeline.qa_plotting.quantile_sketch import GroupedQuantileSketch
+
+
+def test_sketch_quantiles_within_accuracy():
+
+    rng = np.random.default_rng(5)
+
+    ngroup = 4
+    groups = rng.integers(0, ngroup, 20000)
+    # Values of both signs over several decades.
+    values = rng.lognormal(0., 2., groups.size) * rng.choice([-1, 1], groups.size)
+    values[::97] = np.nan
+
+    sketch = GroupedQuantileSketch(relative_accuracy=0.01)
+    sketch.add(groups, values)
+
+    qs = [0., 0.25, 0.5, 0.75, 1.]
+
+    out_groups, counts, quants = sketch.quantiles(qs)
+
+    assert np.all(out_groups == np.arange(ngroup))
+
+    for jj, group in enumerate(out_groups):
+        these = values[(groups == group) & np.isfinite(values)]
+
+        assert counts[jj] == these.size
+
+        ref = np.percentile(these, np.array(qs) * 100, method='lower')
+
+        assert np.all(np.abs(quants[:, jj] - ref) <= 0.01 * np.abs(ref))
+
+
+def test_sketch_merge_matches_single():
+
+    rng = np.random.default_rng(8)
+
+    groups = rng.integers(0, 10, 5000)
+    values = rng.normal(5., 3., groups.size)
+
+    single = GroupedQuantileSketch()
+    single.add(groups, values)
+
+    merged = GroupedQuantileSketch()
+    for chunk in np.array_split(np.arange(groups.size), 3):
+        part = GroupedQuantileSketch()
+        part.add(groups[chunk], values[chunk])
+        merged.merge(part)
+
+    assert np.all(merged.keys == single.keys)
+    assert np.all(merged.counts == single.counts)
+
+    for out, ref in zip(merged.quantiles([0.25, 0.5]), single.quantiles([0.25, 0.5])):
+        assert np.all(out == ref)
+
+
+def test_sketch_empty_and_mismatch():
+
+    sketch = GroupedQuantileSketch()
+
+    groups, counts, values = sketch.quantiles([0.5])
+
+    assert groups.size == 0
+    assert counts.size == 0
+    assert values.shape == (1, 0)
+
+    # Only NaNs leaves the sketch empty.
+    sketch.add([0, 1], [np.nan, np.nan])
+    assert sketch.groups().size == 0
+
+    with pytest.raises(ValueError):
+        sketch.merge(GroupedQuantileSketch(relative_accuracy=0.02))
+
+    with pytest.raises(ValueError):
+        sketch.merge(GroupedQuantileSketch(min_value=1e-3))
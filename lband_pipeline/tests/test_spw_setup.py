@@ -0,0 +1,64 @@
+
+import numpy as np
+
+from lband_pipeline.spw_setup import LineCatalogue, linerest_dict_GHz
+from lband_pipeline.line_tools.line_flagging import lines_rest2obs
+
+
+def test_catalogue_matches_line_loop():
+    '''
+    Compare to checking every line against every SPW range, as in the
+    original SPW identification.
+    '''
+
+    catalogue = LineCatalogue(linerest_dict_GHz)
+
+    rng = np.random.default_rng(346)
+
+    fmins = rng.uniform(1.0e9, 2.0e9, 200)
+    fmaxs = fmins + rng.choice([4e6, 8e6, 64e6, 1e9], 200)
+
+    for vsys in [-300., 0., 250.]:
+
+        matches = catalogue.lines_in_ranges(fmins, fmaxs, vsys=vsys)
+
+        for fmin, fmax, match in zip(fmins, fmaxs, matches):
+            ref = [line for line in linerest_dict_GHz
+                   if fmin < lines_rest2obs(linerest_dict_GHz[line], vsys) * 1e9 < fmax]
+
+            assert match == ref
+
+
+def test_catalogue_overlapping_species():
+
+    catalogue = LineCatalogue(linerest_dict_GHz)
+
+    # OH lines over a galaxy's velocity range within a 1.66-1.67 GHz SPW.
+    names, freq_ranges = catalogue.lines_overlapping(1.66e9, 1.67e9, [-20., -600.],
+                                                     species='OH')
+
+    assert names == ["OH1665", "OH1667"]
+
+    assert np.allclose(freq_ranges[0], [lines_rest2obs(1.66540180e9, -20.),
+                                        lines_rest2obs(1.66540180e9, -600.)])
+
+    # The RRL H158a is also within range but is not an OH line.
+    names, freq_ranges = catalogue.lines_overlapping(1.64e9, 1.67e9, [-20., -600.])
+
+    assert names == ["OH1665", "OH1667", "H158a"]
+
+
+def test_catalogue_checksum():
+
+    catalogue = LineCatalogue(linerest_dict_GHz)
+
+    assert catalogue.checksum() == LineCatalogue(dict(linerest_dict_GHz)).checksum()
+
+    # A changed rest frequency, or a new line, changes the checksum.
+    changed = dict(linerest_dict_GHz)
+    changed["OH1720"] = 1.720529887
+    assert LineCatalogue(changed).checksum() != catalogue.checksum()
+
+    changed = dict(linerest_dict_GHz)
+    changed["H100a"] = 6.47850
+    assert LineCatalogue(changed).checksum() != catalogue.checksum()
@@ -28,7 +28,7 @@ mySDM = sys.argv[-1]
 myvis = mySDM if mySDM.endswith("ms") else mySDM + ".ms"
 
 # Get the SPW mapping for the continuum MS.
-spwdict_filename = "spw_definitions.npy"
+spwdict_filename = "spw_definitions.json"
 contspw_dict = create_spw_dict(myvis,
                                continuum_only=True,
                                save_spwdict=True,